@@ -0,0 +1,265 @@
+# ============================================================
+#
+#  Easy backup
+#  Backup Pipeline Benchmark
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+#
+# Usage:
+#   python benchmarks/bench_backup.py --profile tiny_files --files 200000 --output results.json
+#   python benchmarks/bench_backup.py --profile all --compare baseline.json --threshold 0.10
+#
+# Every profile is backed up three times through run_incremental_backup: first run,
+# unchanged incremental and churned incremental. The "remote" side is a local folder
+# reached through fake_ssh.py, installed as ssh and sshpass in front of PATH, so only
+# rsync is needed. Each run happens in its own process so peak RSS is per run.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+PROFILES = ("tiny_files", "huge_files", "deep_nesting")
+RUNS = ("first", "unchanged", "churned")
+
+
+def write_file(path, size, rng):
+    with open(path, "wb") as f:
+        f.write(rng.randbytes(size))
+
+
+def generate_tree(root, profile, files, seed=1988):
+    """
+    Create a synthetic source tree.
+
+    Profiles:
+    - tiny_files: files small files of 0-4 KiB, 1000 per folder.
+    - huge_files: files // 1000 (at least 2) files of 64 MiB.
+    - deep_nesting: files small files spread over folders nested 32 levels deep.
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+
+    if profile == "tiny_files":
+        for i in range(files):
+            folder = os.path.join(root, f"dir_{i // 1000:05d}")
+            os.makedirs(folder, exist_ok=True)
+            write_file(os.path.join(folder, f"file_{i:08d}.dat"), rng.randint(0, 4096), rng)
+
+    elif profile == "huge_files":
+        for i in range(max(2, files // 1000)):
+            write_file(os.path.join(root, f"image_{i:03d}.img"), 64 * 1024 * 1024, rng)
+
+    elif profile == "deep_nesting":
+        for i in range(files):
+            depth = i % 32
+            folder = os.path.join(root, *[f"level_{level}_{i % 7}" for level in range(depth)])
+            os.makedirs(folder, exist_ok=True)
+            write_file(os.path.join(folder, f"file_{i:08d}.dat"), rng.randint(0, 8192), rng)
+
+    else:
+        raise ValueError(f"Unknown profile {profile}")
+
+
+def churn_tree(root, fraction, seed=2024):
+    """
+    Modify, delete and add files: fraction of the files is touched, split evenly.
+    """
+    rng = random.Random(seed)
+    paths = sorted(str(path) for path in Path(root).rglob("*") if path.is_file())
+    touched = rng.sample(paths, max(1, int(len(paths) * fraction)))
+    for i, path in enumerate(touched):
+        action = i % 3
+        if action == 0:
+            size = os.path.getsize(path)
+            write_file(path, max(1, size), rng)
+        elif action == 1:
+            os.remove(path)
+        else:
+            write_file(path + ".new", max(1, os.path.getsize(path) // 2), rng)
+
+
+def tree_totals(root):
+    files, size = 0, 0
+    for path in Path(root).rglob("*"):
+        if path.is_file():
+            files += 1
+            size += path.stat().st_size
+    return files, size
+
+
+def prepare_environment(work_dir):
+    """Install the SSH stand-in in front of PATH."""
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    install_fake_ssh(bin_dir)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+
+def install_fake_ssh(bin_dir):
+    for name in ("ssh", "sshpass"):
+        link = os.path.join(bin_dir, name)
+        os.symlink(REPO_ROOT / "benchmarks" / "fake_ssh.py", link)
+
+
+def _backup_process(kwargs, queue):
+    from utils.easybackup_core import run_incremental_backup
+
+    start = time.monotonic()
+    exit_code = run_incremental_backup(**kwargs)
+    wall_time = time.monotonic() - start
+
+    # ru_maxrss is in KiB on Linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put({"exit_code": exit_code, "wall_time": wall_time, "peak_rss_kb": peak_rss})
+
+
+def timed_backup(kwargs, ssh_log):
+    """Run one backup in a child process and collect its metrics."""
+    open(ssh_log, "w").close()
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_backup_process, args=(kwargs, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    with open(ssh_log) as f:
+        calls = f.read().split()
+    result["ssh_handshakes"] = calls.count("auth")
+    result["ssh_commands"] = calls.count("ssh")
+    return result
+
+
+def bench_profile(profile, files, churn, work_dir, backup_options):
+    """
+    Benchmark the first, unchanged and churned runs of one profile.
+
+    Returns:
+    - dict: run name -> metrics.
+    """
+    source = os.path.join(work_dir, profile, "source")
+    remote = os.path.join(work_dir, profile, "remote")
+    os.makedirs(remote, exist_ok=True)
+    generate_tree(source, profile, files)
+
+    kwargs = {"local_path": source + "/", "remote_path": remote, "ssh_user": "bench",
+              "remote_host": "localhost", "ssh_password": "bench", **backup_options}
+    ssh_log = os.path.join(work_dir, "ssh_calls.log")
+    os.environ["EASYBACKUP_FAKE_SSH_LOG"] = ssh_log
+
+    results = {}
+    for run in RUNS:
+        if run == "churned":
+            churn_tree(source, churn)
+        total_files, total_bytes = tree_totals(source)
+
+        # Snapshots are named to the second
+        time.sleep(1)
+        metrics = timed_backup(kwargs, ssh_log)
+        metrics["files"] = total_files
+        metrics["bytes"] = total_bytes
+        metrics["files_per_s"] = total_files / metrics["wall_time"]
+        metrics["mb_per_s"] = total_bytes / 1024 ** 2 / metrics["wall_time"]
+        results[run] = metrics
+        print(f"{profile:>12} {run:>9}: {metrics['wall_time']:8.2f}s {metrics['files_per_s']:10.0f} files/s "
+              f"{metrics['mb_per_s']:8.1f} MB/s  ssh {metrics['ssh_handshakes']} auth/"
+              f"{metrics['ssh_commands']} cmd  rss {metrics['peak_rss_kb'] / 1024:.0f} MiB  "
+              f"exit {metrics['exit_code']}")
+    return results
+
+
+def compare_results(current, baseline, threshold):
+    """
+    Compare wall times with a previous result file.
+
+    Returns:
+    - list: Human readable regressions, empty if none is above threshold.
+    """
+    regressions = []
+    for profile, runs in current["profiles"].items():
+        for run, metrics in runs.items():
+            previous = baseline.get("profiles", {}).get(profile, {}).get(run)
+            if not previous:
+                continue
+            change = metrics["wall_time"] / previous["wall_time"] - 1
+            if change > threshold:
+                regressions.append(f"{profile}/{run}: {previous['wall_time']:.2f}s -> "
+                                   f"{metrics['wall_time']:.2f}s (+{change:.0%})")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EasyBackup pipeline benchmark")
+    parser.add_argument("--profile", default="all", choices=PROFILES + ("all",))
+    parser.add_argument("--files", type=int, default=100000, help="Number of files per profile [100000].")
+    parser.add_argument("--churn", type=float, default=0.01, help="Fraction of files churned [0.01].")
+    parser.add_argument("--parallel-shards", type=int, default=None)
+    parser.add_argument("--fast-seed", action="store_true", help="Seed the first run with a tar stream.")
+    parser.add_argument("--seed-compression", default="zstd", choices=("zstd", "lz4", "none"))
+    parser.add_argument("--seed-level", type=int, default=None)
+    parser.add_argument("--output", default="bench_results.json", help="Result file [bench_results.json].")
+    parser.add_argument("--compare", metavar="BASELINE", help="Previous result file to check against.")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Allowed wall time increase over the baseline [0.10].")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated trees.")
+    args = parser.parse_args()
+
+    if shutil.which("rsync") is None:
+        sys.exit("rsync is required to run the benchmark.")
+
+    work_dir = tempfile.mkdtemp(prefix="easybackup_bench_")
+    prepare_environment(work_dir)
+
+    profiles = PROFILES if args.profile == "all" else (args.profile,)
+    backup_options = {"parallel_shards": args.parallel_shards, "fast_seed": args.fast_seed,
+                      "seed_compression": args.seed_compression, "seed_level": args.seed_level}
+    try:
+        results = {"revision": git_revision(),
+                   "python": platform.python_version(),
+                   "settings": vars(args),
+                   "profiles": {profile: bench_profile(profile, args.files, args.churn, work_dir, backup_options)
+                                for profile in profiles}}
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
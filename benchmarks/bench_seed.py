@@ -0,0 +1,97 @@
+# ============================================================
+#
+#  Easy backup
+#  First Backup Seeding Benchmark
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+#
+# Usage:
+#   python benchmarks/bench_seed.py --files 200000 --output seed_results.json
+#
+# Times the first backup of the tiny_files and huge_files profiles with plain rsync
+# and with the tar stream seed (no compression, lz4 and zstd), using the same local
+# SSH stand-in as bench_backup.py.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bench_backup import generate_tree, tree_totals, timed_backup, prepare_environment, git_revision
+
+MODES = {
+    "rsync": {"fast_seed": False},
+    "seed_none": {"fast_seed": True, "seed_compression": "none"},
+    "seed_lz4": {"fast_seed": True, "seed_compression": "lz4"},
+    "seed_zstd": {"fast_seed": True, "seed_compression": "zstd"},
+}
+
+
+def bench_first_backup(profile, files, work_dir):
+    """
+    Time a first backup of one profile in every mode.
+
+    Returns:
+    - dict: mode -> metrics.
+    """
+    source = os.path.join(work_dir, profile, "source")
+    generate_tree(source, profile, files)
+    total_files, total_bytes = tree_totals(source)
+    ssh_log = os.path.join(work_dir, "ssh_calls.log")
+    os.environ["EASYBACKUP_FAKE_SSH_LOG"] = ssh_log
+
+    results = {}
+    for mode, options in MODES.items():
+        remote = os.path.join(work_dir, profile, f"remote_{mode}")
+        os.makedirs(remote)
+        kwargs = {"local_path": source + "/", "remote_path": remote, "ssh_user": "bench",
+                  "remote_host": "localhost", "ssh_password": "bench", **options}
+        metrics = timed_backup(kwargs, ssh_log)
+        metrics["files"] = total_files
+        metrics["bytes"] = total_bytes
+        metrics["files_per_s"] = total_files / metrics["wall_time"]
+        metrics["mb_per_s"] = total_bytes / 1024 ** 2 / metrics["wall_time"]
+        results[mode] = metrics
+        print(f"{profile:>12} {mode:>10}: {metrics['wall_time']:8.2f}s {metrics['files_per_s']:10.0f} files/s "
+              f"{metrics['mb_per_s']:8.1f} MB/s  exit {metrics['exit_code']}")
+
+        # The remote copies are not needed anymore and can be large
+        shutil.rmtree(remote, ignore_errors=True)
+        time.sleep(1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EasyBackup first backup seeding benchmark")
+    parser.add_argument("--files", type=int, default=100000, help="Number of files per profile [100000].")
+    parser.add_argument("--output", default="bench_seed_results.json", help="Result file [bench_seed_results.json].")
+    args = parser.parse_args()
+
+    for tool in ("rsync", "tar", "zstd", "lz4"):
+        if shutil.which(tool) is None:
+            sys.exit(f"{tool} is required to run the seeding benchmark.")
+
+    work_dir = tempfile.mkdtemp(prefix="easybackup_bench_seed_")
+    prepare_environment(work_dir)
+    try:
+        results = {"revision": git_revision(),
+                   "settings": vars(args),
+                   "profiles": {profile: bench_first_backup(profile, args.files, work_dir)
+                                for profile in ("tiny_files", "huge_files")}}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
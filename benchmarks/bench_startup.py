@@ -0,0 +1,102 @@
+# ============================================================
+#
+#  Easy backup
+#  Command Line Start-up Benchmark
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+#
+# Usage:
+#   python benchmarks/bench_startup.py --runs 20 --budget-ms 150
+#
+# Starts easybackup_cmd.py for the quick commands in a clean HOME (no vault) and
+# reports the median wall time and the slowest imports (python -X importtime) of
+# each. Exits with status 1 if a command is over the budget, so it can run in CI.
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+CLI = str(REPO_ROOT / "easybackup_cmd.py")
+
+COMMANDS = {
+    "help": ["--help"],
+    "list": ["--list-backups"],
+    "estimate_missing": ["--estimate", "missing"],
+    "prune_missing": ["--prune-backups", "missing"],
+}
+
+IMPORTTIME_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+
+def time_command(args, env, runs):
+    """Return the wall times in seconds of runs starts of the CLI."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, CLI] + args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       cwd=env["HOME"])
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def slowest_imports(args, env, count=5):
+    """
+    Return the top level imports with the largest cumulative time (microseconds).
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", CLI] + args, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True, cwd=env["HOME"])
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        # Only modules imported directly by the script or the interpreter (one space of indentation)
+        if match and len(match.group(3)) == 1:
+            imports.append((match.group(4), int(match.group(2))))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EasyBackup command line start-up benchmark")
+    parser.add_argument("--runs", type=int, default=20, help="Starts per command [20].")
+    parser.add_argument("--budget-ms", type=float, default=150.0, help="Median wall time budget per command [150].")
+    parser.add_argument("--output", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix="easybackup_bench_startup_")
+    env = {**os.environ, "HOME": home}
+
+    results = {}
+    over_budget = []
+    for name, command in COMMANDS.items():
+        times = time_command(command, env, args.runs)
+        median_ms = statistics.median(times) * 1000
+        imports = slowest_imports(command, env)
+        results[name] = {"median_ms": median_ms, "max_ms": max(times) * 1000,
+                         "slowest_imports_us": dict(imports)}
+        status = "ok" if median_ms <= args.budget_ms else "OVER BUDGET"
+        print(f"{name:>18}: median {median_ms:7.1f} ms  max {max(times) * 1000:7.1f} ms  [{status}]")
+        print("                    " + ", ".join(f"{module} {us / 1000:.1f} ms" for module, us in imports))
+        if median_ms > args.budget_ms:
+            over_budget.append(name)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"budget_ms": args.budget_ms, "commands": results}, f, indent=2)
+
+    if over_budget:
+        sys.exit(f"Over the {args.budget_ms:.0f} ms start-up budget: {', '.join(over_budget)}")
+
+
+if __name__ == "__main__":
+    main()
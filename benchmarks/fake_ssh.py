@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# ============================================================
+#
+#  Easy backup
+#  Local SSH Stand-in for Benchmarks
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+#
+# Installed as "ssh" and "sshpass" in a temporary bin folder put first in PATH.
+# Remote commands run on the local machine, so the backup pipeline can be measured
+# without a network or an sshd. Every invocation is appended to $EASYBACKUP_FAKE_SSH_LOG
+# ("auth" for sshpass, i.e. a real handshake, "ssh" for any ssh command).
+
+import os
+import sys
+
+# ssh options taking a value
+OPTIONS_WITH_VALUE = set("bcDEeFIiJLlmOopQRSWw")
+
+
+def log_call(kind):
+    log_file = os.environ.get("EASYBACKUP_FAKE_SSH_LOG")
+    if log_file:
+        with open(log_file, "a") as f:
+            f.write(kind + "\n")
+
+
+def fake_sshpass(args):
+    log_call("auth")
+    # Drop "-e" or "-p <password>" and run the wrapped command (the fake ssh)
+    while args and args[0].startswith("-"):
+        option = args.pop(0)
+        if option == "-p":
+            args.pop(0)
+    os.execvp(args[0], args)
+
+
+def fake_ssh(args):
+    log_call("ssh")
+    flags = set()
+    while args and args[0].startswith("-"):
+        option = args.pop(0)
+        letter = option[1:2]
+        if letter in OPTIONS_WITH_VALUE:
+            if not option[2:]:
+                args.pop(0)
+            if letter == "O":
+                flags.add("control")  # -O exit/check: nothing to tear down
+        else:
+            flags.update(option[1:])
+
+    args.pop(0)  # user@host
+    if "N" in flags or "control" in flags or not args:
+        sys.exit(0)
+    os.execvp("sh", ["sh", "-c", " ".join(args)])
+
+
+if __name__ == "__main__":
+    if os.path.basename(sys.argv[0]) == "sshpass":
+        fake_sshpass(sys.argv[1:])
+    else:
+        fake_ssh(sys.argv[1:])
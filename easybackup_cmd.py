@@ -12,11 +12,14 @@
 # ===========================================================
 
 import argparse
-from utils.cmd_credentials_management import create_backup_config_cmd, \
-     list_backup_configs_cmd, del_backup_configs_cmd, modify_backup_configs_cmd,\
-     run_backup, run_all_active_backups
-# from utils.easybackup_core import run_incremental_backup
-from utils.logger import logger  # Import the shared logger
+import logging
+import sys
+# Each command imports its own modules below, so --help and the quick commands
+# do not load the backup engine, the crypto library, the daemons or the log handlers
+
+COMMANDS = ("create_backup", "list_backups", "del_backup", "modify_backup", "run_backup", "prune_backups",
+            "estimate", "watch_backup", "scheduler", "run_all_backups", "manifest_list", "manifest_diff",
+            "manifest_find", "verify", "restore", "probe_all")
 
 def main():
     parser = argparse.ArgumentParser(description="Backup Management Script")
@@ -30,8 +33,97 @@ def main():
                         help="Delete a backup configuration.")
     parser.add_argument("-mbc", "--modify-backup", action="store_true", 
                         help="Modify a backup configuration.")                
+    parser.add_argument("-rab", "--run-all-backups", action="store_true",
+                        help="Run all active backup configurations concurrently.")
+    parser.add_argument("-wbc", "--watch-backup", metavar="NAME",
+                        help="Continuously back up a configuration, syncing changed folders as they change.")
+    parser.add_argument("--sync-interval", type=int, default=300,
+                        help="Minimum seconds between two syncs of changed folders with --watch-backup [300].")
+    parser.add_argument("--full-interval", type=int, default=86400,
+                        help="Seconds between two full backup passes with --watch-backup [86400].")
+    parser.add_argument("-sd", "--scheduler", action="store_true",
+                        help="Run every active configuration on its schedule from one long-lived process.")
+    parser.add_argument("--jitter", type=int, default=300,
+                        help="Maximum random delay in seconds of scheduled runs with --scheduler [300].")
+    parser.add_argument("-pbc", "--prune-backups", metavar="NAME",
+                        help="Apply the retention rules of a configuration without running a backup.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="With --prune-backups, only report the snapshots that would be deleted.")
+    parser.add_argument("-ebc", "--estimate", metavar="NAME",
+                        help="Estimate the files, bytes and duration of the next run of a configuration.")
+    parser.add_argument("--window", type=float, metavar="HOURS",
+                        help="Warn if --run-all-backups is not expected to finish within this many hours.")
+    parser.add_argument("--no-preflight", action="store_true",
+                        help="Do not estimate and order the jobs longest first with --run-all-backups.")
+    parser.add_argument("--max-workers", type=int, default=4,
+                        help="Maximum number of backups running at once with --run-all-backups or --scheduler [4].")
+    parser.add_argument("--per-host", type=int, default=1,
+                        help="Maximum number of backups running at once against one remote host [1].")
+    parser.add_argument("--per-disk", type=int, default=1,
+                        help="Maximum number of backups running at once reading one local disk [1].")
+    parser.add_argument("-mls", "--manifest-list", metavar="NAME",
+                        help="List the snapshot manifests of a configuration with their size.")
+    parser.add_argument("-mdf", "--manifest-diff", metavar="NAME",
+                        help="Show what changed between two snapshots of a configuration, from their manifests.")
+    parser.add_argument("--from", dest="from_snapshot", metavar="SNAPSHOT",
+                        help="Older snapshot of --manifest-diff [the one before --to].")
+    parser.add_argument("--to", dest="to_snapshot", metavar="SNAPSHOT",
+                        help="Newer snapshot of --manifest-diff [latest].")
+    parser.add_argument("-mfd", "--manifest-find", nargs=2, metavar=("NAME", "PATH"),
+                        help="List the snapshots of a configuration holding PATH (relative to the snapshot).")
+
+    parser.add_argument("-vbc", "--verify", metavar="NAME",
+                        help="Hash the latest snapshot of a configuration and the local files, and report mismatches.")
+    parser.add_argument("--sample", metavar="SIZE",
+                        help="With --verify, only check a fraction (0.05, 5%%) or a byte budget (200G) per run, "
+                             "continuing where the previous run stopped [every file].")
+    parser.add_argument("--snapshot", metavar="SNAPSHOT",
+                        help="Snapshot checked by --verify or restored by --restore instead of latest.")
+    parser.add_argument("--hash", default="sha256", choices=("sha256", "sha1", "md5", "blake2b"),
+                        help="Digest used by --verify, the matching *sum tool must exist on the remote host [sha256].")
+    parser.add_argument("--hash-workers", type=int,
+                        help="Local hashing processes of --verify [CPU count].")
+
+    parser.add_argument("-rsb", "--restore", metavar="NAME",
+                        help="Restore the latest snapshot (or --snapshot) of a configuration into --target.")
+    parser.add_argument("--target", metavar="DIR",
+                        help="Local folder --restore writes into.")
+    parser.add_argument("--include", action="append", metavar="PATTERN",
+                        help="With --restore, only restore this path or glob, relative to the snapshot. Repeatable.")
+    parser.add_argument("--streams", type=int, default=4,
+                        help="Parallel rsync streams of --restore [4].")
+
+    parser.add_argument("-pah", "--probe-all", action="store_true",
+                        help="Check every configured host at once (TCP connect and SSH login) and print the results.")
+    parser.add_argument("--probe-ttl", type=int, default=300,
+                        help="Seconds --run-all-backups and --scheduler trust a host probe before probing again, "
+                             "0 to not probe [300].")
+
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Show debug messages (rsync progress) on the console.")
+    parser.add_argument("--log-json", action="store_true",
+                        help="Write log records as JSON lines.")
+    parser.add_argument("--log-rotate", metavar="WHEN",
+                        help="Rotate the log file by time (e.g. midnight) instead of by size, or 'external' "
+                             "to only reopen it after logrotate moved it.")
 
     args = parser.parse_args()
+    if not any(getattr(args, command) for command in COMMANDS):
+        parser.print_help()
+        return
+
+    from utils.logger import configure_logging
+    from utils.state import safe_config_name
+    # One log file per command, and per config for the commands taking a config name, a
+    # rotation by one process would otherwise pull the file from under the others
+    log_name = next(command for command in COMMANDS if getattr(args, command))
+    config_name = getattr(args, log_name)
+    if isinstance(config_name, list):
+        config_name = config_name[0]  # --manifest-find NAME PATH
+    if isinstance(config_name, str):
+        log_name += f"_{safe_config_name(config_name)}"
+    configure_logging(console_level=logging.DEBUG if args.verbose else logging.INFO, json_format=args.log_json,
+                      rotate_when=args.log_rotate, log_name=log_name)
 
     ######################################
     # DEBUG: Simulating run_backup entry
@@ -49,21 +141,88 @@ def main():
     ######################################
 
     if args.create_backup:
+        from utils.cmd_credentials_management import create_backup_config_cmd
         create_backup_config_cmd()
 
     elif args.list_backups:
+        from utils.cmd_credentials_management import list_backup_configs_cmd
         list_backup_configs_cmd()
 
     elif args.del_backup:
+        from utils.cmd_credentials_management import del_backup_configs_cmd
         del_backup_configs_cmd()
 
     elif args.modify_backup:        
+        from utils.cmd_credentials_management import modify_backup_configs_cmd
         modify_backup_configs_cmd()        
         
     elif args.run_backup:                
-        run_backup(config_name=args.run_backup)
-    else:
-        parser.print_help()
+        from utils.cmd_credentials_management import run_backup
+        exit_code = run_backup(config_name=args.run_backup)
+        if exit_code != 0:
+            # The job exit code (rsync's, SSH failure, phase timeout), 1 if the config does not exist
+            sys.exit(1 if exit_code is None else exit_code)
+
+    elif args.prune_backups:
+        from utils.cmd_credentials_management import prune_backups_cmd
+        prune_backups_cmd(config_name=args.prune_backups, dry_run=args.dry_run)
+
+    elif args.estimate:
+        from utils.cmd_credentials_management import estimate_backup_cmd
+        estimate_backup_cmd(config_name=args.estimate)
+
+    elif args.manifest_list:
+        from utils.cmd_credentials_management import manifest_list_cmd
+        manifest_list_cmd(config_name=args.manifest_list)
+
+    elif args.manifest_diff:
+        from utils.cmd_credentials_management import manifest_diff_cmd
+        manifest_diff_cmd(config_name=args.manifest_diff, old=args.from_snapshot, new=args.to_snapshot)
+
+    elif args.manifest_find:
+        from utils.cmd_credentials_management import manifest_find_cmd
+        manifest_find_cmd(config_name=args.manifest_find[0], path=args.manifest_find[1])
+
+    elif args.verify:
+        from utils.cmd_credentials_management import verify_backup_cmd
+        if verify_backup_cmd(config_name=args.verify, sample=args.sample, snapshot=args.snapshot,
+                             algorithm=args.hash, workers=args.hash_workers) is False:
+            sys.exit(1)
+
+    elif args.restore:
+        if not args.target:
+            parser.error("--restore needs --target")
+        from utils.cmd_credentials_management import restore_backup_cmd
+        if restore_backup_cmd(config_name=args.restore, target_dir=args.target, snapshot=args.snapshot,
+                              patterns=args.include, streams=args.streams) != 0:
+            sys.exit(1)
+
+    elif args.probe_all:
+        from utils.cmd_credentials_management import probe_all_cmd
+        if not probe_all_cmd():
+            sys.exit(1)
+
+    elif args.watch_backup:
+        from utils.watch_daemon import watch_backup
+        watch_backup(config_name=args.watch_backup, sync_interval=args.sync_interval,
+                     full_interval=args.full_interval)
+
+    elif args.scheduler:
+        from utils.scheduler import run_scheduler
+        run_scheduler(max_workers=max(1, args.max_workers), per_host_limit=max(1, args.per_host),
+                      per_disk_limit=max(1, args.per_disk), jitter=max(0, args.jitter),
+                      probe_ttl=max(0, args.probe_ttl))
+
+    elif args.run_all_backups:
+        from utils.concurrent_runner import run_all_active_backups_concurrently
+        all_ok = run_all_active_backups_concurrently(max_workers=max(1, args.max_workers),
+                                                     per_host_limit=max(1, args.per_host),
+                                                     per_disk_limit=max(1, args.per_disk),
+                                                     preflight=not args.no_preflight,
+                                                     window_hours=args.window,
+                                                     probe_ttl=max(0, args.probe_ttl))
+        if not all_ok:
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+# ============================================================
+#
+#  Easy backup
+#  Non-blocking Subprocess Helpers
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import asyncio
+import contextlib
+import os
+import subprocess
+
+
+async def terminate(process):
+    """Kill a child process if it is still running and reap it."""
+    if process.returncode is None:
+        with contextlib.suppress(ProcessLookupError):
+            process.kill()
+        await process.wait()
+
+
+async def run_process(argv, input=None, timeout=None, env=None, check=False):
+    """
+    Run a command without a shell, reading stdout and stderr concurrently.
+
+    The child is killed when timeout expires or the calling task is cancelled, so a
+    cancelled job never leaves processes behind.
+
+    Args:
+    - argv (list): Command and arguments.
+    - input (str or bytes): Data written to the command's stdin.
+    - timeout (float): Seconds before the command is killed and asyncio.TimeoutError raised, None for no limit.
+    - env (dict): Environment of the command, the current one if None.
+    - check (bool): Raise subprocess.CalledProcessError on a non-zero exit code.
+
+    Returns:
+    - subprocess.CompletedProcess: With stdout and stderr as text.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *argv, stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env)
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            process.communicate(input.encode(errors="surrogateescape") if isinstance(input, str) else input), timeout)
+    except BaseException:
+        await terminate(process)
+        raise
+
+    result = subprocess.CompletedProcess(argv, process.returncode, stdout.decode(errors="replace"),
+                                         stderr.decode(errors="replace"))
+    if check:
+        result.check_returncode()
+    return result
+
+
+async def run_pipeline(commands, env=None):
+    """
+    Run commands connected stdout to stdin, like a shell pipeline without the shell.
+
+    Only the next process holds each pipe, so a failing reader stops the writer.
+
+    Args:
+    - commands (list): argv lists, in pipeline order.
+    - env (dict): Environment of every command, the current one if None.
+
+    Returns:
+    - list: Exit codes, in pipeline order.
+    """
+    processes = []
+    read_fd = None
+    try:
+        for index, argv in enumerate(commands):
+            last = index == len(commands) - 1
+            write_fd = None
+            if not last:
+                next_read_fd, write_fd = os.pipe()
+            try:
+                processes.append(await asyncio.create_subprocess_exec(
+                    *argv, stdin=read_fd if read_fd is not None else asyncio.subprocess.DEVNULL,
+                    stdout=write_fd, env=env))
+            finally:
+                # The children hold their own copies of the pipe ends
+                for fd in (read_fd, write_fd):
+                    if fd is not None:
+                        os.close(fd)
+                read_fd = None
+            if not last:
+                read_fd = next_read_fd
+        return list(await asyncio.gather(*(process.wait() for process in processes)))
+    except BaseException:
+        if read_fd is not None:
+            os.close(read_fd)
+        for process in processes:
+            await terminate(process)
+        raise
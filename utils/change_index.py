@@ -0,0 +1,246 @@
+# ============================================================
+#
+#  Easy backup
+#  Local Change Index
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import hashlib
+import os
+import sqlite3
+import stat as stat_module
+
+HASH_CHUNK = 1024 * 1024
+
+
+def scan_tree(source_dir, prefix=""):
+    """
+    Walk a local tree once and stat every entry without following symlinks.
+
+    Args:
+    - source_dir (str): Directory the returned paths are relative to.
+    - prefix (str): Sub-path of source_dir to walk ("" for all of it, or "name/").
+
+    Returns:
+    - dict: relative path -> (size, mtime_ns, inode, mode). Directories are included,
+            so added or removed entries also mark their parent as changed.
+    """
+    entries = {}
+    root = os.path.join(source_dir, prefix)
+    if prefix:
+        stat = os.lstat(root)
+        entries[prefix.rstrip("/")] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_mode)
+
+    stack = [(root, prefix)]
+    while stack:
+        folder, relative = stack.pop()
+        try:
+            with os.scandir(folder) as iterator:
+                for entry in iterator:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    path = relative + entry.name
+                    entries[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_mode)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, path + "/"))
+        except OSError:
+            continue
+    return entries
+
+
+def hash_file(path):
+    """Return the BLAKE2b digest of a file, None if it can not be read."""
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def collapse_nested(paths):
+    """
+    Drop paths that live under another listed directory, e.g. a single rm -rf or a
+    recursive rsync of the parent already covers them.
+    """
+    collapsed = []
+    for path in sorted(paths):
+        if collapsed and path.startswith(collapsed[-1] + "/"):
+            continue
+        collapsed.append(path)
+    return collapsed
+
+
+class ChangeIndex:
+    """
+    Persistent per-config index (SQLite) of the files captured by the last backup.
+
+    Each row holds path, size, mtime, inode, mode, an optional content hash and the
+    snapshot that last transferred the file. Comparing it with a fresh local walk
+    gives the changed set without asking rsync to scan and compare the whole remote
+    tree, and matches moved or renamed files with their previous location.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        # Used from worker threads by the async backup job, one thread at a time
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, "
+                                "mtime_ns INTEGER, inode INTEGER, mode INTEGER, snapshot TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if "hash" not in columns:
+            # Indexes created before move detection
+            self.connection.execute("ALTER TABLE files ADD COLUMN hash TEXT")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def snapshot(self):
+        """Name of the snapshot the index describes, None if the index is empty."""
+        return self._get_meta("snapshot")
+
+    @property
+    def source(self):
+        """local_path the index was built from."""
+        return self._get_meta("source")
+
+    def is_valid_for(self, local_path, prev_backup):
+        """
+        The index can only replace the rsync scan if it describes the snapshot "latest" points to.
+        """
+        return bool(prev_backup) and self.source == local_path and \
+            self.snapshot == os.path.basename(prev_backup.rstrip("/"))
+
+    def diff(self, current):
+        """
+        Compare a scan_tree() result with the index.
+
+        Returns:
+        - list: Paths that are new or whose size, mtime, inode or mode changed (sorted).
+        - list: Paths that no longer exist locally (sorted).
+        """
+        changed = []
+        indexed_paths = set()
+        for path, size, mtime_ns, inode, mode in self.connection.execute(
+                "SELECT path, size, mtime_ns, inode, mode FROM files"):
+            indexed_paths.add(path)
+            if current.get(path, (size, mtime_ns, inode, mode)) != (size, mtime_ns, inode, mode):
+                changed.append(path)
+
+        deleted = sorted(indexed_paths.difference(current))
+        changed.extend(path for path in current if path not in indexed_paths)
+        return sorted(changed), deleted
+
+    def find_moves(self, current, changed, deleted, source_dir=None, hash_min_size=None):
+        """
+        Match new paths with the path the same file had in the previous snapshot.
+
+        A new regular file matches a deleted one with the same inode, size, mtime and
+        mode (a rename or move on the same file system). With hash_min_size, new files
+        of at least that size whose size, mtime and mode match a single indexed file are
+        also matched when their content hash equals the indexed one (copies, moves
+        across file systems). The mode has to match because the link shares the inode
+        with the previous snapshot, rsync must not change its permissions.
+
+        Args:
+        - current (dict): scan_tree() result.
+        - changed (list): Changed paths from diff().
+        - deleted (list): Deleted paths from diff().
+        - source_dir (str): Directory the paths are relative to, needed to hash new files.
+        - hash_min_size (int): Smallest file size matched by content hash, None to only match inodes.
+
+        Returns:
+        - list: (previous path, new path) tuples.
+        """
+        indexed = {}
+        for path, size, mtime_ns, inode, mode, digest in self.connection.execute(
+                "SELECT path, size, mtime_ns, inode, mode, hash FROM files"):
+            if stat_module.S_ISREG(mode):
+                indexed[path] = (size, mtime_ns, inode, mode, digest)
+
+        by_inode = {}
+        for path in deleted:
+            if path in indexed:
+                size, mtime_ns, inode, mode, _ = indexed[path]
+                by_inode[(inode, size, mtime_ns, mode)] = path
+
+        by_size_mtime = {}
+        if hash_min_size is not None:
+            for path, (size, mtime_ns, _, mode, digest) in indexed.items():
+                if size >= hash_min_size and digest:
+                    by_size_mtime.setdefault((size, mtime_ns, mode), []).append((path, digest))
+
+        moves = []
+        for path in changed:
+            if path in indexed:
+                continue  # Modified in place, not moved
+            size, mtime_ns, inode, mode = current[path]
+            if not stat_module.S_ISREG(mode) or size == 0:
+                continue
+            previous = by_inode.get((inode, size, mtime_ns, mode))
+            if previous is None and source_dir is not None:
+                candidates = by_size_mtime.get((size, mtime_ns, mode), [])
+                if len(candidates) == 1 and hash_file(os.path.join(source_dir, path)) == candidates[0][1]:
+                    previous = candidates[0][0]
+            if previous is not None:
+                moves.append((previous, path))
+        return moves
+
+    def update(self, local_path, current, snapshot, changed=None, source_dir=None, hash_min_size=None):
+        """
+        Record a successful backup.
+
+        Args:
+        - local_path (str): Source the scan was taken from.
+        - current (dict): scan_tree() result the backup was based on.
+        - snapshot (str): Name of the new snapshot directory.
+        - changed (list): Paths transferred by the backup. None means a full run,
+                          every path is marked as captured by snapshot.
+        - source_dir (str): Directory the paths are relative to, needed for hashing.
+        - hash_min_size (int): Hash the written regular files of at least this size for
+                               move detection, None to store no hashes.
+        """
+        def row(path):
+            size, mtime_ns, inode, mode = current[path]
+            digest = None
+            if hash_min_size is not None and source_dir is not None and stat_module.S_ISREG(mode) \
+                    and size >= hash_min_size:
+                digest = hash_file(os.path.join(source_dir, path))
+            return (path, size, mtime_ns, inode, mode, snapshot, digest)
+
+        with self.connection:
+            if changed is None:
+                self.connection.execute("DELETE FROM files")
+                rows = (row(path) for path in current)
+            else:
+                self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)")
+                self.connection.execute("DELETE FROM seen")
+                self.connection.executemany("INSERT INTO seen VALUES (?)", ((path,) for path in current))
+                self.connection.execute("DELETE FROM files WHERE path NOT IN (SELECT path FROM seen)")
+                rows = (row(path) for path in changed if path in current)
+            self.connection.executemany("INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, mode, snapshot, hash) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                        [("snapshot", snapshot), ("source", local_path)])
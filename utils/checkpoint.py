@@ -0,0 +1,71 @@
+# ============================================================
+#
+#  Easy backup
+#  Resumable Job Checkpoints
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import datetime
+import json
+import os
+
+# rsync keeps partially transferred files here (relative to the snapshot) so an
+# interrupted transfer continues them instead of starting the files over
+PARTIAL_DIR = ".rsync-partial"
+
+
+class Checkpoint:
+    """
+    Per-config record of the snapshot a backup is writing.
+
+    It is saved once the snapshot directory exists and cleared after "latest" points
+    to it. A checkpoint left by an interrupted run lets the next run continue into
+    the same snapshot instead of creating a new one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Return the saved checkpoint dict, None if there is none or it can not be read."""
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def resumable(self, local_path, remote_path, prev_backup):
+        """
+        Return the checkpoint of an interrupted run of the same job, None if it can not be resumed.
+
+        The snapshot was built on top of prev_backup (--link-dest, hard-link clone), so it
+        is only continued while "latest" still points there.
+        """
+        state = self.load()
+        if not state:
+            return None
+        if (state.get("local_path"), state.get("remote_path"), state.get("prev_backup")) != \
+                (local_path, remote_path, prev_backup or ""):
+            return None
+        return state
+
+    def save(self, local_path, remote_path, prev_backup, snapshot, new_backup):
+        if not self.path:
+            return
+        state = {"local_path": local_path, "remote_path": remote_path, "prev_backup": prev_backup or "",
+                 "snapshot": snapshot, "new_backup": new_backup,
+                 "started": datetime.datetime.now().isoformat(timespec="seconds")}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
@@ -10,11 +10,16 @@
 # ===========================================================
 
 import getpass
+import json
+import shlex
 from utils.credentials_management import load_backup_configs, save_backup_configs,\
      create_backup_config, BACKUP_FILE, delete_backup_config, \
-     check_if_backup_config_exist
-from utils.easybackup_core import run_incremental_backup
+     check_if_backup_config_exist, is_config_active, OPTIONAL_CONFIG_FIELDS, as_bool, as_int
+# The backup engine, retention, estimator and SSH modules are imported by the
+# functions using them, so listing or editing configs starts quickly
 from utils.logger import logger
+from utils.state import config_state_path, safe_config_name, STATE_DIR
+from pathlib import Path
 
 # TODO: Possible fix to avoid storing pass
 # create key for the program
@@ -47,11 +52,15 @@ def create_backup_config_cmd():
     ssh_key = None # Not used for now
     ssh_port = input("Enter the port for the ssh backup remote host [22]: \n") or 22
     keep_days = input("Enter the oldest age in days for your files before start deleting [Enter nothing for infinite]: \n") or None
+    parallel_shards = input("Enter the number of parallel rsync streams for large sources [Enter nothing for a single stream]: \n") or None
+    use_change_index = input("Keep a local change index to send only changed files? [y/N]: \n").strip().lower() in ("y", "yes")
     active = True
 
     cmd_creation_flag = create_backup_config(name, local_path, remote_path, ssh_user,
                                              ssh_password, remote_host, ssh_key, 
-                                             ssh_port, keep_days, active)
+                                             ssh_port, keep_days, active,
+                                             parallel_shards=parallel_shards,
+                                             use_change_index=use_change_index)
     if cmd_creation_flag:
         logger.debug("New config created sucessfully in cmd.")
     
@@ -102,7 +111,7 @@ def modify_backup_configs_cmd():
 
 
         if check_if_backup_config_exist(name_to_modify):    
-            config_to_be_modified = stored_backup_configs[name_to_modify]
+            config_to_be_modified = {**OPTIONAL_CONFIG_FIELDS, **stored_backup_configs[name_to_modify]}
             delete_backup_config(name_to_modify)  # Old config need to be removed 
             for sub_key, sub_value in config_to_be_modified.items():
                 if sub_key == "ssh_password": 
@@ -124,25 +133,390 @@ def modify_backup_configs_cmd():
 
 def run_backup(config_name):
     # Safe to use in non CMD functions 
+    # Returns the job exit code (see run_incremental_backup), None if the config does not exist
+    exit_code = None
     if check_if_backup_config_exist(config_name):
         stored_backup_configs = load_backup_configs(backup_file=BACKUP_FILE)        
-        logger.info(f"Starting backup using configuration named: {stored_backup_configs[config_name]['name']}")
-        config = stored_backup_configs[config_name]
-        run_incremental_backup(local_path=config["local_path"],
-                               remote_path=config["remote_path"],
-                               ssh_user=config["ssh_user"],
-                               ssh_password=config["ssh_password"],
-                               remote_host=config["remote_host"],
-                               ssh_port=config["ssh_port"],
-                               keep_days=config["keep_days"]) 
+        exit_code = run_backup_config(stored_backup_configs[config_name])
+    return exit_code
+
+
+def retention_rules(config):
+    # GFS rules of a configuration, None when it only uses keep_days (or nothing)
+    rules = {rule: as_int(config.get(rule)) for rule in ("keep_last", "keep_daily", "keep_weekly", "keep_monthly")}
+    rules = {rule: value for rule, value in rules.items() if value}
+    if not rules:
+        return None
+    rules["background"] = as_bool(config.get("prune_in_background", True))
+    return rules
+
+
+def phase_timeouts(config):
+    # "connect=60,transfer=14400" to {"connect": 60.0, "transfer": 14400.0}, None if not set
+    text = config.get("phase_timeouts")
+    if text in (None, "", "None"):
+        return None
+    timeouts = {}
+    for item in str(text).split(","):
+        phase, _, seconds = item.partition("=")
+        timeouts[phase.strip()] = float(seconds)
+    return timeouts
+
+
+def throughput_policy(config):
+    from utils.throughput import ThroughputPolicy
+    # Bandwidth windows and CPU/IO priorities of a configuration, None if it has none
+    fields = ("bandwidth_windows", "nice", "ionice_class", "ionice_level")
+    if all(config.get(field) in (None, "", "None") for field in fields):
+        return None
+    ionice_class = config.get("ionice_class")
+    return ThroughputPolicy(bandwidth_windows=config.get("bandwidth_windows"),
+                            nice=as_int(config.get("nice")),
+                            ionice_class=None if ionice_class in ("", "None") else ionice_class,
+                            ionice_level=as_int(config.get("ionice_level")),
+                            state_path=config_state_path(config["name"], "throughput.json"))
+
+
+def backup_kwargs(config):
+    # Map a stored configuration to run_incremental_backup arguments
+    index_path = None
+    if as_bool(config.get("use_change_index")):
+        index_path = config_state_path(config["name"], "change_index.sqlite")
+    prometheus_path = None
+    if config.get("prometheus_textfile_dir") not in (None, "", "None"):
+        prometheus_path = Path(config["prometheus_textfile_dir"]) / f"easybackup_{safe_config_name(config['name'])}.prom"
+    return {"local_path": config["local_path"],
+            "remote_path": config["remote_path"],
+            "ssh_user": config["ssh_user"],
+            "ssh_password": config["ssh_password"],
+            "remote_host": config["remote_host"],
+            "ssh_port": config["ssh_port"],
+            "keep_days": as_int(config["keep_days"]),
+            "parallel_shards": as_int(config.get("parallel_shards")),
+            "index_path": index_path,
+            "job_name": config["name"],
+            "metrics_path": config_state_path(config["name"], "metrics.jsonl"),
+            "prometheus_path": prometheus_path,
+            "retention": retention_rules(config),
+            "throughput": throughput_policy(config),
+            "fast_seed": as_bool(config.get("fast_seed")),
+            "seed_compression": config.get("seed_compression") or "zstd",
+            "seed_level": as_int(config.get("seed_level")),
+            "auto_compression": as_bool(config.get("auto_compression")),
+            "compression_cache": config_state_path(config["name"], "compression.json"),
+            "compression_reevaluate_days": as_int(config.get("compression_reevaluate_days")) or 7,
+            "detect_moves": as_bool(config.get("detect_moves")),
+            "move_hash_min_size": as_int(config.get("move_hash_min_size")),
+            "checkpoint_path": config_state_path(config["name"], "checkpoint.json"),
+            "size_split_threshold": as_int(config.get("size_split_threshold")),
+            "large_pass_state": config_state_path(config["name"], "large_pass.json"),
+            "phase_timeouts": phase_timeouts(config),
+            "manifest_dir": manifest_dir(config["name"]) if as_bool(config.get("write_manifests")) else None}
+
+
+def manifest_dir(config_name):
+    # Local manifests of a configuration, readable without decrypting the vault. Created by the first backup.
+    return STATE_DIR / safe_config_name(config_name) / "manifests"
+
+
+def destination_configs(config):
+    # The configuration itself, then one configuration per entry of its "destinations" list.
+    # An entry overrides the remote, credential and retention fields it sets and keeps its
+    # state (change index, checkpoint, metrics, manifests) under "<name>@<destination name>".
+    destinations = config.get("destinations")
+    if isinstance(destinations, str):
+        # Edited through the modify menu, the list comes back as JSON text
+        destinations = json.loads(destinations) if destinations.strip() not in ("", "None") else None
+    configs = [config]
+    for number, destination in enumerate(destinations or [], start=2):
+        label = destination.get("name") or destination.get("remote_host") or str(number)
+        configs.append({**config, **destination, "name": f"{config['name']}@{label}", "destinations": None})
+    return configs
+
+
+def run_backup_config(config, **overrides):
+    # Run an already loaded configuration, so callers running many jobs decrypt the vault only once
+    # overrides replace run_incremental_backup arguments of every destination (e.g. subtrees)
+    # Returns 0 if every destination succeeded, else the first failure, CONNECT_FAILURE_EXIT_CODE only
+    # when no destination failed for another reason
+    logger.info(f"Starting backup using configuration named: {config['name']}")
+    from utils.easybackup_core import run_incremental_backup, run_fanout_backup, CONNECT_FAILURE_EXIT_CODE
+    configs = destination_configs(config)
+    if len(configs) == 1:
+        return run_incremental_backup(**{**backup_kwargs(config), **overrides})
+
+    results = run_fanout_backup([{**backup_kwargs(destination), **overrides} for destination in configs])
+    exit_codes = []
+    for destination, result in zip(configs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Destination {destination['name']} ({destination['remote_host']}) crashed: {result}")
+            result = getattr(result, "returncode", 1)
+        else:
+            logger.info(f"Destination {destination['name']} ({destination['remote_host']}): "
+                        f"{'ok' if result == 0 else f'failed with exit code {result}'}")
+        exit_codes.append(result)
+    failed = [exit_code for exit_code in exit_codes if exit_code != 0]
+    return next((exit_code for exit_code in failed if exit_code != CONNECT_FAILURE_EXIT_CODE),
+                failed[0] if failed else 0)
+
+
+def probe_targets(configs):
+    # (remote_host, ssh_port, ssh_user, ssh_password) of every destination of configs, see host_probe
+    return [(destination["remote_host"], as_int(destination.get("ssh_port")) or 22, destination["ssh_user"],
+             destination["ssh_password"]) for config in configs for destination in destination_configs(config)]
+
+
+def probe_all_cmd():
+    # Probe every host of the vault at once, save the results for the runners and print them
+    # Returns True if every host answered and accepted its logins
+    from utils.host_probe import ReachabilityCache, format_probe_table, host_key
+    configs = list(load_backup_configs(backup_file=BACKUP_FILE).values())
+    targets = probe_targets(configs)
+    if not targets:
+        print("No backup configuration to probe.")
+        return True
+
+    names = {}
+    for config in configs:
+        for destination in destination_configs(config):
+            key = host_key(destination["remote_host"], as_int(destination.get("ssh_port")) or 22)
+            names.setdefault(key, []).append(destination["name"])
+    results = ReachabilityCache().refresh(targets, force=True)
+    print(f"\n{format_probe_table(results, names)}\n")
+    return all(result["tcp_ok"] and all(login["ok"] is not False for login in result["auth"].values())
+               for result in results.values())
+
+
+def estimate_config(config, all_configs):
+    # Estimate the next run of a configuration, with the throughput history of every config on the same host
+    from utils.estimator import estimate_backup
+    kwargs = backup_kwargs(config)
+    host_metrics_paths = [config_state_path(other["name"], "metrics.jsonl") for other in all_configs
+                          if other["remote_host"] == config["remote_host"]]
+    return estimate_backup(local_path=kwargs["local_path"], remote_path=kwargs["remote_path"],
+                           ssh_user=kwargs["ssh_user"], remote_host=kwargs["remote_host"],
+                           ssh_password=kwargs["ssh_password"], ssh_port=kwargs["ssh_port"],
+                           index_path=kwargs["index_path"], metrics_path=kwargs["metrics_path"],
+                           host_metrics_paths=host_metrics_paths,
+                           cache_path=config_state_path(config["name"], "estimate.json"))
+
+
+def estimate_backup_cmd(config_name):
+    # Print the expected transfer and duration of the next run of a configuration
+    if not check_if_backup_config_exist(config_name):
+        return
+    from utils.estimator import format_duration
+    stored_backup_configs = load_backup_configs(backup_file=BACKUP_FILE)
+    estimate = estimate_config(stored_backup_configs[config_name], list(stored_backup_configs.values()))
+
+    print(f"\nEstimate for {config_name} ({estimate['method']}, {estimate['estimated']}):")
+    print(f"  Files to transfer: {estimate['files']}")
+    print(f"  Bytes to transfer: {estimate['bytes']}")
+    if estimate["bytes_per_s"]:
+        print(f"  Host throughput:   {estimate['bytes_per_s'] / 1024 ** 2:.1f} MB/s, "
+              f"{estimate['files_per_s']:.0f} files/s")
+    print(f"  Expected duration: {format_duration(estimate['eta_seconds'])}")
+
+
+def prune_backups_cmd(config_name, dry_run=False):
+    # Apply the retention rules of a configuration without running a backup
+    if not check_if_backup_config_exist(config_name):
+        return
+    from utils.retention import apply_retention
+    from utils.ssh_session import SSHSession
+    config = load_backup_configs(backup_file=BACKUP_FILE)[config_name]
+    rules = retention_rules(config) or {}
+    keep_days = as_int(config["keep_days"])
+    if keep_days is None and not rules:
+        logger.info(f"Configuration {config_name} has no retention rule, nothing to prune.")
+        return
+
+    with SSHSession(remote_host=config["remote_host"], ssh_port=config["ssh_port"],
+                    ssh_user=config["ssh_user"], ssh_password=config["ssh_password"]) as session:
+        success, message = session.open()
+        if not success:
+            logger.info(f"SSH connection unsucesfull: {message}")
+            return
+        latest = session.check_output(f"readlink {shlex.quote(config['remote_path'] + '/latest')}")
+        kept, deleted = apply_retention(session, config["remote_path"], protected=[latest], dry_run=dry_run,
+                                        keep_days=keep_days, **rules)
+    if not dry_run:
+        from utils.manifest import remove_manifests
+        remove_manifests(manifest_dir(config_name), deleted)
+
+    print(f"\nKeeping {len(kept)} snapshot(s):")
+    for name in kept:
+        print(f"  {name}")
+    print(f"{'Would delete' if dry_run else 'Deleted'} {len(deleted)} snapshot(s):")
+    for name in deleted:
+        print(f"  {name}")
+
+
+def verify_backup_cmd(config_name, sample=None, snapshot=None, algorithm="sha256", workers=None):
+    # Hash a snapshot (latest by default) and the local source, report mismatches and keep a history
+    # Returns True if every verified file matched, False otherwise, None if nothing was verified
+    if not check_if_backup_config_exist(config_name):
+        return None
+    from utils.ssh_session import SSHSession
+    from utils.verify import verify_snapshot
+    config = load_backup_configs(backup_file=BACKUP_FILE)[config_name]
+    state_path = config_state_path(config_name, "verify.json")
+    state = {}
+    if state_path.exists():
+        with open(state_path) as f:
+            state = json.load(f)
+
+    with SSHSession(remote_host=config["remote_host"], ssh_port=config["ssh_port"],
+                    ssh_user=config["ssh_user"], ssh_password=config["ssh_password"]) as session:
+        success, message = session.open()
+        if not success:
+            logger.info(f"SSH connection unsucesfull: {message}")
+            return None
+        if snapshot:
+            snapshot_dir = f"{config['remote_path']}/{snapshot}"
+        else:
+            snapshot_dir = session.check_output(f"readlink {shlex.quote(config['remote_path'] + '/latest')}")
+            if not snapshot_dir:
+                logger.info(f"Configuration {config_name} has no snapshot to verify.")
+                return None
+        result = verify_snapshot(session, config["local_path"], snapshot_dir, algorithm=algorithm, sample=sample,
+                                 cursor=state.get("cursor"), workers=workers)
+
+    if result["mode"] == "sample":
+        with open(state_path, "w") as f:
+            json.dump({"cursor": result["cursor"]}, f)
+    with open(config_state_path(config_name, "verify.jsonl"), "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+    print(f"\nVerification of {config_name} snapshot {result['snapshot']} ({result['mode']}, {result['algorithm']}):")
+    print(f"  Files verified:  {result['verified']} of {result['candidates']} ({format_size(result['bytes'])}), "
+          f"{result['skipped_changed']} changed since the snapshot skipped")
+    print(f"  Throughput:      {result['bytes'] / max(result['wall_time'], 1e-9) / 1024 ** 2:.1f} MB/s "
+          f"(local {result['local_seconds']:.1f}s, remote {result['remote_seconds']:.1f}s, "
+          f"total {result['wall_time']:.1f}s)")
+    for label in ("mismatched", "missing", "unreadable"):
+        print(f"  {label.capitalize() + ':':16} {len(result[label])}")
+        for path in result[label][:50]:
+            print(f"    {path}")
+        if len(result[label]) > 50:
+            print(f"    ... {len(result[label]) - 50} more in verify.jsonl")
+    return not result["mismatched"] and not result["missing"]
+
+
+def restore_backup_cmd(config_name, target_dir, snapshot=None, patterns=None, streams=4):
+    # Restore a snapshot (latest by default), or the paths matching patterns, into target_dir
+    # Returns the rsync exit code, None if the config, the host or the snapshot is not available
+    if not check_if_backup_config_exist(config_name):
+        return None
+    from utils.restore import restore_snapshot
+    from utils.ssh_session import SSHSession
+    config = load_backup_configs(backup_file=BACKUP_FILE)[config_name]
+
+    with SSHSession(remote_host=config["remote_host"], ssh_port=config["ssh_port"],
+                    ssh_user=config["ssh_user"], ssh_password=config["ssh_password"]) as session:
+        success, message = session.open()
+        if not success:
+            logger.info(f"SSH connection unsucesfull: {message}")
+            return None
+        if snapshot in (None, "latest"):
+            snapshot_dir = session.check_output(f"readlink {shlex.quote(config['remote_path'] + '/latest')}")
+        else:
+            snapshot_dir = f"{config['remote_path']}/{snapshot}"
+        if not snapshot_dir:
+            logger.info(f"Configuration {config_name} has no snapshot to restore.")
+            return None
+        return restore_snapshot(session, snapshot_dir, target_dir, patterns=patterns, streams=max(1, streams),
+                                manifest_dir=manifest_dir(config_name),
+                                state_path=config_state_path(config_name, "restore.json"))
+
+
+def format_size(size):
+    # 1536 -> "1.5 KB"
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def resolve_manifest(config_name, snapshot=None, before=None):
+    # Local manifest of a snapshot: a dated name, "latest", or with None the newest one (older than before if given)
+    from utils.manifest import list_manifests, manifest_path
+    folder = manifest_dir(config_name)
+    snapshots = list_manifests(folder)
+    if snapshot is None and before is not None:
+        snapshots = [name for name in snapshots if name < before]
+    if snapshot in (None, "latest"):
+        if not snapshots:
+            logger.info(f"No earlier snapshot manifest for configuration {config_name}.")
+            return None, None
+        snapshot = snapshots[-1]
+    elif snapshot not in snapshots:
+        logger.info(f"No manifest of snapshot {snapshot} for configuration {config_name}.")
+        return None, None
+    return snapshot, manifest_path(folder, snapshot)
+
+
+def manifest_list_cmd(config_name):
+    # Print the snapshots that have a manifest and their size, from the manifest indexes only
+    from utils.manifest import list_manifests, manifest_path, read_index
+    folder = manifest_dir(config_name)
+    snapshots = list_manifests(folder)
+    if not snapshots:
+        logger.info(f"No snapshot manifest for configuration {config_name} (enable them with write_manifests).")
+        return
+    print(f"\nSnapshot manifests of {config_name}:")
+    for snapshot in snapshots:
+        index = read_index(manifest_path(folder, snapshot))
+        print(f"  {snapshot}  {index['entries']:>10} entries  {index['files']:>10} files  "
+              f"{format_size(index['bytes']):>10}")
+
+
+def manifest_diff_cmd(config_name, old=None, new=None):
+    # Print the changes between two snapshots (the two newest by default) from their manifests
+    from utils.manifest import diff_manifests
+    new, new_path = resolve_manifest(config_name, new)
+    if new_path is None:
+        return
+    old, old_path = resolve_manifest(config_name, old, before=new)
+    if old_path is None:
+        return
+    counts = {"added": 0, "deleted": 0, "modified": 0}
+    size_change = 0
+    for change, before, after in diff_manifests(old_path, new_path):
+        counts[change] += 1
+        size_change += (after.size if after else 0) - (before.size if before else 0)
+        if change == "added":
+            print(f"+ {after.path}")
+        elif change == "deleted":
+            print(f"- {before.path}")
+        else:
+            print(f"M {after.path} ({before.size} -> {after.size} bytes)")
+    print(f"\n{old} -> {new}: {counts['added']} added, {counts['deleted']} deleted, "
+          f"{counts['modified']} modified, {'+' if size_change >= 0 else '-'}{format_size(abs(size_change))}")
+
+
+def manifest_find_cmd(config_name, path):
+    # Print the snapshots holding a path, reading one block of each manifest
+    import datetime
+    from utils.manifest import list_manifests, lookup, manifest_path
+    folder = manifest_dir(config_name)
+    found = 0
+    for snapshot in list_manifests(folder):
+        entry = lookup(manifest_path(folder, snapshot), path)
+        if entry is not None:
+            found += 1
+            modified = datetime.datetime.fromtimestamp(entry.mtime).isoformat(sep=" ")
+            print(f"  {snapshot}  {entry.size:>14} bytes  modified {modified}  mode {entry.mode:o}")
+    print(f"{path}: found in {found} snapshot(s)")
 
 
 def run_all_active_backups():
     # Safe to use in non CMD functions 
     stored_backup_configs = load_backup_configs(backup_file=BACKUP_FILE)   
 
-    for backup_config in stored_backup_configs:
-        if backup_config["active"]:
+    for backup_config in stored_backup_configs.values():
+        if is_config_active(backup_config):
             run_backup(config_name=backup_config["name"])
     
 
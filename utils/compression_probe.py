@@ -0,0 +1,227 @@
+# ============================================================
+#
+#  Easy backup
+#  Adaptive Compression Selection
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import datetime
+import functools
+import json
+import os
+import random
+import re
+import subprocess
+import zlib
+from utils.state import STATE_DIR
+from utils.logger import logger  # Import the shared logger
+
+# Extensions of data that is already compressed, never worth compressing again
+INCOMPRESSIBLE_EXTENSIONS = {
+    "7z", "avi", "bz2", "deb", "flac", "gif", "gz", "heic", "iso", "jpeg", "jpg", "lz4", "lzma", "lzo",
+    "m4a", "m4v", "mkv", "mov", "mp3", "mp4", "ogg", "opus", "png", "qcow2", "rar", "rpm", "squashfs",
+    "tbz", "tgz", "txz", "webm", "webp", "xz", "zip", "zst",
+}
+
+SAMPLE_FILES = 200  # Files trial-compressed per evaluation
+SCAN_LIMIT = 20000  # Files looked at while sampling, so huge trees are not walked completely
+BLOCK_SIZE = 64 * 1024  # Size of each trial block
+BLOCKS_PER_FILE = 3  # Blocks read from the start, middle and end of each sampled file
+
+SKIP_RATIO = 0.95  # Extensions compressing worse than this go to --skip-compress
+DISABLE_RATIO = 0.90  # Above this overall ratio compression is not enabled at all
+ZSTD_RATIO = 0.50  # Below this ratio the data is worth zstd, above it the cheaper lz4
+
+# rsync version of every remote host, "host:port" -> {"version": [3, 2], "checked": iso time}
+RSYNC_VERSIONS_FILE = STATE_DIR / "rsync_versions.json"
+RSYNC_VERSION_MAX_AGE = datetime.timedelta(days=1)
+COMPRESS_CHOICE_VERSION = (3, 2)  # rsync 3.2 added --compress-choice (zstd, lz4)
+
+
+def sample_files(local_path, count=SAMPLE_FILES, scan_limit=SCAN_LIMIT, seed=None):
+    """
+    Reservoir-sample regular files of a tree, looking at most at scan_limit files.
+
+    Returns:
+    - list: (path, size) tuples.
+    """
+    rng = random.Random(seed)
+    sample = []
+    seen = 0
+    for folder, _, filenames in os.walk(local_path):
+        for filename in filenames:
+            path = os.path.join(folder, filename)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            if not os.path.isfile(path) or os.path.islink(path) or stat.st_size == 0:
+                continue
+            seen += 1
+            if len(sample) < count:
+                sample.append((path, stat.st_size))
+            else:
+                slot = rng.randrange(seen)
+                if slot < count:
+                    sample[slot] = (path, stat.st_size)
+            if seen >= scan_limit:
+                return sample
+    return sample
+
+
+def extension_of(path):
+    name = os.path.basename(path).lower()
+    return name.rsplit(".", 1)[1] if "." in name[1:] else ""
+
+
+def trial_ratio(path, size):
+    """
+    Compress a few blocks of a file with fast zlib and return compressed/original size.
+    """
+    offsets = sorted({0, max(0, size // 2 - BLOCK_SIZE // 2), max(0, size - BLOCK_SIZE)})[:BLOCKS_PER_FILE]
+    original = compressed = 0
+    try:
+        with open(path, "rb") as f:
+            for offset in offsets:
+                f.seek(offset)
+                block = f.read(BLOCK_SIZE)
+                original += len(block)
+                compressed += len(zlib.compress(block, 1))
+    except OSError:
+        return None
+    return compressed / original if original else None
+
+
+def evaluate_compression(local_path):
+    """
+    Sample local_path and decide how rsync should compress it.
+
+    Returns:
+    - dict: enabled, algorithm, level, skip_compress (extensions), sample_ratio
+            (size weighted expected ratio of the data that is compressed), evaluated (iso time).
+    """
+    by_extension = {}
+    for path, size in sample_files(local_path):
+        extension = extension_of(path)
+        if extension in INCOMPRESSIBLE_EXTENSIONS:
+            continue
+        ratio = trial_ratio(path, size)
+        if ratio is None:
+            continue
+        weight, weighted_ratio = by_extension.get(extension, (0, 0.0))
+        by_extension[extension] = (weight + size, weighted_ratio + ratio * size)
+
+    ratios = {extension: weighted_ratio / weight for extension, (weight, weighted_ratio) in by_extension.items()}
+    skip = sorted(INCOMPRESSIBLE_EXTENSIONS | {extension for extension, ratio in ratios.items()
+                                               if ratio > SKIP_RATIO and extension})
+
+    kept = [(by_extension[extension][0], ratio) for extension, ratio in ratios.items() if ratio <= SKIP_RATIO]
+    total = sum(weight for weight, _ in kept)
+    sample_ratio = sum(weight * ratio for weight, ratio in kept) / total if total else 1.0
+
+    decision = {"enabled": sample_ratio <= DISABLE_RATIO,
+                "algorithm": "zstd" if sample_ratio < ZSTD_RATIO else "lz4",
+                "level": 3 if sample_ratio < ZSTD_RATIO else None,
+                "skip_compress": skip,
+                "sample_ratio": sample_ratio,
+                "evaluated": datetime.datetime.now().isoformat(timespec="seconds")}
+    return decision
+
+
+def choose_compression(local_path, cache_path=None, reevaluate_days=7):
+    """
+    Return the cached compression decision of a config, re-evaluating it when it is too old.
+    """
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            decision = json.load(f)
+        age = datetime.datetime.now() - datetime.datetime.fromisoformat(decision["evaluated"])
+        if age < datetime.timedelta(days=reevaluate_days):
+            return decision
+
+    decision = evaluate_compression(local_path)
+    if cache_path:
+        with open(cache_path, "w") as f:
+            json.dump(decision, f)
+    return decision
+
+
+def parse_rsync_version(text):
+    """(major, minor) from "rsync --version" output, None if it can not be read."""
+    match = re.search(r"version (\d+)\.(\d+)", text or "")
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+@functools.lru_cache(maxsize=None)
+def rsync_supports_compress_choice():
+    """True if the local rsync has --compress-choice. Asked once per process, jobs run inside the event loop."""
+    try:
+        version = subprocess.run(["rsync", "--version"], stdout=subprocess.PIPE, text=True).stdout
+    except OSError:
+        return False
+    return (parse_rsync_version(version) or (0, 0)) >= COMPRESS_CHOICE_VERSION
+
+
+async def remote_rsync_version(session, cache_path=RSYNC_VERSIONS_FILE):
+    """
+    Return the (major, minor) rsync version of the session's host, None if unknown.
+
+    The answer is cached per host and port for RSYNC_VERSION_MAX_AGE, so most runs
+    do not ask again.
+    """
+    key = f"{session.remote_host}:{session.ssh_port}"
+    try:
+        with open(cache_path) as f:
+            versions = json.load(f)
+    except (OSError, ValueError):
+        versions = {}
+    cached = versions.get(key)
+    if cached and datetime.datetime.now() - datetime.datetime.fromisoformat(cached["checked"]) < RSYNC_VERSION_MAX_AGE:
+        return tuple(cached["version"]) if cached["version"] else None
+
+    version = parse_rsync_version(await session.check_output_async("rsync --version"))
+    versions[key] = {"version": list(version) if version else None,
+                     "checked": datetime.datetime.now().isoformat(timespec="seconds")}
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(versions, f)
+    os.replace(tmp_path, cache_path)
+    return version
+
+
+def compression_rsync_args(decision, remote_version=None):
+    """
+    Translate a compression decision into rsync options.
+
+    The algorithm and level are only chosen when both rsyncs have --compress-choice
+    (remote_version, see remote_rsync_version), an older remote would abort the
+    negotiation. Otherwise plain -z is used.
+    """
+    if not decision or not decision["enabled"]:
+        return []
+    args = ["-z", "--skip-compress=" + "/".join(decision["skip_compress"])]
+    if (remote_version or (0, 0)) >= COMPRESS_CHOICE_VERSION and rsync_supports_compress_choice():
+        args.append(f"--compress-choice={decision['algorithm']}")
+        if decision["level"] is not None:
+            args.append(f"--compress-level={decision['level']}")
+    return args
+
+
+def log_achieved_ratio(decision, rsync_stats):
+    """
+    Log the chosen settings and the ratio achieved on the wire (bytes sent / literal data).
+    """
+    if not decision or not decision["enabled"]:
+        logger.info(f"Compression disabled (sampled ratio {decision['sample_ratio']:.2f})" if decision else
+                    "Compression disabled")
+        return
+    literal = rsync_stats.get("literal_data")
+    achieved = rsync_stats.get("total_bytes_sent", 0) / literal if literal else None
+    logger.info(f"Compression {decision['algorithm']} level {decision['level']}, "
+                f"{len(decision['skip_compress'])} skipped extensions, sampled ratio {decision['sample_ratio']:.2f}, "
+                f"achieved ratio {f'{achieved:.2f}' if achieved is not None else 'n/a'}")
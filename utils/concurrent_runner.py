@@ -0,0 +1,264 @@
+# ============================================================
+#
+#  Easy backup
+#  Concurrent Backup Runner
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import heapq
+import itertools
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.credentials_management import load_backup_configs, BACKUP_FILE, is_config_active
+from utils.cmd_credentials_management import run_backup_config, estimate_config, probe_targets
+from utils.easybackup_core import CONNECT_FAILURE_EXIT_CODE
+from utils.estimator import format_duration
+from utils.host_probe import ReachabilityCache, DEFAULT_TTL
+from utils.logger import logger  # Import the shared logger
+
+
+def local_disk_id(local_path):
+    """
+    Identify the device holding a local source path, so jobs reading the same disk can be limited.
+
+    Args:
+    - local_path (str): Local source directory.
+
+    Returns:
+    - int or str: The st_dev of the path, or the path itself if it can not be stat'ed.
+    """
+    try:
+        return os.stat(local_path).st_dev
+    except OSError:
+        return local_path
+
+
+def config_hosts(config):
+    """Remote hosts of every destination of a configuration, a job takes a per-host slot on each of them."""
+    return sorted({host for host, _, _, _ in probe_targets([config])})
+
+
+def _run_job(config):
+    """Run one backup job and return its result record."""
+    start = time.monotonic()
+    try:
+        exit_code = run_backup_config(config)
+        error = None
+    except Exception as e:
+        exit_code = getattr(e, "returncode", 1)
+        error = str(e)
+        logger.error(f"Backup {config['name']} failed: {error}")
+
+    return {"name": config["name"],
+            "remote_host": config["remote_host"],
+            "status": "ok" if exit_code == 0 else "failed",
+            "exit_code": exit_code,
+            "wall_time": time.monotonic() - start,
+            "error": error}
+
+
+def config_down(config, cache):
+    """True if the cache knows every destination host of a configuration is down."""
+    return all(cache.is_down(host, port) for host, port, _, _ in probe_targets([config]))
+
+
+def split_reachable(configs, ttl=DEFAULT_TTL):
+    """
+    Probe at once the hosts of configs without a fresh probe result, and set aside the
+    configurations whose hosts are all known to be down.
+
+    Returns:
+    - list: Configurations to run.
+    - list: Result records (status "skipped") of the configurations left out.
+    """
+    cache = ReachabilityCache(ttl=ttl)
+    cache.refresh(probe_targets(configs))
+    runnable, skipped = [], []
+    for config in configs:
+        if not config_down(config, cache):
+            runnable.append(config)
+            continue
+        logger.warning(f"Skipping backup {config['name']}: {config['remote_host']} is unreachable")
+        skipped.append({"name": config["name"], "remote_host": config["remote_host"], "status": "skipped",
+                        "exit_code": CONNECT_FAILURE_EXIT_CODE, "wall_time": 0.0, "error": "host unreachable"})
+    return runnable, skipped
+
+
+def run_backups_concurrently(configs, max_workers=4, per_host_limit=1, per_disk_limit=1):
+    """
+    Run several backup configurations at the same time on a thread pool.
+
+    A job is only started when a global worker slot, a slot for each of its destination
+    hosts (see config_hosts) and a slot for its local source disk are all free, so one slow host no longer blocks the
+    others while a single NAS or source spindle is never overloaded.
+
+    Args:
+    - configs (list): Backup configuration dicts as stored in the vault.
+    - max_workers (int): Global cap of jobs running at once.
+    - per_host_limit (int): Cap of jobs running at once against the same remote host.
+    - per_disk_limit (int): Cap of jobs running at once reading from the same local disk.
+
+    Returns:
+    - list: One result dict per job (name, remote_host, status, exit_code, wall_time, error),
+            in the order of configs.
+    """
+    pending = list(configs)
+    results = {}
+    running = {}
+    host_slots = Counter()
+    disk_slots = Counter()
+    disk_ids = {config["name"]: local_disk_id(config["local_path"]) for config in pending}
+    hosts = {config["name"]: config_hosts(config) for config in pending}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Start every pending job whose host and disk still have free slots
+            for config in list(pending):
+                if len(running) >= max_workers:
+                    break
+                disk = disk_ids[config["name"]]
+                if any(host_slots[host] >= per_host_limit for host in hosts[config["name"]]) \
+                        or disk_slots[disk] >= per_disk_limit:
+                    continue
+                host_slots.update(hosts[config["name"]])
+                disk_slots[disk] += 1
+                pending.remove(config)
+                logger.info(f"Scheduling backup {config['name']} ({len(running) + 1}/{max_workers} workers busy)")
+                running[executor.submit(_run_job, config)] = config
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                config = running.pop(future)
+                host_slots.subtract(hosts[config["name"]])
+                disk_slots[disk_ids[config["name"]]] -= 1
+                results[config["name"]] = future.result()
+
+    return [results[config["name"]] for config in configs]
+
+
+def preflight_estimates(configs, all_configs, max_workers=4):
+    """
+    Estimate every job before the run, in parallel.
+
+    Returns:
+    - dict: config name -> estimated seconds, None when unknown (no history or the estimate failed).
+    """
+    def estimate(config):
+        try:
+            return estimate_config(config, all_configs)["eta_seconds"]
+        except Exception as e:
+            logger.error(f"Pre-flight estimate of {config['name']} failed: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        etas = dict(zip((config["name"] for config in configs), executor.map(estimate, configs)))
+    for name, eta in etas.items():
+        logger.info(f"Pre-flight estimate of {name}: {format_duration(eta)}")
+    return etas
+
+
+def predict_makespan(configs, etas, max_workers=4, per_host_limit=1, per_disk_limit=1):
+    """
+    Replay the scheduling of run_backups_concurrently with the estimated durations.
+
+    Jobs with an unknown estimate count as instantaneous, so the result is a lower bound then.
+
+    Returns:
+    - float: Expected seconds until the last job finishes.
+    """
+    pending = list(configs)
+    running = []
+    host_slots = Counter()
+    disk_slots = Counter()
+    disk_ids = {config["name"]: local_disk_id(config["local_path"]) for config in pending}
+    hosts = {config["name"]: config_hosts(config) for config in pending}
+    order = itertools.count()  # Tie breaker, configs are not comparable
+    now = 0.0
+    while pending or running:
+        for config in list(pending):
+            if len(running) >= max_workers:
+                break
+            disk = disk_ids[config["name"]]
+            if any(host_slots[host] >= per_host_limit for host in hosts[config["name"]]) \
+                    or disk_slots[disk] >= per_disk_limit:
+                continue
+            host_slots.update(hosts[config["name"]])
+            disk_slots[disk] += 1
+            pending.remove(config)
+            heapq.heappush(running, (now + (etas.get(config["name"]) or 0), next(order), config))
+
+        now, _, config = heapq.heappop(running)
+        host_slots.subtract(hosts[config["name"]])
+        disk_slots[disk_ids[config["name"]]] -= 1
+    return now
+
+
+def format_summary_table(results):
+    """
+    Render the end-of-run summary of run_backups_concurrently as a text table.
+    """
+    headers = ["Backup", "Host", "Status", "Exit code", "Wall time (s)"]
+    rows = [[r["name"], str(r["remote_host"]), r["status"], str(r["exit_code"]), f"{r['wall_time']:.1f}"]
+            for r in results]
+    widths = [max(len(row[i]) for row in [headers] + rows) for i in range(len(headers))]
+
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(headers, widths)),
+             "  ".join("-" * width for width in widths)]
+    for row in rows:
+        lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+    return "\n".join(lines)
+
+
+def run_all_active_backups_concurrently(max_workers=4, per_host_limit=1, per_disk_limit=1, preflight=True,
+                                        window_hours=None, probe_ttl=DEFAULT_TTL):
+    """
+    Run every active configuration of the vault concurrently and print the summary table.
+
+    The remote hosts are probed first, all at once (see host_probe), and configurations
+    whose hosts are down are reported as skipped instead of each waiting for its own
+    connection timeout. Probe results younger than probe_ttl seconds are reused, 0 (or
+    None) turns the probing off.
+
+    With preflight, every job is estimated first (see estimator.estimate_backup) and the
+    jobs are started longest first, so a long job does not start last and stretch the run.
+    The expected duration of the whole run is logged and compared with window_hours.
+
+    Returns:
+    - bool: True if every job succeeded.
+    """
+    stored_backup_configs = load_backup_configs(backup_file=BACKUP_FILE)
+    configs = [config for config in stored_backup_configs.values() if is_config_active(config)]
+    if not configs:
+        logger.info("No active backup configuration to run.")
+        return True
+
+    skipped = []
+    if probe_ttl:
+        configs, skipped = split_reachable(configs, ttl=probe_ttl)
+
+    if preflight and configs:
+        etas = preflight_estimates(configs, list(stored_backup_configs.values()), max_workers=max_workers)
+        # Unknown estimates first, they may well be the longest
+        configs.sort(key=lambda config: -(etas[config["name"]] if etas[config["name"]] is not None else float("inf")))
+        makespan = predict_makespan(configs, etas, max_workers=max_workers, per_host_limit=per_host_limit,
+                                    per_disk_limit=per_disk_limit)
+        logger.info(f"Expected duration of the run: {format_duration(makespan)}"
+                    + (" (some jobs have no estimate)" if None in etas.values() else ""))
+        if window_hours is not None and makespan > window_hours * 3600:
+            logger.warning(f"The run is not expected to fit the {window_hours} h backup window "
+                           f"({format_duration(makespan)})")
+
+    results = run_backups_concurrently(configs, max_workers=max_workers,
+                                       per_host_limit=per_host_limit, per_disk_limit=per_disk_limit) + skipped
+
+    summary = format_summary_table(results)
+    print(f"\n{summary}\n")
+    logger.info(f"Concurrent run summary:\n{summary}")
+
+    return all(result["status"] == "ok" for result in results)
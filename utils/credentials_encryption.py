@@ -12,11 +12,11 @@
 import json
 import os
 import base64
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
-from cryptography.hazmat.backends import default_backend
 import random
 
+# cryptography is imported by encrypt_json/decrypt_json only, commands that never
+# open the vault (--help, scheduler reloads without changes) do not load it
+
 
 def generate_key():
     """Generate a 32-byte (256-bit) AES key and return it in base64 format."""
@@ -44,6 +44,10 @@ def encrypt_json(data, key):
     - encrypted_data (str): Encrypted JSON as a base64-encoded string.
     - iv (str): Base64-encoded Initialization Vector.
     """
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.backends import default_backend
+
     key = base64.urlsafe_b64decode(key)  # Decode the key from base64
     iv = os.urandom(16)  # Generate a random IV (Initialization Vector)
 
@@ -75,6 +79,10 @@ def decrypt_json(encrypted_data, iv, key):
     Returns:
     - dict: Decrypted JSON data.
     """
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.backends import default_backend
+
     key = base64.urlsafe_b64decode(key)
     iv = base64.b64decode(iv)
     encrypted_data = base64.b64decode(encrypted_data)
@@ -11,6 +11,7 @@
 
 from utils.credentials_encryption import load_encrypted_json, save_encrypted_json,\
      generate_key
+import functools
 import os
 from utils.logger import logger
 from pathlib import Path
@@ -25,9 +26,51 @@ from pathlib import Path
 # ssh -i ~/.ssh/backup_key -p <ssh_port> <user>@<remote_host>
 
 
-ENCRIPTION_KEY = generate_key()
+@functools.lru_cache(maxsize=None)
+def encryption_key():
+    # Derived on first use instead of at import time, only vault reads and writes need it
+    return generate_key()
+
+
+def __getattr__(name):
+    # ENCRIPTION_KEY is still available as a module attribute
+    if name == "ENCRIPTION_KEY":
+        return encryption_key()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 BACKUP_FILE = Path.home() / ".easybackup_configs.enc"
 
+# Optional per-config settings and their defaults. Configs stored before a setting
+# existed are read with these defaults and the modify menu offers them as well.
+OPTIONAL_CONFIG_FIELDS = {
+    "parallel_shards": None,  # Number of rsync workers splitting local_path, None for a single stream
+    "use_change_index": False,  # Keep a local change index and only send changed paths
+    "keep_last": None,  # Retention: always keep the N newest snapshots
+    "keep_daily": None,  # Retention: newest snapshot of each of the N last days
+    "keep_weekly": None,  # Retention: newest snapshot of each of the N last weeks
+    "keep_monthly": None,  # Retention: newest snapshot of each of the N last months
+    "prune_in_background": True,  # Do not wait for old snapshots to be deleted
+    "bandwidth_windows": None,  # e.g. "08:00-18:00=2000,18:00-08:00=0" in KB/s, "NN%" of the learned link capacity
+    "nice": None,  # CPU priority of the local rsync
+    "ionice_class": None,  # IO priority class of the local rsync: idle, best-effort or realtime
+    "ionice_level": None,  # IO priority level 0-7 within the class
+    "fast_seed": False,  # Seed the first snapshot with a tar stream instead of rsync
+    "seed_compression": "zstd",  # Compression of the seed stream: zstd, lz4 or none
+    "seed_level": None,  # Compression level of the seed stream
+    "auto_compression": False,  # Pick rsync compression from sampled data compressibility
+    "compression_reevaluate_days": 7,  # Age of the cached compression decision before sampling again
+    "detect_moves": False,  # Hard-link moved and renamed files instead of sending them again (needs use_change_index)
+    "move_hash_min_size": None,  # Also match moved files of at least this many bytes by content hash
+    "size_split_threshold": None,  # Send files of at least this many bytes in a separate large file pass
+    "schedule": None,  # Scheduler daemon: interval ("6h", "1d") or cron expression ("0 2 * * *")
+    "schedule_jitter": None,  # Maximum random delay in seconds of scheduled runs, the daemon default if None
+    "destinations": None,  # More destinations of the same source, e.g. [{"name": "nas2", "remote_host": ..., "remote_path": ...}]
+    "write_manifests": False,  # Write a manifest of every snapshot, locally and next to the snapshots
+    "phase_timeouts": None,  # Seconds allowed per job phase, e.g. "connect=60,transfer=14400"
+    "prometheus_textfile_dir": None,  # node_exporter textfile collector folder for the job metrics
+}
+
 def check_if_backup_config_exist(config_name):
     stored_backup_configs = load_backup_configs(backup_file=BACKUP_FILE)
     if config_name in stored_backup_configs:
@@ -37,8 +80,23 @@ def check_if_backup_config_exist(config_name):
         logger.info(f"Configuration {config_name} do not exist.")
     return flag
 
+def as_bool(value):
+    # Flags are stored as bools on creation but as text once edited through the modify menu
+    if isinstance(value, str):
+        return value.strip().lower() not in ("false", "0", "no", "n", "none", "")
+    return bool(value)
+
+def as_int(value):
+    # Numeric settings edited through the modify menu come back as text, "None" included
+    if value is None or (isinstance(value, str) and value.strip().lower() in ("", "none")):
+        return None
+    return int(value)
+
+def is_config_active(config):
+    return as_bool(config.get("active", True))
+
 def create_backup_config(name, local_path, remote_path, ssh_user, ssh_password, 
-                         remote_host, ssh_key, ssh_port, keep_days, active):
+                         remote_host, ssh_key, ssh_port, keep_days, active, **options):
 
     new_config = {"name": name,
                   "local_path": local_path,
@@ -50,6 +108,8 @@ def create_backup_config(name, local_path, remote_path, ssh_user, ssh_password,
                   "ssh_port": ssh_port,
                   "keep_days": keep_days,
                   "active": active}
+    for field, default in OPTIONAL_CONFIG_FIELDS.items():
+        new_config[field] = options.get(field, default)
     stored_backup_configs = load_backup_configs(backup_file=BACKUP_FILE)
     # Using remote host as name in case that no name has been provided
     if new_config["name"] == "":
@@ -66,8 +126,8 @@ def load_backup_configs(backup_file="./easybackup_configs.enc"):
     logger.debug("Loading stored backup configurations.")
     stored_backup_configs = {}
     if os.path.exists(backup_file):
-        logger.debug(f"Stored backup configurations exist on {str(Path(backup_file).resolve())}")
-        stored_backup_configs = load_encrypted_json(file_path=backup_file, key=ENCRIPTION_KEY)
+        logger.debug("Stored backup configurations exist on %s", Path(backup_file).resolve())
+        stored_backup_configs = load_encrypted_json(file_path=backup_file, key=encryption_key())
         logger.debug("Stored backup configurations loaded successfully.")
     else:
         logger.debug("Stored backup configurations do not exist.")
@@ -77,7 +137,7 @@ def load_backup_configs(backup_file="./easybackup_configs.enc"):
 
 def save_backup_configs(backups_configs, backup_file="./easybackup_configs.enc"):
     try:
-        save_encrypted_json(file_path=backup_file, data=backups_configs, key=ENCRIPTION_KEY)
+        save_encrypted_json(file_path=backup_file, data=backups_configs, key=encryption_key())
         logger.debug("Backup configurations stored sucessfully.")
         flag = True
     except:
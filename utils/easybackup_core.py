@@ -10,54 +10,47 @@
 # ===========================================================
 
 
+import asyncio
 import subprocess
+import contextlib
 import datetime
-import re
+import json
+import logging
+import os
+import stat as stat_module
+import shlex
+import time
+from collections import deque
 from utils.logger import logger  # Import the shared logger
+from utils.ssh_session import SSHSession
+from utils.async_process import run_process
+from utils.rsync_progress import stream_rsync_async, parse_record, FileEvent, ItemEvent, ProgressEvent, StatsEvent
+from utils.job_metrics import JobMetrics
+from utils.retention import apply_retention_async, delete_snapshots_cmd
+from utils.checkpoint import Checkpoint, PARTIAL_DIR
+from utils.seed_stream import seed_snapshot
+from utils.compression_probe import choose_compression, compression_rsync_args, log_achieved_ratio, \
+    remote_rsync_version
+from utils.rsync_shards import (plan_shards, split_source, write_files_from, files_from_args, root_attributes_cmd,
+                                delete_extraneous_cmd)
+from utils.change_index import ChangeIndex, scan_tree, collapse_nested
+from utils.manifest import (ITEMIZE_ARGS, REMOTE_MANIFEST_DIR, ManifestCollector, build_manifest, entries_from_tree,
+                            manifest_path, read_manifest, remove_manifests, rsync_name, write_manifest)
 
+# The SSH connection of the job could not be opened (EX_TEMPFAIL of sysexits.h). Distinct
+# from rsync's 255, which also means the link dropped in the middle of a transfer
+CONNECT_FAILURE_EXIT_CODE = 75
+TIMEOUT_EXIT_CODE = 124  # A phase ran out of time, as reported by timeout(1)
 
-def test_ssh_connection_with_sshpass(remote_host, ssh_port=22, ssh_user=None, ssh_password=None, timeout=5):
-    """
-    Test SSH connection using sshpass for password authentication and subprocess.
-
-    Args:
-    - host (str): The remote server's hostname or IP address.
-    - port (int, optional): SSH port (default is 22).
-    - ssh_user (str): SSH username.
-    - ssh_password (str): SSH password for authentication.
-    - timeout (int, optional): Connection timeout in seconds.
-
-    Returns:
-    - bool: True if connection is successful, False otherwise.
-    - str: Error message if connection fails.
-    """
-    if not ssh_password:
-        return False, "Password is required when using sshpass."
+# Large file pass of run_split_rsync
+LARGE_BLOCK_SIZE = 128 * 1024  # Largest rsync block size, fewer checksums for huge files
+DELTA_MIN_MATCHED = 0.10  # Below this share of matched data the delta algorithm is not worth it
 
-    # Create the sshpass command using password and ssh
-    ssh_command = [
-        "sshpass", "-p", ssh_password, "ssh", "-o", f"ConnectTimeout={timeout}", "-p", str(ssh_port),
-        f"{ssh_user}@{remote_host}", "exit"
-    ]
-
-    try:
-        # Run SSH command with sshpass
-        result = subprocess.run(ssh_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
+RSYNC_ARGS_BATCH = 256  # Source folders per rsync command of run_folders_rsync, keeps argv short
 
-        if result.returncode == 0:
-            return True, "SSH connection successful."
-        else:
-            # If returncode is non-zero, check for authentication or other errors
-            if "Permission denied" in result.stderr or "Authentication failed" in result.stderr:
-                return False, "Authentication failed: Incorrect username or password."
-            else:
-                return False, f"SSH connection failed: {result.stderr.strip()}"
 
-    # except subprocess.TimeoutExpired:
-    #     return False, "SSH connection timed out."
-    except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        return False, f"Unexpected error: {str(e)}"
+class PhaseTimeout(Exception):
+    """A phase of the job ran over its entry in phase_timeouts."""
 
 
 def parse_rsync_current_file(line):
@@ -70,11 +63,9 @@ def parse_rsync_current_file(line):
     Returns:
     - filename: The extracted filename, or None if no filename is found.
     """
-    # Regex to match lines that look like filenames (e.g., containing a dot)
-    filename_match = re.match(r"^\s*([^\s]+\.\S+)$", line)  # Match lines with a dot (e.g., file extensions)
-    
-    if filename_match:
-        return filename_match.group(1).strip()  # Remove leading/trailing whitespace
+    event = parse_record(line.rstrip("\r\n").encode())
+    if isinstance(event, FileEvent):
+        return event.name
     return None
 
 
@@ -87,31 +78,497 @@ def parse_rsync_progress(line):
     - line: A line of output from rsync, e.g. "10,220,696   0%  522.43kB/s    0:00:19 (xfr#1772, ir-chk=1389/18955)"
     
     Returns:
-    - transferred: The transferred bytes as an integer.
-    - percent: The progress percentage as an integer.
-    - ir_chk_current: The current file number (int).
-    - ir_chk_total: The total number of files (int).
-    """
-    # Regex to match the transferred bytes, percentage, and ir-chk values
-    match = re.match(r"\s*(\d[\d,]*)\s+(\d+)%\s+([\d.]+[kMG]?B/s)\s+([\d:]+)\s+\(xfr#(\d+),\s*ir-chk=(\d+)/(\d+)\)", line)
-    out_dict = None
-    if match:
-        out_dict = {
-            "Bytes Transferred": match.group(1).replace(",", ""),  # Remove commas
-            "Percentage": match.group(2),
-            "Speed": match.group(3),
-            "Time": match.group(4),
-            "Xfr Number": match.group(5),
-            "IR-Chk Numerator": match.group(6),
-            "IR-Chk Denominator": match.group(7)
-        }
-    return out_dict
-
-
-def run_incremental_backup(local_path, remote_path, ssh_user, remote_host, ssh_password, ssh_port=22, keep_days=None):
+    - ProgressEvent: bytes, percent, rate (bytes/s), elapsed, xfr, files_remaining and
+                     files_total, or None if the line is not a progress record.
+    """
+    event = parse_record(b" " + line.strip().encode())
+    if isinstance(event, ProgressEvent):
+        return event
+    return None
+
+
+class ProgressLogger:
+    """
+    Default subscriber of rsync progress events.
+
+    Counts files, collects the --stats totals and logs the overall progress at most
+    once every interval seconds, instead of one log call per rsync output line.
+    """
+
+    def __init__(self, interval=1.0, on_event=None):
+        self.interval = interval
+        self.on_event = on_event
+        self.files = 0
+        self.last = None
+        self.stats = {}
+        self.rates = deque(maxlen=10000)
+        self._last_log = 0.0
+
+    def __call__(self, event):
+        if isinstance(event, FileEvent) or isinstance(event, ItemEvent) and event.flags[0] in "<>":
+            self.files += 1
+        elif isinstance(event, ProgressEvent):
+            self.last = event
+            self.rates.append(event.rate)
+            now = time.monotonic()
+            if now - self._last_log >= self.interval:
+                self._last_log = now
+                self.log(event)
+        elif isinstance(event, StatsEvent):
+            self.stats[event.key] = event.value
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def log(self, event):
+        logger.debug("Overall Progress: %s%% Speed: %.2fkB/s Bytes Transferred: (%s bytes) | "
+                     "Files: %s transferred, %s to check of %s",
+                     event.percent, event.rate / 1024, event.bytes, event.xfr,
+                     event.files_remaining, event.files_total)
+
+
+async def run_rsync(rsync_cmd, on_event=None, metrics=None):
+    """
+    Run one rsync command with real-time progress tracking.
+
+    Args:
+    - rsync_cmd (list): rsync argv.
+    - on_event (callable): Optional subscriber receiving every rsync_progress event.
+    - metrics (JobMetrics): Job the --stats totals are added to.
+
+    Returns:
+    - int: rsync's exit code.
+    """
+    logger.info(f"Used rsync command: {shlex.join(rsync_cmd)}")
+
+    progress = ProgressLogger(on_event=on_event)
+    returncode, stderr_tail = await stream_rsync_async(rsync_cmd, on_event=progress)
+
+    if progress.last is not None:
+        progress.log(progress.last)
+    logger.info(f"rsync listed {progress.files} file(s)")
+    if metrics is not None:
+        metrics.add_rsync_stats(progress.stats)
+        metrics.add_rate_samples(progress.rates)
+    if returncode != 0:
+        logger.error(f"rsync exited with code {returncode}: {' | '.join(stderr_tail)}")
+
+    return returncode
+
+
+async def run_sharded_rsync(rsync_base, local_path, destination, rsync_rsh, shard_count, fresh=True, metrics=None,
+                            on_event=None):
+    """
+    Copy local_path into one snapshot with several rsync workers, one per shard of its top-level entries.
+
+    Args:
+    - rsync_base (list): rsync argv shared by every worker (options and --link-dest).
+    - local_path (str): Local source directory.
+    - destination (str): rsync destination, e.g. user@host:/backup/2024-01-01_00-00-00
+    - rsync_rsh (str): Remote shell for rsync's "-e" option.
+    - shard_count (int): Number of rsync workers.
+    - fresh (bool): The snapshot was created by this run. A resumed one also gets its
+                    top-level entries deleted from the source removed (see delete_extraneous_cmd).
+    - metrics (JobMetrics): Job the --stats totals of every worker are added to.
+    - on_event (callable): Subscriber receiving the rsync events of every worker.
+
+    Returns:
+    - int: 0 if every shard succeeded, otherwise the first non-zero rsync exit code.
+    """
+    shards = await asyncio.to_thread(plan_shards, local_path, shard_count)
+    if not shards:
+        return await run_rsync(rsync_base + ["-e", rsync_rsh, local_path, destination], on_event=on_event,
+                               metrics=metrics)
+
+    source_dir, _ = split_source(local_path)
+    logger.info(f"Running {len(shards)} rsync shards of {local_path}")
+
+    lists = [write_files_from(shard) for shard in shards]
+    try:
+        # --files-from turns off the recursion implied by -a, so it is requested again
+        commands = [rsync_base + ["-r"] + files_from_args(files_from) + ["-e", rsync_rsh, source_dir, destination]
+                    for files_from in lists]
+        exit_codes = await asyncio.gather(*(run_rsync(rsync_cmd, on_event=on_event, metrics=metrics)
+                                            for rsync_cmd in commands))
+    finally:
+        for files_from in lists:
+            os.remove(files_from)
+
+    failed = [exit_code for exit_code in exit_codes if exit_code != 0]
+    if failed:
+        return failed[0]
+
+    if not fresh:
+        exit_code = await run_rsync(delete_extraneous_cmd(local_path, rsync_rsh, destination), metrics=metrics)
+        if exit_code != 0:
+            return exit_code
+    return await run_rsync(root_attributes_cmd(local_path, rsync_rsh, destination), metrics=metrics)
+
+
+def link_moves_cmd(prev_backup, new_backup):
+    """
+    Build the remote command hard-linking moved files, reading NUL separated
+    "previous path, new path" pairs from stdin.
+
+    xargs hands the pairs to a few sh processes (an even batch size keeps pairs
+    together). A failed link is not an error, rsync then simply sends the file.
+    """
+    script = ('prev=$1; new=$2; shift 2; while [ $# -ge 2 ]; do '
+              'case $2 in */*) mkdir -p -- "$new/${2%/*}" ;; esac; '
+              'ln -f -- "$prev/$1" "$new/$2" 2>/dev/null; shift 2; done')
+    return (f"xargs -0 -n 2000 sh -c {shlex.quote(script)} sh "
+            f"{shlex.quote(prev_backup)} {shlex.quote(new_backup)}")
+
+
+def unlink_changed_cmd(new_backup):
+    """
+    Build the remote command removing changed entries from a hard-linked clone, reading
+    NUL separated paths from stdin.
+
+    A cloned file shares its inode with the older snapshots. When only its mode, owner
+    or group changed, rsync's quick check passes and it would chmod/chown that shared
+    inode in place, rewriting the older snapshots too. Once removed, rsync writes a new
+    file (using --link-dest as its basis). Folders are real copies in the clone and stay.
+    """
+    script = 'for path; do [ -d "$path" ] && [ ! -L "$path" ] || rm -f -- "$path"; done'
+    return f"cd {shlex.quote(new_backup)} && xargs -0 sh -c {shlex.quote(script)} sh"
+
+
+async def unlink_outdated(session, local_path, new_backup, destination):
+    """
+    Unlink from a resumed snapshot the entries the transfer into it is going to update.
+
+    The interrupted snapshot was filled by a hard-linked clone or by --link-dest, so its
+    files share inodes with the older snapshots, and a resumed rsync updates existing
+    files in place when only their attributes differ. A dry run lists the entries that
+    differ, they are removed (see unlink_changed_cmd) and rsync writes them as new files.
+
+    Returns:
+    - int: The dry run's exit code, 0 (or 24, files vanished meanwhile) when the snapshot is safe to resume.
+    """
+    result = await run_process(["rsync", "-a", "--dry-run", "--out-format=%i %n", "-e", session.rsync_rsh(),
+                                local_path, destination])
+    if result.returncode not in (0, 24):
+        logger.error(f"rsync dry run exited with code {result.returncode}: {result.stderr.strip()}")
+        return result.returncode
+    # "%i %n": 11 flag characters then the name. Folders stay, deletions are left to the transfer
+    outdated = [rsync_name(line[12:]) for line in result.stdout.splitlines()
+                if len(line) > 12 and line[0] in "<>ch." and line[1] in "fLDS"]
+    if outdated:
+        logger.info(f"Unlinking {len(outdated)} outdated entries from {new_backup} before resuming")
+        await session.run_async(unlink_changed_cmd(new_backup), input="\0".join(outdated), check=True)
+    return result.returncode
+
+
+async def run_changed_rsync(session, rsync_base, source_dir, changed, deleted, prev_backup, new_backup, destination,
+                            moves=None, metrics=None, on_event=None):
+    """
+    Build a snapshot from the previous one and transfer only the changed paths.
+
+    The previous snapshot is hard-link cloned on the remote side, the changed files
+    are unlinked from the clone (see unlink_changed_cmd), moved files are hard-linked
+    to their new path and paths deleted locally are removed from the clone, each in
+    one batched command. rsync then only receives the changed paths through
+    --files-from and finds the moved ones already up to date.
+
+    Args:
+    - session (SSHSession): Open session to the remote host.
+    - rsync_base (list): rsync argv options.
+    - source_dir (str): Directory the change set paths are relative to.
+    - changed (list): New or modified paths.
+    - deleted (list): Paths removed since the previous snapshot.
+    - prev_backup (str): Remote previous snapshot.
+    - new_backup (str): Remote new snapshot.
+    - destination (str): rsync destination of new_backup.
+    - moves (list): (previous path, new path) pairs from ChangeIndex.find_moves.
+    - metrics (JobMetrics): Job the --stats totals are added to.
+    - on_event (callable): Subscriber receiving the rsync events.
+
+    Returns:
+    - int: rsync's exit code.
+    """
+    logger.info(f"{len(changed)} changed and {len(deleted)} deleted paths since {prev_backup}")
+
+    await session.run_async(f"cp -al {shlex.quote(prev_backup)}/. {shlex.quote(new_backup)}/", check=True)
+    if changed:
+        # Before the moves: their links are recreated right after, with a matching mode
+        await session.run_async(unlink_changed_cmd(new_backup), input="\0".join(changed), check=True)
+    if moves:
+        logger.info(f"Hard-linking {len(moves)} moved files from {prev_backup}")
+        await session.run_async(link_moves_cmd(prev_backup, new_backup),
+                                input="\0".join(path for move in moves for path in move), check=True)
+    if deleted:
+        await session.run_async(f"cd {shlex.quote(new_backup)} && xargs -0 rm -rf --",
+                                input="\0".join(collapse_nested(deleted)), check=True)
+    if not changed:
+        return 0
+
+    files_from = write_files_from(changed)
+    try:
+        return await run_rsync(rsync_base + files_from_args(files_from) + ["-e", session.rsync_rsh(), source_dir,
+                                                                           destination],
+                               on_event=on_event, metrics=metrics)
+    finally:
+        os.remove(files_from)
+
+
+def direct_entries(source_dir, folder):
+    """
+    List the entries directly inside a folder of the rsync source, except the folders.
+
+    Returns:
+    - list: Paths relative to source_dir, as rsync names them.
+    """
+    base = "" if folder == "." else folder.rstrip("/") + "/"
+    try:
+        with os.scandir(os.path.join(source_dir, folder)) as entries:
+            return [base + entry.name for entry in entries if not entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return []
+
+
+async def run_folders_rsync(session, rsync_base, source_dir, folders, subtrees, prev_backup, new_backup, destination,
+                            metrics=None, on_event=None):
+    """
+    Build a snapshot from the previous one and sync only dirty folders, for the watch daemon.
+
+    The previous snapshot is hard-link cloned on the remote side. A dirty folder only
+    has its direct entries synced: rsync --dirs with --delete on the folder, its
+    sub-folders keep their cloned content. Its files are unlinked from the clone first
+    (see unlink_changed_cmd) and rsync rebuilds them against --link-dest, a
+    chmod/chown (IN_ATTRIB) would otherwise rewrite the older snapshots. New subtrees
+    (created or moved-in folders) are removed from the clone and synced recursively.
+
+    Args:
+    - session (SSHSession): Open session to the remote host.
+    - rsync_base (list): rsync argv options.
+    - source_dir (str): Directory the paths are relative to.
+    - folders (list): Folders whose direct entries are synced, "." for source_dir itself.
+    - subtrees (list): Folders synced recursively.
+    - prev_backup (str): Remote previous snapshot.
+    - new_backup (str): Remote new snapshot.
+    - destination (str): rsync destination of new_backup.
+    - metrics (JobMetrics): Job the --stats totals are added to.
+    - on_event (callable): Subscriber receiving the rsync events.
+
+    Returns:
+    - int: 0 if every rsync run succeeded, otherwise the first non-zero exit code.
+    """
+    logger.info(f"{len(folders)} dirty folders and {len(subtrees)} new subtrees since {prev_backup}")
+
+    await session.run_async(f"cp -al {shlex.quote(prev_backup)}/. {shlex.quote(new_backup)}/", check=True)
+    files = [path for folder in folders for path in await asyncio.to_thread(direct_entries, source_dir, folder)]
+    if files:
+        await session.run_async(unlink_changed_cmd(new_backup), input="\0".join(files), check=True)
+    if subtrees:
+        await session.run_async(f"cd {shlex.quote(new_backup)} && xargs -0 rm -rf --", input="\0".join(subtrees),
+                                check=True)
+
+    # -R keeps the path after "/./" below the snapshot. A folder named with a trailing
+    # slash has its direct entries synced by --dirs, -a's recursion is turned off
+    source = source_dir.rstrip("/") + "/./"
+    runs = [["--no-recursive", "--dirs", "-R"] + [source + ("" if folder == "." else folder.rstrip("/") + "/")
+                                                  for folder in folders[i:i + RSYNC_ARGS_BATCH]]
+            for i in range(0, len(folders), RSYNC_ARGS_BATCH)]
+    runs += [["-R"] + [source + subtree for subtree in subtrees[i:i + RSYNC_ARGS_BATCH]]
+             for i in range(0, len(subtrees), RSYNC_ARGS_BATCH)]
+    for args in runs:
+        exit_code = await run_rsync(rsync_base + args + ["-e", session.rsync_rsh(), destination],
+                                    on_event=on_event, metrics=metrics)
+        if exit_code != 0:
+            return exit_code
+    return 0
+
+
+async def run_split_rsync(rsync_base, local_path, destination, rsync_rsh, threshold, fresh=True, state_path=None,
+                          metrics=None, on_event=None):
+    """
+    Transfer small and large files in two passes tuned for each, into the same snapshot.
+
+    - Small files (below threshold) and every folder, link and deletion: one pass over
+      the whole tree with --whole-file, the delta algorithm saves nothing on tiny
+      files but costs checksums and round trips for each of them.
+    - Large files: only the files found by a local walk (--files-from), with the
+      largest block size. When the previous large pass matched little data the
+      delta is skipped with --whole-file. In a fresh snapshot the files are written
+      with --inplace: a changed file is a new inode there (the --link-dest basis
+      is only read), so no older snapshot sharing the inode can be modified. A
+      resumed snapshot may hold such shared inodes and keeps the default temp file.
+
+    Args:
+    - rsync_base (list): rsync argv options.
+    - local_path (str): Local source directory.
+    - destination (str): rsync destination of the new snapshot.
+    - rsync_rsh (str): Remote shell of the SSH session.
+    - threshold (int): Size in bytes from which a file goes through the large file pass.
+    - fresh (bool): The snapshot was created by this run.
+    - state_path (str): JSON file keeping the matched data share of the last large pass.
+    - metrics (JobMetrics): Job the --stats totals and the per-pass throughput are added to.
+    - on_event (callable): Subscriber receiving the rsync events of both passes.
+
+    Returns:
+    - int: 0 if both passes succeeded, otherwise the first non-zero exit code.
+    """
+    async def run_pass(name, rsync_cmd):
+        pass_metrics = JobMetrics(name)
+        start = time.monotonic()
+        exit_code = await run_rsync(rsync_cmd, on_event=on_event, metrics=pass_metrics)
+        seconds = time.monotonic() - start
+        if metrics is not None:
+            metrics.add_rsync_stats(pass_metrics.rsync)
+            metrics.add_rate_samples(pass_metrics.rate_samples)
+            metrics.add_pass(name, pass_metrics.rsync, seconds)
+        transferred = pass_metrics.rsync.get("total_transferred_file_size", 0)
+        logger.info(f"{name} pass: {pass_metrics.rsync.get('regular_files_transferred', 0)} files, "
+                    f"{transferred} bytes in {seconds:.1f}s ({transferred / seconds / 1024 ** 2 if seconds else 0:.1f} MB/s)")
+        return exit_code, pass_metrics.rsync
+
+    exit_code, _ = await run_pass("small_files", rsync_base + ["--whole-file", f"--max-size={threshold - 1}",
+                                                                "-e", rsync_rsh, local_path, destination])
+    if exit_code != 0:
+        return exit_code
+
+    source_dir, prefix = split_source(local_path)
+    tree = await asyncio.to_thread(scan_tree, source_dir, prefix)
+    large = [path for path, (size, _, _, mode) in tree.items()
+             if stat_module.S_ISREG(mode) and size >= threshold]
+    if not large:
+        return 0
+
+    state = {}
+    if state_path and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    large_cmd = [arg for arg in rsync_base if not (fresh and arg.startswith("--partial-dir="))]
+    large_cmd += [f"--block-size={LARGE_BLOCK_SIZE}"]
+    if fresh:
+        large_cmd.append("--inplace")
+    if state.get("matched_share") is not None and state["matched_share"] < DELTA_MIN_MATCHED:
+        logger.info(f"Last large file pass matched {state['matched_share']:.0%} of the data, copying whole files")
+        large_cmd.append("--whole-file")
+
+    files_from = write_files_from(large)
+    try:
+        exit_code, stats = await run_pass("large_files", large_cmd + files_from_args(files_from)
+                                           + ["-e", rsync_rsh, source_dir, destination])
+    finally:
+        os.remove(files_from)
+
+    delta = stats.get("matched_data", 0) + stats.get("literal_data", 0)
+    if exit_code == 0 and state_path and delta and "--whole-file" not in large_cmd:
+        with open(state_path, "w") as f:
+            json.dump({"matched_share": stats.get("matched_data", 0) / delta}, f)
+    elif exit_code == 0 and state_path and "--whole-file" in large_cmd:
+        # Measure the delta again on the next run, the data may have become more similar
+        with open(state_path, "w") as f:
+            json.dump({}, f)
+    return exit_code
+
+
+async def store_manifest(session, manifest_dir, remote_path, snapshot, prev_backup, collector, tree=None,
+                         subtrees=None, folders=None):
+    """
+    Write the manifest of a new snapshot locally and copy it next to the snapshots.
+
+    The entries come from the change index walk (tree) when the run used one, otherwise
+    from the itemized rsync output gathered by collector. A run that only synced
+    folders and subtrees completes them with the manifest of the previous snapshot.
+
+    Returns:
+    - dict: Manifest index (entries, files, bytes), None if it could not be built.
+    """
+    os.makedirs(manifest_dir, exist_ok=True)
+    previous_path = manifest_path(manifest_dir, os.path.basename(prev_backup.rstrip("/"))) if prev_backup else None
+    has_previous = previous_path is not None and os.path.exists(previous_path)
+    if tree is not None:
+        entries, replaced = entries_from_tree(tree), None
+    elif subtrees is not None:
+        if not has_previous:
+            logger.info(f"No manifest of {prev_backup}, the manifest of {snapshot} is not written")
+            return None
+        entries, replaced = collector.entries, subtrees
+    else:
+        entries, replaced = collector.entries, None
+    listed = folders or ()
+
+    path = manifest_path(manifest_dir, snapshot)
+    index = await asyncio.to_thread(lambda: write_manifest(path, build_manifest(
+        entries, read_manifest(previous_path) if has_previous else None, replaced, collector.deleted, listed)))
+    logger.info(f"Manifest of {snapshot}: {index['entries']} entries, {index['files']} files, {index['bytes']} bytes")
+
+    remote_dir = f"{remote_path}/{REMOTE_MANIFEST_DIR}"
+    remote_file = f"{remote_dir}/{os.path.basename(path)}"
+    with open(path, "rb") as f:
+        data = f.read()
+    await session.run_async(f"mkdir -p {shlex.quote(remote_dir)} && cat > {shlex.quote(remote_file + '.tmp')} "
+                            f"&& mv {shlex.quote(remote_file + '.tmp')} {shlex.quote(remote_file)}",
+                            input=data, check=True)
+    return index
+
+
+async def run_fanout_backup_async(jobs):
+    """
+    Back up one source to several destinations at once.
+
+    The source is walked once and the same tree gives each destination its change
+    set against its own change index (destinations may be at different snapshots).
+    The destinations are then pushed concurrently, each with its own SSH session,
+    checkpoint and metrics, so an unreachable or slow one does not hold the others
+    back, and the transfers read the same files at about the same time, mostly
+    from the page cache after the first one.
+
+    Args:
+    - jobs (list): run_incremental_backup_async keyword arguments, one dict per
+                   destination, all with the same local_path.
+
+    Returns:
+    - list: Exit code of each destination in the order of jobs, the exception for
+            a destination that crashed.
+    """
+    local_path = jobs[0]["local_path"]
+    if any(job["local_path"] != local_path for job in jobs):
+        raise ValueError("Every destination of a fan-out backup must have the same local_path")
+
+    current_tree = None
+    if any(job.get("index_path") for job in jobs):
+        source_dir, prefix = split_source(local_path)
+        start = time.monotonic()
+        current_tree = await asyncio.to_thread(scan_tree, source_dir, prefix)
+        logger.info(f"Scanned {len(current_tree)} entries of {local_path} once for {len(jobs)} destinations "
+                    f"in {time.monotonic() - start:.2f}s")
+
+    return await asyncio.gather(*(run_incremental_backup_async(**{**job, "current_tree": current_tree})
+                                  for job in jobs), return_exceptions=True)
+
+
+def run_fanout_backup(jobs):
+    """Blocking run_fanout_backup_async."""
+    return asyncio.run(run_fanout_backup_async(jobs))
+
+
+def run_incremental_backup(*args, **kwargs):
+    """
+    Blocking run_incremental_backup_async, for callers outside an event loop (the
+    command line, the thread based runners). Takes the same arguments.
+    """
+    return asyncio.run(run_incremental_backup_async(*args, **kwargs))
+
+
+async def run_incremental_backup_async(local_path, remote_path, ssh_user, remote_host, ssh_password, ssh_port=22,
+                                       keep_days=None, parallel_shards=None, index_path=None, subtrees=None,
+                                       folders=None, job_name=None, metrics_path=None, prometheus_path=None, retention=None,
+                                       throughput=None, fast_seed=False, seed_compression="zstd", seed_level=None,
+                                       auto_compression=False, compression_cache=None, compression_reevaluate_days=7,
+                                       detect_moves=False, move_hash_min_size=None, checkpoint_path=None,
+                                       size_split_threshold=None, large_pass_state=None, phase_timeouts=None,
+                                       manifest_dir=None, current_tree=None):
     """
     Perform incremental backups using rsync with SSH password authentication and show overall progress.
 
+    Every external command runs as an asyncio subprocess (argv, no local shell) whose
+    stdout and stderr are read concurrently; local scans and hashing run in worker
+    threads. Cancelling the task kills the running commands, the checkpoint lets the
+    next run resume the snapshot.
+
     Parameters:
         local_path (str): Local source directory.
         remote_path (str): Remote backup directory.
@@ -120,83 +577,286 @@ def run_incremental_backup(local_path, remote_path, ssh_user, remote_host, ssh_p
         ssh_password (str): SSH password for authentication.
         ssh_port (int): SSH port.
         keep_days (int): Number of days to keep old backups.
-    """
+        parallel_shards (int): Split local_path into this many rsync workers. None or 1 for a single stream.
+        index_path (str): Local change index (SQLite) of the config. When it describes the
+                          "latest" snapshot only the changed paths are sent, and the run is
+                          skipped if nothing changed. None to let rsync scan the whole tree.
+        subtrees (list): Only sync these directories recursively (relative to the rsync source,
+                         see rsync_shards.split_source), rebuilt with --link-dest next to a clone
+                         of the rest of the previous snapshot. None for a full pass. Used by
+                         the watch daemon, see run_folders_rsync.
+        folders (list): With subtrees, also sync the direct entries of these directories.
+        job_name (str): Name used in the metrics records, local_path by default.
+        metrics_path (str): JSON lines file the job record (phase timings, rsync --stats) is appended to.
+        prometheus_path (str): node_exporter textfile collector file replaced with the job metrics.
+        retention (dict): GFS retention rules and prune options applied with keep_days, see
+                          retention.apply_retention (keep_last, keep_daily, keep_weekly,
+                          keep_monthly, parallel, background).
+        throughput (ThroughputPolicy): Bandwidth windows and nice/ionice priority of the local rsync.
+        fast_seed (bool): When there is no previous snapshot, stream the tree as a tar archive
+                          first and let rsync only run a consistency pass.
+        seed_compression (str): "zstd", "lz4" or "none" for the seed stream.
+        seed_level (int): Compression level of the seed stream.
+        auto_compression (bool): Sample local_path to pick rsync's compression algorithm, level
+                                 and skip-compress list, or leave compression off.
+        compression_cache (str): JSON file caching the compression decision of the config.
+        compression_reevaluate_days (int): Age after which the cached decision is re-evaluated.
+        detect_moves (bool): With a valid change index, hard-link moved and renamed files from
+                             their previous path in the remote snapshot instead of sending them again.
+        move_hash_min_size (int): Also match files of at least this many bytes by content hash
+                                  (copies, moves across file systems). None to match inodes only.
+        checkpoint_path (str): JSON file recording the snapshot being written. An interrupted
+                               run is resumed into the same snapshot by the next one.
+        size_split_threshold (int): Send files of at least this many bytes in a separate pass tuned
+                                    for large files (see run_split_rsync). Used for full passes
+                                    instead of parallel_shards. None for a single pass.
+        large_pass_state (str): JSON file keeping the delta efficiency of the last large file pass.
+        phase_timeouts (dict): Seconds allowed per phase, by metrics phase name (connect,
+                               readlink, seed, transfer, prune...). The job is stopped and
+                               its commands killed when a phase runs over.
+        manifest_dir (str): Folder of the local snapshot manifests (see utils.manifest). Each
+                            run writes the manifest of its snapshot there and next to the
+                            snapshots on the remote host. None to write no manifest.
+        current_tree (dict): scan_tree() result of local_path already taken by the caller,
+                             used with index_path instead of walking the tree again.
 
-    success, message = test_ssh_connection_with_sshpass(remote_host=remote_host, ssh_port=ssh_port, ssh_user=ssh_user, ssh_password=ssh_password)
+    Returns:
+        int: Job exit code. 0 on success, rsync's exit code if the transfer failed,
+             CONNECT_FAILURE_EXIT_CODE if the remote host could not be reached,
+             TIMEOUT_EXIT_CODE if a phase ran over its timeout.
+    """
+    metrics = JobMetrics(job_name or local_path)
+    exit_code = None
+    try:
+        exit_code = await _backup_job(metrics, local_path=local_path, remote_path=remote_path, ssh_user=ssh_user,
+                                remote_host=remote_host, ssh_password=ssh_password, ssh_port=ssh_port,
+                                keep_days=keep_days, parallel_shards=parallel_shards, index_path=index_path,
+                                subtrees=subtrees, folders=folders or [], retention=retention, throughput=throughput,
+                                fast_seed=fast_seed, seed_compression=seed_compression, seed_level=seed_level,
+                                auto_compression=auto_compression, compression_cache=compression_cache,
+                                compression_reevaluate_days=compression_reevaluate_days,
+                                detect_moves=detect_moves, move_hash_min_size=move_hash_min_size,
+                                checkpoint_path=checkpoint_path, size_split_threshold=size_split_threshold,
+                                large_pass_state=large_pass_state, phase_timeouts=phase_timeouts or {},
+                                manifest_dir=manifest_dir, current_tree=current_tree)
+        return exit_code
+    except PhaseTimeout as e:
+        # The commands of the phase were killed; an interrupted transfer is resumed from the checkpoint
+        logger.error(f"Backup stopped, {e}")
+        exit_code = TIMEOUT_EXIT_CODE
+        return exit_code
+    finally:
+        # Failed and crashed jobs are recorded too, a crash has no exit code
+        metrics.finish(exit_code)
+        logger.info("Job phases: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in metrics.phases.items()))
+        if metrics_path:
+            metrics.write_jsonl(metrics_path)
+        if prometheus_path:
+            metrics.write_prometheus(prometheus_path)
+
+
+async def _backup_job(metrics, local_path, remote_path, ssh_user, remote_host, ssh_password, ssh_port, keep_days,
+                      parallel_shards, index_path, subtrees, folders, retention, throughput, fast_seed, seed_compression,
+                      seed_level, auto_compression, compression_cache, compression_reevaluate_days, detect_moves,
+                      move_hash_min_size, checkpoint_path, size_split_threshold, large_pass_state, phase_timeouts,
+                      manifest_dir, current_tree):
+    # Body of run_incremental_backup_async, every phase is timed in metrics
+    async def step(name, awaitable):
+        # Run one phase, cancelled (and its commands killed) when it runs over its timeout
+        with metrics.phase(name):
+            try:
+                return await asyncio.wait_for(awaitable, phase_timeouts.get(name))
+            except asyncio.TimeoutError:
+                raise PhaseTimeout(f"phase {name} ran over its {phase_timeouts[name]}s timeout") from None
+
+    if index_path and current_tree is None:
+        # One fast local walk gives the change set, before any connection is opened
+        source_dir, prefix = split_source(local_path)
+        current_tree = await step("index_scan", asyncio.to_thread(scan_tree, source_dir, prefix))
+
+    compression = None
+    if auto_compression:
+        compression = await step("compression_probe", asyncio.to_thread(
+            choose_compression, local_path, compression_cache, compression_reevaluate_days))
+
+    async with contextlib.AsyncExitStack() as stack:
+        # One multiplexed SSH connection is shared by every remote step of the job
+        session = await stack.enter_async_context(SSHSession(remote_host=remote_host, ssh_port=ssh_port,
+                                                             ssh_user=ssh_user, ssh_password=ssh_password))
+        change_index = stack.enter_context(ChangeIndex(index_path)) if index_path else None
+
+        success, message = await step("connect", session.open_async())
+
+        if not success:
+            logger.info(f"SSH connection unsucesfull: {message}")
+            return CONNECT_FAILURE_EXIT_CODE
 
-    if success:
         logger.info("SSH connection sucessful")
 
-        date_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        new_backup = f"{remote_path}/{date_str}"
         latest = f"{remote_path}/latest"
 
-        # SSH command with password authentication using sshpass
-        ssh_cmd = f"sshpass -p '{ssh_password}' ssh -p {ssh_port}"
-
         # Find the previous backup
-        get_prev_cmd = f"{ssh_cmd} {ssh_user}@{remote_host} 'readlink {latest}'"
-        try:
-            prev_backup = subprocess.check_output(get_prev_cmd, shell=True, text=True).strip() 
-        except subprocess.CalledProcessError:
-            prev_backup = ""
+        prev_backup = await step("readlink", session.check_output_async(f"readlink {shlex.quote(latest)}"))
 
-        logger.info(f"Previous backup found: {prev_backup}")    
+        logger.info(f"Previous backup found: {prev_backup}")
+
+        checkpoint = Checkpoint(checkpoint_path)
+        resumed = checkpoint.resumable(local_path, remote_path, prev_backup)
+        if resumed and (await session.run_async(f"test -d {shlex.quote(resumed['new_backup'])}")).returncode == 0:
+            date_str, new_backup = resumed["snapshot"], resumed["new_backup"]
+            logger.info(f"Resuming the interrupted backup into {new_backup} (started {resumed['started']})")
+        else:
+            resumed = None
+            abandoned = checkpoint.load()
+            if abandoned and abandoned.get("remote_path") == remote_path and \
+                    abandoned["snapshot"] != os.path.basename(prev_backup.rstrip("/")):
+                # Built on top of another "latest", it can not be continued
+                logger.info(f"Removing the incomplete snapshot {abandoned['new_backup']}")
+                await session.run_async(delete_snapshots_cmd(remote_path, [abandoned["snapshot"]]))
+            checkpoint.clear()
+            date_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            new_backup = f"{remote_path}/{date_str}"
+
+        changed = moves = None
+        if resumed:
+            # The interrupted clone or transfer state is unknown, a full pass into the
+            # partial snapshot completes it and only sends what is missing, once the
+            # entries it updates are unlinked (see unlink_outdated)
+            subtrees = None
+        elif subtrees is not None and prev_backup:
+            if not subtrees and not folders:
+                logger.info("No dirty folders, skipping backup.")
+                return 0
+        elif change_index and change_index.is_valid_for(local_path, prev_backup):
+            changed, deleted = await asyncio.to_thread(change_index.diff, current_tree)
+            if not changed and not deleted:
+                logger.info(f"No changes since {prev_backup}, skipping backup.")
+                return 0
+            if detect_moves:
+                moves = await step("move_detection", asyncio.to_thread(
+                    change_index.find_moves, current_tree, changed, deleted, split_source(local_path)[0],
+                    move_hash_min_size))
+                logger.info(f"{len(moves)} moved files detected, "
+                            f"{sum(current_tree[path][0] for _, path in moves)} bytes not sent again")
 
         # Create new backup directory on remote server
-        process = subprocess.run(f"{ssh_cmd} {ssh_user}@{remote_host} 'mkdir -p {new_backup}'", shell=True, check=True)        
+        await step("mkdir", session.run_async(f"mkdir -p {shlex.quote(new_backup)}", check=True))
+        if not resumed:
+            checkpoint.save(local_path, remote_path, prev_backup, date_str, new_backup)
 
-        # Rsync command with password authentication and progress tracking
-        rsync_base = "rsync -a --delete --info=progress2 --progress"
-        rsync_ssh = f"-e 'sshpass -p \"{ssh_password}\" ssh -p {ssh_port}'"
-        
+        # Rsync command tunnelled through the session and progress tracking
+        rsync_base = ["rsync", "-a", "--delete", "--info=progress2", "--progress", "--stats",
+                      f"--partial-dir={PARTIAL_DIR}"]
         if prev_backup:
-            rsync_cmd = f"{rsync_base} --link-remote_path={prev_backup} {rsync_ssh} {local_path} {ssh_user}@{remote_host}:{new_backup}"
+            rsync_base.append(f"--link-dest={prev_backup}")
+
+        if compression and compression["enabled"]:
+            # zstd/lz4 are only negotiated with an rsync 3.2 on the other side, else plain -z
+            remote_version = await remote_rsync_version(session)
+            rsync_base += compression_rsync_args(compression, remote_version)
+
+        collector = None
+        if manifest_dir:
+            # The itemized listing of the transfer is the manifest, no second walk is needed
+            rsync_base += ITEMIZE_ARGS
+            collector = ManifestCollector()
+
+        bwlimit = None
+        if throughput:
+            rsync_base = throughput.command_prefix() + rsync_base
+            bwlimit = throughput.bwlimit()
+        if bwlimit:
+            # The limit is a budget for the whole job, shared by the shards
+            shards = int(parallel_shards) if parallel_shards and changed is None and subtrees is None \
+                and not size_split_threshold else 1
+            rsync_base.append(f"--bwlimit={max(1, bwlimit // max(1, shards))}")
+            logger.info(f"Bandwidth limited to {bwlimit} KB/s")
+        destination = f"{ssh_user}@{remote_host}:{new_backup}"
+
+        if resumed:
+            exit_code = await step("unlink", unlink_outdated(session, local_path, new_backup, destination))
+            if exit_code not in (0, 24):
+                logger.error(f"Backup failed, {latest} still points to {prev_backup}")
+                return exit_code
+
+        if fast_seed and not prev_backup and not resumed:
+            exit_code = await step("seed", seed_snapshot(session, local_path, new_backup,
+                                                         compression=seed_compression, level=seed_level))
+            if exit_code != 0:
+                logger.error(f"Backup failed, {latest} was not created")
+                return exit_code
+
+        if subtrees is not None and prev_backup:
+            transfer = run_folders_rsync(session, rsync_base, split_source(local_path)[0], folders,
+                                         collapse_nested(subtrees), prev_backup, new_backup, destination,
+                                         metrics=metrics, on_event=collector)
+        elif changed is not None:
+            transfer = run_changed_rsync(session, rsync_base, split_source(local_path)[0], changed, deleted,
+                                         prev_backup, new_backup, destination, moves=moves, metrics=metrics,
+                                         on_event=collector)
+        elif size_split_threshold:
+            transfer = run_split_rsync(rsync_base, local_path, destination, session.rsync_rsh(),
+                                       int(size_split_threshold), fresh=not resumed,
+                                       state_path=large_pass_state, metrics=metrics, on_event=collector)
+        elif parallel_shards and int(parallel_shards) > 1:
+            transfer = run_sharded_rsync(rsync_base, local_path, destination, session.rsync_rsh(),
+                                         int(parallel_shards), fresh=not resumed, metrics=metrics,
+                                         on_event=collector)
         else:
-            rsync_cmd = f"{rsync_base} {rsync_ssh} {local_path} {ssh_user}@{remote_host}:{new_backup}"
-
-        logger.info(f"Used rsync command: {rsync_cmd.replace(ssh_password, '********')}")
-
-        # Run rsync with real-time progress tracking
-        process = subprocess.Popen(rsync_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        for line in process.stdout:
-            # sys.stdout.write(line)
-            # sys.stdout.flush()
-            logger.debug(f"process.stdout: {line}")            
-            
-            # Parse currrent file
-            parsed_rsync_current_file = parse_rsync_current_file(line)
-
-            # Parse transferred bytes, percentage, and ir-chk from each rsync line
-            parsed_rsync_progress = parse_rsync_progress(line)
-
-            if parsed_rsync_current_file is not None:
-                logger.debug(f"Current file: {parsed_rsync_current_file}")
-
-            if parsed_rsync_progress is not None:            
-                logger.debug(f"Overall Progress: {parsed_rsync_progress['Percentage']}% "
-                            f"Speed: {parsed_rsync_progress['Speed']} "
-                            f"Bytes Transferred: ({parsed_rsync_progress['Bytes Transferred']} bytes) | "
-                            f"File {parsed_rsync_progress['IR-Chk Numerator']}/"
-                            f"{parsed_rsync_progress['IR-Chk Denominator']}")
-              
-        # Wait for rsync to finish
-        process.wait()
-
-        # Update the "latest" symlink
-        update_symlink_cmd = f"{ssh_cmd} {ssh_user}@{remote_host} 'rm -f {latest} && ln -s {new_backup} {latest}'"
-        subprocess.run(update_symlink_cmd, shell=True, check=True)
-
-        # Optional: Delete old backups
-        if keep_days:
-            delete_old_cmd = f"{ssh_cmd} {ssh_user}@{remote_host} 'find {remote_path} -maxdepth 1 -type d -mtime +{keep_days} -exec rm -rf {{}} \;'"
-            subprocess.run(delete_old_cmd, shell=True, check=True)
+            transfer = run_rsync(rsync_base + ["-e", session.rsync_rsh(), local_path, destination],
+                                 on_event=collector, metrics=metrics)
+        exit_code = await step("transfer", transfer)
+
+        if auto_compression:
+            log_achieved_ratio(compression, metrics.rsync)
+
+        # Never point "latest" to an incomplete snapshot
+        if exit_code != 0:
+            logger.error(f"Backup failed, {latest} still points to {prev_backup}")
+            return exit_code
+
+        # Point "latest" to the new snapshot atomically: a new link renamed over the old one
+        latest_tmp = f"{latest}.tmp"
+        await step("symlink_swap", session.run_async(
+            f"test -d {shlex.quote(new_backup)} && ln -sfn {shlex.quote(new_backup)} {shlex.quote(latest_tmp)} "
+            f"&& mv -T {shlex.quote(latest_tmp)} {shlex.quote(latest)}", check=True))
+        checkpoint.clear()
+
+        if manifest_dir:
+            try:
+                await step("manifest", store_manifest(
+                    session, manifest_dir, remote_path, date_str, prev_backup, collector,
+                    tree=current_tree if changed is not None else None,
+                    subtrees=subtrees if subtrees is not None and prev_backup else None,
+                    folders=folders if subtrees is not None and prev_backup else None))
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                # The snapshot itself is complete, only the queries lose this one
+                logger.error(f"Could not write the manifest of {date_str}: {e}")
+
+        if throughput:
+            throughput.learn(metrics.rate_percentile(90), bwlimit)
+
+        if change_index:
+            # Hashes are only needed to match moved files by content
+            await step("index_update", asyncio.to_thread(
+                change_index.update, local_path, current_tree, date_str, changed, split_source(local_path)[0],
+                move_hash_min_size if detect_moves else None))
+
+        # Optional: Delete old backups, planned from the snapshot names and never touching "latest"
+        if keep_days or retention:
+            try:
+                _, pruned = await step("prune", apply_retention_async(session, remote_path, protected=[new_backup],
+                                                                      keep_days=keep_days, **(retention or {})))
+            except subprocess.CalledProcessError as e:
+                # The new snapshot is complete and "latest" points to it, the next run prunes again
+                logger.warning(f"Could not delete old snapshots of {remote_path}: {(e.stderr or '').strip() or e}")
+            else:
+                if manifest_dir:
+                    remove_manifests(manifest_dir, pruned)
 
         logger.info("Backup completed!")
 
-    else:
-        logger.info(f"SSH connection unsucesfull: {message}")
+    return exit_code
 
 # Example Usage:
 # incremental_backup("/local/source/", "/backup", "ssh_user", "remote.server.com", "your_password")
@@ -218,6 +878,8 @@ if __name__ == "__main__":
 
     # Adding credentials stored infile for testing
     
+    from utils.logger import configure_logging
+    configure_logging(console_level=logging.DEBUG)
     from credentials_raw_testing_DO_NOT_ADD_TO_REPO import connections_dict
     connection_dict = connections_dict["NAS No Key"]
 
@@ -0,0 +1,204 @@
+# ============================================================
+#
+#  Easy backup
+#  Pre-flight Transfer Estimator
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import datetime
+import hashlib
+import json
+import os
+import shlex
+import stat as stat_module
+import statistics
+from utils.change_index import ChangeIndex, scan_tree
+from utils.rsync_progress import stream_rsync, StatsEvent
+from utils.rsync_shards import split_source
+from utils.ssh_session import SSHSession
+from utils.logger import logger  # Import the shared logger
+
+HISTORY_RUNS = 10  # Recent successful runs used for throughput and overhead
+
+
+def tree_fingerprint(tree):
+    """Digest of a scan_tree() result, equal only if no entry was added, removed or modified."""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in sorted(tree):
+        digest.update(f"{path}\0{tree[path]}\n".encode(errors="surrogateescape"))
+    return digest.hexdigest()
+
+
+def tree_totals(tree, paths=None):
+    """Return the number and total size of the regular files of tree (only paths if given)."""
+    files = size = 0
+    for path in tree if paths is None else paths:
+        entry = tree.get(path)
+        if entry and stat_module.S_ISREG(entry[3]):
+            files += 1
+            size += entry[0]
+    return files, size
+
+
+def index_estimate(index_path, tree, local_path, latest):
+    """
+    Estimate the transfer from the change index, without an rsync scan.
+
+    Like a backup run, the index is only trusted if it describes the snapshot "latest"
+    points to (see ChangeIndex.is_valid_for): after a failed or foreign run it does not.
+
+    Returns:
+    - tuple: (files, bytes), None if the index is missing or does not describe latest.
+    """
+    if not index_path or not os.path.exists(index_path):
+        return None
+    with ChangeIndex(index_path) as change_index:
+        if not change_index.is_valid_for(local_path, latest):
+            return None
+        changed, _ = change_index.diff(tree)
+    return tree_totals(tree, changed)
+
+
+def dry_run_estimate(session, local_path, latest):
+    """
+    Estimate the transfer with an rsync dry run against the "latest" snapshot.
+
+    Returns:
+    - tuple: (files, bytes), None if there is no "latest" snapshot or the dry run failed.
+    """
+    if not latest:
+        return None
+    stats = {}
+
+    def on_event(event):
+        if isinstance(event, StatsEvent):
+            stats[event.key] = event.value
+
+    rsync_cmd = ["rsync", "-a", "--delete", "--dry-run", "--stats", "-e", session.rsync_rsh(),
+                 local_path, f"{session.target}:{latest}/"]
+    returncode, stderr_tail = stream_rsync(rsync_cmd, on_event=on_event)
+    if returncode != 0:
+        logger.error(f"Estimate dry run failed with exit code {returncode}: {' '.join(stderr_tail)}")
+        return None
+    return stats.get("regular_files_transferred", 0), stats.get("total_transferred_file_size", 0)
+
+
+def read_history(metrics_path, runs=HISTORY_RUNS):
+    """Return the last successful job records of a metrics.jsonl file, oldest first."""
+    if not metrics_path or not os.path.exists(metrics_path):
+        return []
+    records = []
+    with open(metrics_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("exit_code") == 0:
+                records.append(record)
+    return records[-runs:]
+
+
+def host_rates(metrics_paths):
+    """
+    Transfer rates of a remote host, from the recent runs of every config backing up to it.
+
+    Returns:
+    - float: Bytes per second over the transfer phases, None without history.
+    - float: Regular files per second over the transfer phases, None without history.
+    """
+    transfer_time = transferred_bytes = transferred_files = 0
+    for metrics_path in metrics_paths:
+        for record in read_history(metrics_path):
+            seconds = record.get("phases", {}).get("transfer")
+            rsync = record.get("rsync", {})
+            if not seconds or not rsync.get("regular_files_transferred"):
+                continue
+            transfer_time += seconds
+            transferred_bytes += rsync.get("total_transferred_file_size", 0)
+            transferred_files += rsync["regular_files_transferred"]
+    if not transfer_time:
+        return None, None
+    return transferred_bytes / transfer_time, transferred_files / transfer_time
+
+
+def job_overhead(metrics_path):
+    """Median seconds a job of the config spends outside the transfer (connect, scan, swap, prune)."""
+    overheads = [record["wall_time"] - record.get("phases", {}).get("transfer", 0)
+                 for record in read_history(metrics_path) if record.get("wall_time") is not None]
+    return statistics.median(overheads) if overheads else 0.0
+
+
+def estimate_backup(local_path, remote_path, ssh_user, remote_host, ssh_password, ssh_port=22, index_path=None,
+                    metrics_path=None, host_metrics_paths=(), cache_path=None):
+    """
+    Estimate the files, bytes and duration of the next run of a backup configuration.
+
+    The transfer is taken from the change index when it describes "latest", otherwise
+    from an rsync --dry-run --stats against "latest" (the whole tree for a first backup). The
+    duration combines it with the historical rates of the remote host and the usual
+    overhead of the job. The estimate is cached and reused while the local tree is
+    unchanged and no backup ran since.
+
+    Args:
+    - index_path (str): Change index of the config, None to use a dry run.
+    - metrics_path (str): metrics.jsonl of the config.
+    - host_metrics_paths (iterable): metrics.jsonl of every config backing up to remote_host.
+    - cache_path (str): JSON file caching the estimate.
+
+    Returns:
+    - dict: files, bytes, method (index, dry_run, full), eta_seconds (None without history),
+            bytes_per_s, files_per_s, overhead_seconds, fingerprint, based_on, estimated (iso time).
+    """
+    source_dir, prefix = split_source(local_path)
+    tree = scan_tree(source_dir, prefix)
+    fingerprint = tree_fingerprint(tree)
+    history = read_history(metrics_path, runs=1)
+    based_on = history[-1]["started"] if history else None
+
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached.get("fingerprint") == fingerprint and cached.get("based_on") == based_on:
+            logger.info(f"Reusing the cached estimate of {cached['estimated']}")
+            return cached
+
+    with SSHSession(remote_host=remote_host, ssh_port=ssh_port, ssh_user=ssh_user,
+                    ssh_password=ssh_password) as session:
+        success, message = session.open()
+        if not success:
+            raise ConnectionError(f"SSH connection unsucesfull: {message}")
+        latest = session.check_output(f"readlink {shlex.quote(remote_path + '/latest')}")
+        method, totals = "index", index_estimate(index_path, tree, local_path, latest)
+        if totals is None:
+            method, totals = "dry_run", dry_run_estimate(session, local_path, latest)
+    if totals is None:
+        method, totals = "full", tree_totals(tree)
+    files, size = totals
+
+    bytes_per_s, files_per_s = host_rates(host_metrics_paths)
+    overhead = job_overhead(metrics_path)
+    eta = None
+    if bytes_per_s:
+        # Large files are bound by the bandwidth, many small ones by the per-file cost
+        eta = overhead + max(size / bytes_per_s, files / files_per_s if files_per_s else 0)
+
+    estimate = {"files": files, "bytes": size, "method": method, "eta_seconds": eta,
+                "bytes_per_s": bytes_per_s, "files_per_s": files_per_s, "overhead_seconds": overhead,
+                "fingerprint": fingerprint, "based_on": based_on,
+                "estimated": datetime.datetime.now().isoformat(timespec="seconds")}
+    if cache_path:
+        with open(cache_path, "w") as f:
+            json.dump(estimate, f)
+    return estimate
+
+
+def format_duration(seconds):
+    """Render seconds as H:MM:SS, "unknown" for None."""
+    if seconds is None:
+        return "unknown"
+    return str(datetime.timedelta(seconds=int(seconds)))
@@ -0,0 +1,220 @@
+# ============================================================
+#
+#  Easy backup
+#  Host Reachability Probes
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import asyncio
+import contextlib
+import json
+import os
+import time
+from utils.async_process import run_process
+from utils.state import STATE_DIR
+from utils.logger import logger  # Import the shared logger
+
+# Probe results of every remote host, shared by --probe-all, --run-all-backups and --scheduler
+HOSTS_FILE = STATE_DIR / "hosts.json"
+DEFAULT_TTL = 300  # Seconds a probe result is trusted before the host is probed again
+PROBE_TIMEOUT = 5  # Seconds for the TCP connect, and for the SSH handshake and authentication
+PROBE_CONCURRENCY = 64  # Hosts probed at once
+
+
+def host_key(host, port):
+    return f"{host}:{port}"
+
+
+async def probe_tcp(host, port, timeout=PROBE_TIMEOUT):
+    """
+    Open and close a TCP connection to the SSH port of a host.
+
+    Returns:
+    - bool: True if the port accepted the connection.
+    - float: Connect time in milliseconds (name resolution included), None on failure.
+    - str: Error message, None on success.
+    """
+    start = time.monotonic()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        return False, None, "TCP connect timed out."
+    except OSError as e:
+        return False, None, f"TCP connect failed: {e.strerror or e}"
+    elapsed = (time.monotonic() - start) * 1000
+    writer.close()
+    with contextlib.suppress(OSError):
+        await writer.wait_closed()
+    return True, elapsed, None
+
+
+async def probe_ssh(host, port, ssh_user, ssh_password, timeout=PROBE_TIMEOUT):
+    """
+    Log in with sshpass and run "exit", without sharing an existing master connection.
+
+    Returns:
+    - bool: True if the login succeeded, None when there is no password to try.
+    - float: Handshake and authentication time in milliseconds, None if it timed out.
+    - str: Error message, None on success.
+    """
+    if not ssh_password:
+        return None, None, "Password is required when using sshpass."
+    command = ["sshpass", "-e", "ssh", "-o", f"ConnectTimeout={timeout}", "-o", "ControlMaster=no",
+               "-o", "ControlPath=none", "-p", str(port), f"{ssh_user}@{host}", "exit"]
+    start = time.monotonic()
+    try:
+        result = await run_process(command, timeout=2 * timeout, env={**os.environ, "SSHPASS": str(ssh_password)})
+    except asyncio.TimeoutError:
+        return False, None, "SSH authentication timed out."
+    except OSError as e:
+        return False, None, f"Unexpected error: {e}"
+    elapsed = (time.monotonic() - start) * 1000
+    if result.returncode == 0:
+        return True, elapsed, None
+    if "Permission denied" in result.stderr or "Authentication failed" in result.stderr:
+        return False, elapsed, "Authentication failed: Incorrect username or password."
+    return False, elapsed, f"SSH connection failed: {result.stderr.strip()}"
+
+
+async def probe_hosts_async(targets, timeout=PROBE_TIMEOUT, concurrency=PROBE_CONCURRENCY):
+    """
+    Probe many hosts at once: a TCP connect per host and port, then one SSH login per
+    user of the hosts that answered. A powered-off host costs one timeout for the whole
+    batch instead of one per job.
+
+    Args:
+    - targets (iterable): (remote_host, ssh_port, ssh_user, ssh_password) tuples, duplicates allowed.
+    - timeout (float): Seconds per probe.
+    - concurrency (int): Hosts probed at once.
+
+    Returns:
+    - dict: host_key -> {"host", "port", "checked", "tcp_ok", "tcp_ms", "error",
+            "auth": {ssh_user: {"ok", "ms", "error"}}}
+    """
+    users = {}
+    for host, port, ssh_user, ssh_password in targets:
+        users.setdefault((host, int(port)), {}).setdefault(ssh_user, ssh_password)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(host, port, credentials):
+        async with semaphore:
+            tcp_ok, tcp_ms, error = await probe_tcp(host, port, timeout)
+            auth = {}
+            if tcp_ok:
+                logins = await asyncio.gather(*(probe_ssh(host, port, ssh_user, ssh_password, timeout)
+                                                for ssh_user, ssh_password in credentials.items()))
+                auth = {ssh_user: {"ok": ok, "ms": ms, "error": login_error}
+                        for ssh_user, (ok, ms, login_error) in zip(credentials, logins)}
+        return {"host": host, "port": port, "checked": time.time(), "tcp_ok": tcp_ok, "tcp_ms": tcp_ms,
+                "error": error, "auth": auth}
+
+    results = await asyncio.gather(*(probe(host, port, credentials) for (host, port), credentials in users.items()))
+    return {host_key(result["host"], result["port"]): result for result in results}
+
+
+def probe_hosts(*args, **kwargs):
+    """Blocking probe_hosts_async."""
+    return asyncio.run(probe_hosts_async(*args, **kwargs))
+
+
+class ReachabilityCache:
+    """
+    Last probe result of every host, kept in HOSTS_FILE so the next run, the scheduler
+    and the CLI reuse it until it is ttl seconds old.
+
+    Usage:
+        cache = ReachabilityCache(ttl=300)
+        cache.refresh(targets)  # Probes only the hosts without a fresh result
+        if cache.is_down(host, port):
+            ...
+    """
+
+    def __init__(self, path=HOSTS_FILE, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.hosts = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def fresh(self, host, port):
+        """Return the cached result of a host, None if there is none or it is older than ttl."""
+        entry = self.hosts.get(host_key(host, port))
+        if entry is None or time.time() - entry["checked"] >= self.ttl:
+            return None
+        return entry
+
+    def is_down(self, host, port):
+        """True if a fresh result says the SSH port of the host does not answer."""
+        entry = self.fresh(host, port)
+        return entry is not None and not entry["tcp_ok"]
+
+    def expires(self, host, port):
+        """Epoch time at which the cached result of a host goes stale, None if there is none."""
+        entry = self.hosts.get(host_key(host, port))
+        return entry["checked"] + self.ttl if entry else None
+
+    def update(self, results):
+        """Merge probe results into the state file, keeping what other processes wrote meanwhile."""
+        self.hosts = {**self._load(), **results}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(self.hosts, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def refresh(self, targets, timeout=PROBE_TIMEOUT, force=False):
+        """
+        Probe, all at once, the targets whose host has no fresh result (every target with force).
+
+        Returns:
+        - dict: The new results, by host_key.
+        """
+        self.hosts = self._load()
+        stale = [target for target in targets if force or self.fresh(target[0], int(target[1])) is None]
+        if not stale:
+            return {}
+        start = time.monotonic()
+        results = probe_hosts(stale, timeout=timeout)
+        self.update(results)
+        down = [key for key, result in results.items() if not result["tcp_ok"]]
+        logger.info(f"Probed {len(results)} host(s) in {time.monotonic() - start:.1f}s"
+                    + (f", unreachable: {', '.join(down)}" if down else ""))
+        return results
+
+
+def format_probe_table(results, names=None):
+    """
+    Render probe results as a text table, one row per host and SSH user.
+
+    Args:
+    - results (dict): host_key -> probe result, as returned by probe_hosts.
+    - names (dict): host_key -> configuration names using the host, for the last column.
+    """
+    def milliseconds(value):
+        return f"{value:.0f}" if value is not None else "-"
+
+    headers = ["Host", "Port", "TCP", "TCP ms", "User", "SSH", "SSH ms", "Configurations", "Error"]
+    rows = []
+    for key, result in sorted(results.items()):
+        logins = result["auth"] or {"-": {"ok": None, "ms": None, "error": result["error"]}}
+        for ssh_user, login in sorted(logins.items(), key=lambda item: str(item[0])):
+            ssh_status = {True: "ok", False: "failed", None: "-"}[login["ok"]]
+            rows.append([str(result["host"]), str(result["port"]), "up" if result["tcp_ok"] else "DOWN",
+                         milliseconds(result["tcp_ms"]), str(ssh_user), ssh_status, milliseconds(login["ms"]),
+                         ", ".join((names or {}).get(key, [])), login["error"] or ""])
+    widths = [max(len(row[i]) for row in [headers] + rows) for i in range(len(headers))]
+
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(headers, widths)).rstrip(),
+             "  ".join("-" * width for width in widths)]
+    for row in rows:
+        lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    return "\n".join(lines)
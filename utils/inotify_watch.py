@@ -0,0 +1,179 @@
+# ============================================================
+#
+#  Easy backup
+#  Inotify Watcher (Linux)
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from utils.logger import logger  # Import the shared logger
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class DirtySet:
+    """
+    Bounded set of directories with pending changes.
+
+    Each directory maps to whether its whole subtree is new (created or moved in) and
+    must be synced recursively, or only its direct entries changed. When more than
+    max_entries directories are pending the set gives up tracking them individually
+    and only remembers that a full scan is needed.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.paths = {}
+        self.overflowed = False
+
+    def add(self, path, recursive=False):
+        if self.overflowed:
+            return
+        self.paths[path] = recursive or self.paths.get(path, False)
+        if len(self.paths) > self.max_entries:
+            self.mark_overflow()
+
+    def mark_overflow(self):
+        self.overflowed = True
+        self.paths.clear()
+
+    def drain(self):
+        """
+        Return the pending directories (path -> recursive) and the overflow flag, and reset the set.
+        """
+        paths, overflowed = self.paths, self.overflowed
+        self.paths, self.overflowed = {}, False
+        return paths, overflowed
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class InotifyWatcher:
+    """
+    Recursive inotify watch of a directory tree, built on libc through ctypes.
+
+    Every event is reduced to the directory it happened in and stored in a DirtySet,
+    created and moved-in directories are stored as recursive.
+    A kernel queue overflow, or running out of inotify watches, marks the set as
+    overflowed so the caller falls back to a full scan.
+    """
+
+    def __init__(self, root, dirty_set):
+        self.root = os.path.abspath(root)
+        self.dirty = dirty_set
+        self.watches = {}
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+
+        self.add_tree(self.root)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                logger.warning("Out of inotify watches (fs.inotify.max_user_watches), falling back to full scans.")
+                self.dirty.mark_overflow()
+            return
+        self.watches[wd] = path
+
+    def add_tree(self, top):
+        """Watch top and every directory below it."""
+        for folder, dirnames, _ in os.walk(top):
+            self._add_watch(folder)
+
+    def read_events(self, timeout):
+        """
+        Wait up to timeout seconds for events and record them in the dirty set.
+
+        Returns:
+        - int: Number of events read.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return 0
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return 0
+
+        count = 0
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            count += 1
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify event queue overflowed, next sync will be a full scan.")
+                self.dirty.mark_overflow()
+                continue
+
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.dirty.add(os.path.dirname(folder))
+            else:
+                self.dirty.add(folder)
+
+            # New or moved-in directories need their own watches, and a recursive sync
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(os.path.join(folder, name))
+                self.dirty.add(os.path.join(folder, name), recursive=True)
+
+        return count
@@ -0,0 +1,166 @@
+# ============================================================
+#
+#  Easy backup
+#  Backup Job Metrics
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import contextlib
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+
+class JobMetrics:
+    """
+    Monotonic per-phase timers and rsync --stats totals of one backup job.
+
+    Usage:
+        metrics = JobMetrics("NAS")
+        with metrics.phase("connect"):
+            ...
+        metrics.finish(exit_code)
+        metrics.write_jsonl(path)
+    """
+
+    def __init__(self, job_name):
+        self.job_name = job_name
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self.phases = {}
+        self.rsync = {}
+        self.rate_samples = []
+        self.passes = {}
+        self.exit_code = None
+        self.wall_time = None
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase. Phases entered more than once are accumulated."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def add_rsync_stats(self, stats):
+        """Add the --stats totals of one rsync run (several runs for shards or split passes)."""
+        with self._lock:
+            for key, value in stats.items():
+                self.rsync[key] = self.rsync.get(key, 0) + value
+
+    def add_rate_samples(self, rates):
+        """Add live transfer rate samples (bytes/s) read from the rsync progress stream."""
+        with self._lock:
+            self.rate_samples.extend(rates)
+
+    def add_pass(self, name, stats, seconds):
+        """
+        Record one transfer pass (e.g. the small and large file passes) with its own
+        --stats totals and time, so the throughput of each pass can be compared.
+        """
+        with self._lock:
+            entry = self.passes.setdefault(name, {"seconds": 0.0, "files": 0, "bytes": 0,
+                                                  "literal_data": 0, "matched_data": 0})
+            entry["seconds"] += seconds
+            entry["files"] += stats.get("regular_files_transferred", 0)
+            entry["bytes"] += stats.get("total_transferred_file_size", 0)
+            entry["literal_data"] += stats.get("literal_data", 0)
+            entry["matched_data"] += stats.get("matched_data", 0)
+            entry["throughput_bytes_per_s"] = entry["bytes"] / entry["seconds"] if entry["seconds"] else None
+
+    def rate_percentile(self, percentile=90):
+        """Return a percentile of the rate samples in bytes/s, None without samples."""
+        if not self.rate_samples:
+            return None
+        samples = sorted(self.rate_samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def finish(self, exit_code):
+        self.exit_code = exit_code
+        self.wall_time = time.monotonic() - self._start
+
+    def record(self):
+        """
+        Return the machine readable job record.
+
+        Returns:
+        - dict: job, started, exit_code, wall_time, phases (seconds), rsync totals,
+                speedup, transfer throughput (bytes/s over the transfer phase),
+                90th percentile of the live rate samples and the transfer passes.
+        """
+        rsync = dict(self.rsync)
+        if rsync.get("total_bytes_sent") or rsync.get("total_bytes_received"):
+            wire_bytes = rsync.get("total_bytes_sent", 0) + rsync.get("total_bytes_received", 0)
+            rsync["speedup"] = rsync.get("total_file_size", 0) / wire_bytes
+
+        transfer_time = self.phases.get("transfer")
+        throughput = None
+        if transfer_time:
+            throughput = rsync.get("total_transferred_file_size", 0) / transfer_time
+
+        return {"job": self.job_name,
+                "started": self.started,
+                "exit_code": self.exit_code,
+                "wall_time": self.wall_time,
+                "phases": dict(self.phases),
+                "rsync": rsync,
+                "throughput_bytes_per_s": throughput,
+                "rate_p90_bytes_per_s": self.rate_percentile(90),
+                "passes": {name: dict(entry) for name, entry in self.passes.items()}}
+
+    def write_jsonl(self, path):
+        """Append the job record to a JSON lines file."""
+        with open(path, "a") as f:
+            f.write(json.dumps(self.record()) + "\n")
+
+    def write_prometheus(self, path):
+        """
+        Write the job record for the node_exporter textfile collector.
+
+        The file is replaced atomically so the collector never reads a partial file.
+        """
+        record = self.record()
+        job = re.sub(r'["\\\n]', "_", str(self.job_name))
+        lines = [
+            "# HELP easybackup_job_exit_code Exit code of the last backup job.",
+            "# TYPE easybackup_job_exit_code gauge",
+            f'easybackup_job_exit_code{{job="{job}"}} {record["exit_code"] if record["exit_code"] is not None else -1}',
+            "# HELP easybackup_job_wall_seconds Wall time of the last backup job.",
+            "# TYPE easybackup_job_wall_seconds gauge",
+            f'easybackup_job_wall_seconds{{job="{job}"}} {record["wall_time"]:.3f}',
+            "# HELP easybackup_job_last_run_timestamp_seconds Unix time the last backup job finished.",
+            "# TYPE easybackup_job_last_run_timestamp_seconds gauge",
+            f'easybackup_job_last_run_timestamp_seconds{{job="{job}"}} {time.time():.0f}',
+            "# HELP easybackup_job_phase_seconds Time spent in each phase of the last backup job.",
+            "# TYPE easybackup_job_phase_seconds gauge",
+        ]
+        lines += [f'easybackup_job_phase_seconds{{job="{job}",phase="{phase}"}} {seconds:.3f}'
+                  for phase, seconds in record["phases"].items()]
+        lines += ["# HELP easybackup_rsync_stat rsync --stats totals of the last backup job.",
+                  "# TYPE easybackup_rsync_stat gauge"]
+        lines += [f'easybackup_rsync_stat{{job="{job}",stat="{key}"}} {value}'
+                  for key, value in record["rsync"].items()]
+        if record["throughput_bytes_per_s"] is not None:
+            lines += ["# HELP easybackup_job_throughput_bytes_per_second Transferred bytes per second of transfer phase.",
+                      "# TYPE easybackup_job_throughput_bytes_per_second gauge",
+                      f'easybackup_job_throughput_bytes_per_second{{job="{job}"}} {record["throughput_bytes_per_s"]:.0f}']
+        if record["passes"]:
+            lines += ["# HELP easybackup_pass_throughput_bytes_per_second Transferred bytes per second of each transfer pass.",
+                      "# TYPE easybackup_pass_throughput_bytes_per_second gauge"]
+            lines += [f'easybackup_pass_throughput_bytes_per_second{{job="{job}",pass="{name}"}} '
+                      f'{entry["throughput_bytes_per_s"] or 0:.0f}' for name, entry in record["passes"].items()]
+
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary, path)
@@ -9,37 +9,110 @@
 #
 # ===========================================================
 
+import atexit
+import datetime
+import json
 import logging
-from pathlib import Path
+import logging.handlers
 import os
-import datetime
+import queue
+from pathlib import Path
 
-# Create the logs path
-logs_path = f"{Path(__file__).parent.parent}/logs/"
-if os.path.exists(logs_path) and os.path.isdir(logs_path):
-    pass
-else:
-    os.makedirs(logs_path)
+# Default logs path, created by configure_logging only
+LOGS_PATH = f"{Path(__file__).parent.parent}/logs/"
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 
-# Create a logger
+# Shared logger. Importing this module only creates it: without configure_logging
+# records only reach Python's last resort handler (warnings and errors on stderr).
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)  # Set the base logging level
 
-# Create a file handler
-date_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-file_handler = logging.FileHandler(f"{logs_path}/{date_str}_easybackup_app.log", mode="a")  # Log to a file in append mode
-file_handler.setLevel(logging.INFO)
-file_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")  # Include %(asctime)s
-file_handler.setFormatter(file_formatter)
-
-# Create a console handler
-console_handler = logging.StreamHandler()  # Log to the console
-console_handler.setLevel(logging.DEBUG)
-console_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")  # Include %(asctime)s
-console_handler.setFormatter(console_formatter)
-
-# Add handler to the logger (avoid duplicate handlers)
-if not logger.hasHandlers():
-    # Add the handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
\ No newline at end of file
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, thread, message and the exception if any."""
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves the record untouched.
+
+    The stock handler merges the message and its arguments before queueing; here the
+    records stay in this process, so the writer thread formats them instead of the
+    thread that logged (e.g. the rsync output loop).
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(console_level=logging.INFO, file_level=logging.INFO, json_format=False, logs_path=LOGS_PATH,
+                      max_bytes=10 * 1024 ** 2, backup_count=5, rotate_when=None, log_name="app"):
+    """
+    Attach the console and file handlers to the shared logger, behind a queue.
+
+    Log calls only put the record on a queue, a background listener thread formats
+    and writes it. Calling it again does nothing.
+
+    The rotating handlers are not safe across processes (one renames the file while
+    the others keep writing to the renamed one), so processes that may run at the
+    same time are given different log names (the command line uses the command and
+    the config name) and each writes its own easybackup_<log_name>.log. Processes
+    sharing a name, e.g. two --list-backups, should use rotate_when="external": the
+    file is then never rotated here but reopened when an outside tool (logrotate)
+    moved it.
+
+    Args:
+    - console_level (int): Level of the console handler.
+    - file_level (int): Level of the file handler.
+    - json_format (bool): Write JSON lines instead of text records.
+    - logs_path (str): Folder of the log file, created if missing.
+    - max_bytes (int): Size at which the log file is rotated.
+    - backup_count (int): Rotated files kept.
+    - rotate_when (str): Rotate by time instead ("midnight", "H", "D", see TimedRotatingFileHandler),
+                         or "external" to leave the rotation to logrotate (WatchedFileHandler).
+    - log_name (str): Name of the log file, e.g. the command of the process.
+
+    Returns:
+    - logging.handlers.QueueListener: The running listener.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    os.makedirs(logs_path, exist_ok=True)
+    log_file = os.path.join(logs_path, f"easybackup_{log_name}.log")
+    if rotate_when == "external":
+        file_handler = logging.handlers.WatchedFileHandler(log_file)
+    elif rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(log_file, when=rotate_when, backupCount=backup_count)
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setLevel(file_level)
+
+    # Create a console handler
+    console_handler = logging.StreamHandler()  # Log to the console
+    console_handler.setLevel(console_level)
+
+    formatter = JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT)
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    logger.setLevel(min(console_level, file_level))
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    # Flush the queue before the interpreter exits
+    atexit.register(_listener.stop)
+    return _listener
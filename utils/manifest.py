@@ -0,0 +1,287 @@
+# ============================================================
+#
+#  Easy backup
+#  Snapshot Manifests
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import bisect
+import gzip
+import json
+import os
+import re
+import stat as stat_module
+import time
+from collections import namedtuple
+from utils.rsync_progress import ItemEvent
+
+# Local manifests: <manifest dir>/<snapshot>.tsv.gz plus its <snapshot>.tsv.gz.idx block index.
+# Remote copies: <remote_path>/REMOTE_MANIFEST_DIR/<snapshot>.tsv.gz, ignored by the retention planner.
+MANIFEST_SUFFIX = ".tsv.gz"
+INDEX_SUFFIX = ".idx"
+REMOTE_MANIFEST_DIR = ".easybackup-manifests"
+
+# Entries per gzip member. Every member can be decompressed on its own, so a lookup
+# only inflates one block while the file stays readable with zcat.
+BLOCK_ENTRIES = 4096
+READ_CHUNK = 1024 * 1024
+
+# rsync options listing every entry of the snapshot, unchanged (hard-linked) ones
+# included: the manifest is built from the transfer output, without another walk.
+ITEMIZE_ARGS = ["-ii", "--out-format=%i %l %M %B %n"]
+
+# File type letter of the itemized output (second character) to the stat file type
+ITEM_TYPES = {"f": stat_module.S_IFREG, "d": stat_module.S_IFDIR, "L": stat_module.S_IFLNK,
+              "D": stat_module.S_IFCHR, "S": stat_module.S_IFIFO}
+PERMISSION_FLAGS = [stat_module.S_IRUSR, stat_module.S_IWUSR, stat_module.S_IXUSR,
+                    stat_module.S_IRGRP, stat_module.S_IWGRP, stat_module.S_IXGRP,
+                    stat_module.S_IROTH, stat_module.S_IWOTH, stat_module.S_IXOTH]
+# Execute slots showing s/t (with execute) or S/T (without) for setuid, setgid and sticky
+SPECIAL_FLAGS = {2: stat_module.S_ISUID, 5: stat_module.S_ISGID, 8: stat_module.S_ISVTX}
+
+# rsync prints unprintable bytes of file names as \#ooo
+RSYNC_ESCAPE_RE = re.compile(rb"\\#([0-7]{3})")
+
+ManifestEntry = namedtuple("ManifestEntry", ["path", "size", "mtime", "mode", "hash"])
+
+
+def manifest_path(manifest_dir, snapshot):
+    return os.path.join(str(manifest_dir), f"{snapshot}{MANIFEST_SUFFIX}")
+
+
+def list_manifests(manifest_dir):
+    """Return the snapshot names that have a local manifest, oldest first."""
+    if not os.path.isdir(manifest_dir):
+        return []
+    return sorted(name[:-len(MANIFEST_SUFFIX)] for name in os.listdir(manifest_dir) if name.endswith(MANIFEST_SUFFIX))
+
+
+def remove_manifests(manifest_dir, snapshots):
+    """Delete the local manifests of deleted snapshots."""
+    for snapshot in snapshots:
+        path = manifest_path(manifest_dir, snapshot)
+        for file_path in (path, path + INDEX_SUFFIX):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+def _escape(path):
+    return path.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def _unescape(text):
+    return re.sub(r"\\(.)", lambda match: {"t": "\t", "n": "\n"}.get(match.group(1), match.group(1)), text)
+
+
+def _parse_permissions(perms):
+    # "rwxr-sr-t" to 0o3755
+    mode = 0
+    for position, (letter, flag) in enumerate(zip(perms, PERMISSION_FLAGS)):
+        if letter in "stST":
+            mode |= SPECIAL_FLAGS[position]
+        if letter not in "-ST":
+            mode |= flag
+    return mode
+
+
+def rsync_name(name):
+    """Undo the \\#ooo escapes rsync prints for unprintable bytes of a file name."""
+    return RSYNC_ESCAPE_RE.sub(lambda match: bytes([int(match.group(1), 8)]),
+                               name.encode(errors="surrogateescape")).decode(errors="surrogateescape")
+
+
+def entry_from_item(event):
+    """
+    Convert an rsync ItemEvent to a ManifestEntry, None for the root of the transfer.
+
+    %M is the local modification time with second resolution.
+    """
+    path = rsync_name(event.name).rstrip("/")
+    if path in ("", "."):
+        return None
+    mtime = int(time.mktime(time.strptime(event.mtime, "%Y/%m/%d-%H:%M:%S")))
+    mode = ITEM_TYPES.get(event.flags[1], 0) | _parse_permissions(event.perms)
+    return ManifestEntry(path, event.size, mtime, mode, "")
+
+
+class ManifestCollector:
+    """
+    rsync event subscriber gathering the itemized entries of a snapshot.
+
+    Pass it as on_event to every rsync run of the job. Runs listing the same path
+    (e.g. the implied directories of shards) keep the last entry.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.deleted = set()
+
+    def __call__(self, event):
+        if not isinstance(event, ItemEvent):
+            return
+        if event.flags.startswith("*deleting"):
+            self.deleted.add(event.name.rstrip("/"))
+            return
+        entry = entry_from_item(event)
+        if entry is not None:
+            self.entries[entry.path] = entry
+
+
+def entries_from_tree(tree):
+    """ManifestEntry dict from a change_index.scan_tree() result."""
+    return {path: ManifestEntry(path, size, mtime_ns // 10 ** 9, mode, "")
+            for path, (size, mtime_ns, _, mode) in tree.items()}
+
+
+def build_manifest(entries, previous=None, replaced=None, deleted=(), listed=()):
+    """
+    Combine the entries listed by this run with the previous manifest.
+
+    Args:
+    - entries (dict): path -> ManifestEntry listed by this run.
+    - previous (iterable): ManifestEntry of the previous snapshot, None if there is none.
+    - replaced (list): Paths whose whole subtree was synced by this run (the entries are
+                       complete below them). None when entries cover the whole snapshot.
+    - deleted (iterable): Paths removed since the previous snapshot.
+    - listed (iterable): Folders whose direct entries were synced by this run, with replaced.
+
+    Returns:
+    - dict: path -> ManifestEntry of the new snapshot. Hashes of entries with the same
+            size, mtime and mode as in the previous manifest are carried over.
+    """
+    merged = dict(entries)
+    if previous is None:
+        return merged
+    roots = tuple(path.rstrip("/") for path in replaced) if replaced is not None else None
+    gone = tuple(path.rstrip("/") for path in deleted)
+    folders = {path.rstrip("/") or "." for path in listed}
+
+    def under(path, bases):
+        return any(path == base or path.startswith(base + "/") for base in bases)
+
+    for entry in previous:
+        current = merged.get(entry.path)
+        if current is not None:
+            if entry.hash and not current.hash and current[1:4] == entry[1:4]:
+                merged[entry.path] = current._replace(hash=entry.hash)
+        elif roots is not None and not under(entry.path, roots) and not under(entry.path, gone) \
+                and (entry.path.rpartition("/")[0] or ".") not in folders:
+            merged[entry.path] = entry
+    return merged
+
+
+def _key(path):
+    # Manifests are sorted on the escaped, encoded path, the bytes the merge and lookups compare
+    return _escape(path).encode(errors="surrogateescape")
+
+
+def write_manifest(path, entries):
+    """
+    Write a sorted manifest and its block index atomically.
+
+    Every line is "path size mtime mode hash" (tab separated, mode in octal). The
+    index lists the first path and offset of every block plus the snapshot totals.
+
+    Returns:
+    - dict: The index (entries, files, bytes, blocks).
+    """
+    rows = sorted((_key(entry.path), entry) for entry in entries.values())
+    blocks = []
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        for start in range(0, len(rows), BLOCK_ENTRIES):
+            block = rows[start:start + BLOCK_ENTRIES]
+            blocks.append([block[0][0].decode(errors="surrogateescape"), f.tell()])
+            data = b"".join(key + f"\t{row.size}\t{row.mtime}\t{row.mode:o}\t{row.hash}\n".encode()
+                            for key, row in block)
+            f.write(gzip.compress(data, compresslevel=6, mtime=0))
+        blocks.append([None, f.tell()])
+    regular = [row for _, row in rows if stat_module.S_ISREG(row.mode)]
+    index = {"entries": len(rows), "files": len(regular), "bytes": sum(row.size for row in regular), "blocks": blocks}
+    with open(tmp_path + INDEX_SUFFIX, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+    os.replace(tmp_path + INDEX_SUFFIX, path + INDEX_SUFFIX)
+    return index
+
+
+def _parse_line(line):
+    path, size, mtime, mode, digest = line.decode(errors="surrogateescape").split("\t")
+    return ManifestEntry(_unescape(path), int(size), int(mtime), int(mode, 8), digest)
+
+
+def _iter_lines(path):
+    # Raw lines of a manifest, decompressed in large chunks
+    with gzip.open(path, "rb") as f:
+        pending = b""
+        for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            yield from lines
+
+
+def read_manifest(path):
+    """Yield the entries of a manifest in manifest order."""
+    for line in _iter_lines(path):
+        yield _parse_line(line)
+
+
+def read_index(path):
+    with open(path + INDEX_SUFFIX) as f:
+        return json.load(f)
+
+
+def lookup(path, wanted):
+    """
+    Return the ManifestEntry of one path, None if the snapshot does not have it.
+
+    Only the block that may hold the path is read and decompressed.
+    """
+    key = _key(wanted.strip("/"))
+    blocks = read_index(path)["blocks"]
+    position = bisect.bisect_right([first.encode(errors="surrogateescape") for first, _ in blocks[:-1]], key) - 1
+    if position < 0:
+        return None
+    with open(path, "rb") as f:
+        f.seek(blocks[position][1])
+        data = gzip.decompress(f.read(blocks[position + 1][1] - blocks[position][1]))
+    for line in data.splitlines():
+        if line.split(b"\t", 1)[0] == key:
+            return _parse_line(line)
+    return None
+
+
+def diff_manifests(old_path, new_path):
+    """
+    Compare two manifests with one merge pass over both sorted files.
+
+    Identical lines are skipped without being parsed, so unchanged entries cost
+    little more than the decompression.
+
+    Yields:
+    - tuple: ("added", None, entry), ("deleted", entry, None) or ("modified", old, new).
+             An entry is modified when its size, mtime, mode or known hash differ.
+    """
+    old_lines, new_lines = _iter_lines(old_path), _iter_lines(new_path)
+    old, new = next(old_lines, None), next(new_lines, None)
+    while old is not None or new is not None:
+        if old is not None and old == new:
+            old, new = next(old_lines, None), next(new_lines, None)
+            continue
+        old_key = old.split(b"\t", 1)[0] if old is not None else None
+        new_key = new.split(b"\t", 1)[0] if new is not None else None
+        if new is None or (old is not None and old_key < new_key):
+            yield "deleted", _parse_line(old), None
+            old = next(old_lines, None)
+        elif old is None or new_key < old_key:
+            yield "added", None, _parse_line(new)
+            new = next(new_lines, None)
+        else:
+            before, after = _parse_line(old), _parse_line(new)
+            if before[1:4] != after[1:4] or (before.hash and after.hash and before.hash != after.hash):
+                yield "modified", before, after
+            old, new = next(old_lines, None), next(new_lines, None)
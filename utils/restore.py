@@ -0,0 +1,256 @@
+# ============================================================
+#
+#  Easy backup
+#  Parallel Restore
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import asyncio
+import datetime
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import stat as stat_module
+import time
+from utils.async_process import run_process
+from utils.checkpoint import PARTIAL_DIR
+from utils.easybackup_core import run_rsync
+from utils.manifest import ManifestEntry, manifest_path, read_manifest, rsync_name
+from utils.rsync_progress import ProgressEvent
+from utils.rsync_shards import PER_FILE_COST, write_files_from, files_from_args
+from utils.logger import logger  # Import the shared logger
+
+# "rsync --list-only" line: permissions, size (with digit grouping since 3.1), date, time, name
+LIST_RE = re.compile(r"([-dlcbps][-rwxsStT]{9})\s+([\d,.]+) (\d{4}/\d\d/\d\d \d\d:\d\d:\d\d) (.*)$")
+# File type letter of the listing to the stat file type
+LIST_TYPES = {"-": stat_module.S_IFREG, "d": stat_module.S_IFDIR, "l": stat_module.S_IFLNK}
+
+
+async def list_snapshot(session, snapshot_dir, manifest_dir=None):
+    """
+    Return the entries of a snapshot, from its local manifest when there is one.
+
+    Without a manifest the snapshot is listed once with "rsync --list-only" over the
+    session, which only needs the rsync the backups already use on the remote host
+    (busybox and BSD find have no -printf).
+
+    Returns:
+    - list: ManifestEntry of every entry (the hash is not known from a listing).
+    """
+    snapshot = os.path.basename(snapshot_dir.rstrip("/"))
+    if manifest_dir:
+        path = manifest_path(manifest_dir, snapshot)
+        if os.path.exists(path):
+            return await asyncio.to_thread(lambda: list(read_manifest(path)))
+
+    logger.info(f"No manifest of {snapshot}, listing it on the remote host")
+    result = await run_process(["rsync", "-a", "--list-only", "-e", session.rsync_rsh(),
+                                f"{session.target}:{snapshot_dir.rstrip('/')}/"], check=True)
+    entries = []
+    for line in result.stdout.splitlines():
+        match = LIST_RE.match(line)
+        if not match or match.group(4) == ".":
+            continue
+        perms, size, when, name = match.groups()
+        if perms[0] == "l":
+            name = name.split(" -> ", 1)[0]
+        mtime = int(time.mktime(time.strptime(when, "%Y/%m/%d %H:%M:%S")))
+        entries.append(ManifestEntry(rsync_name(name), int(re.sub(r"[,.]", "", size)), mtime,
+                                     LIST_TYPES.get(perms[0], 0), ""))
+    return entries
+
+
+def matches(path, patterns):
+    """
+    True if path is selected by a pattern: the path itself, a folder holding it, or a
+    glob matching it or one of its folders ("projects/*/report.pdf", "*.sql").
+    """
+    parents = [path]
+    while "/" in parents[-1]:
+        parents.append(parents[-1].rsplit("/", 1)[0])
+    return any(fnmatch.fnmatchcase(candidate, pattern) for pattern in patterns for candidate in parents)
+
+
+def select_entries(entries, patterns=None):
+    """Entries selected by patterns, with the folders leading to them. Every entry without patterns."""
+    if not patterns:
+        return list(entries)
+    patterns = [pattern.strip("/") for pattern in patterns]
+    entries = list(entries)
+    selected = [entry for entry in entries if matches(entry.path, patterns)]
+    folders = set()
+    for entry in selected:
+        path = entry.path
+        while "/" in path:
+            path = path.rsplit("/", 1)[0]
+            folders.add(path)
+    chosen = {entry.path for entry in selected}
+    return selected + [entry for entry in entries if entry.path in folders and entry.path not in chosen]
+
+
+def plan_streams(entries, streams):
+    """
+    Split the files of a restore into balanced streams, largest first to the lightest stream.
+
+    Folders are left out: rsync creates them for the files and a last pass gives them
+    their attributes once nothing is written into them anymore.
+
+    Returns:
+    - list: Lists of entries, one per non-empty stream.
+    - list: Folder entries.
+    """
+    files = sorted((entry for entry in entries if not stat_module.S_ISDIR(entry.mode)),
+                   key=lambda entry: entry.size, reverse=True)
+    folders = [entry for entry in entries if stat_module.S_ISDIR(entry.mode)]
+    plan = [[] for _ in range(max(1, min(streams, len(files))))]
+    loads = [0] * len(plan)
+    for entry in files:
+        lightest = loads.index(min(loads))
+        plan[lightest].append(entry)
+        loads[lightest] += entry.size + PER_FILE_COST
+    return [stream for stream in plan if stream], folders
+
+
+class RestoreProgress:
+    """
+    Aggregate the progress of every stream and log throughput and ETA.
+
+    Each stream reports the completed share of its own bytes (--info=progress2), so
+    files already restored by an interrupted run count as done.
+    """
+
+    def __init__(self, total_bytes, interval=5.0):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.done = {}
+        self.rates = {}
+        self.start = time.monotonic()
+        self._last_log = 0.0
+
+    def stream(self, index, stream_bytes):
+        def on_event(event):
+            if isinstance(event, ProgressEvent):
+                self.done[index] = stream_bytes * event.percent / 100
+                self.rates[index] = event.rate
+                now = time.monotonic()
+                if now - self._last_log >= self.interval:
+                    self._last_log = now
+                    self.log()
+        return on_event
+
+    def finish_stream(self, index, stream_bytes):
+        self.done[index] = stream_bytes
+        self.rates[index] = 0.0
+
+    def log(self):
+        done = sum(self.done.values())
+        rate = sum(self.rates.values())
+        eta = (self.total_bytes - done) / rate if rate else None
+        logger.info(f"Restore: {done / max(self.total_bytes, 1):.0%} of {self.total_bytes} bytes, "
+                    f"{rate / 1024 ** 2:.1f} MB/s, ETA "
+                    f"{datetime.timedelta(seconds=int(eta)) if eta is not None else 'unknown'}")
+
+
+async def restore_snapshot_async(session, snapshot_dir, target_dir, patterns=None, streams=4, manifest_dir=None,
+                                 state_path=None):
+    """
+    Copy a snapshot, or the paths selected by patterns, back to a local folder.
+
+    The selected files are split into size balanced rsync streams pulling in parallel
+    over the SSH session. Partially transferred files are kept in the rsync partial
+    folder and finished streams are recorded in state_path, so running the same
+    restore again resumes it.
+
+    Args:
+    - session (SSHSession): Open session to the remote host.
+    - snapshot_dir (str): Remote snapshot to restore.
+    - target_dir (str): Local folder the snapshot content is written into.
+    - patterns (list): Paths or globs relative to the snapshot, None for everything.
+    - streams (int): Parallel rsync streams.
+    - manifest_dir (str): Local manifests of the configuration, to avoid a remote listing.
+    - state_path (str): JSON file recording the finished streams of the restore.
+
+    Returns:
+    - int: 0 on success, otherwise the first non-zero rsync exit code.
+    """
+    entries = select_entries(await list_snapshot(session, snapshot_dir, manifest_dir), patterns)
+    if not entries:
+        logger.info(f"Nothing in {snapshot_dir} matches {patterns}")
+        return 0
+    plan, folders = plan_streams(entries, streams)
+    sizes = [sum(entry.size for entry in stream) for stream in plan]
+    total = sum(sizes)
+    logger.info(f"Restoring {sum(map(len, plan))} files ({total} bytes) of {snapshot_dir} to {target_dir} "
+                f"in {len(plan)} streams")
+
+    # Same snapshot, selection and stream count give the same plan, so its finished streams can be skipped
+    key = hashlib.blake2b(json.dumps([snapshot_dir, os.path.abspath(target_dir), sorted(patterns or []), streams])
+                          .encode(), digest_size=16).hexdigest()
+    finished = set()
+    if state_path and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get("key") == key:
+            finished = set(state.get("finished", []))
+            logger.info(f"Resuming the restore, {len(finished)} of {len(plan)} streams already finished")
+
+    def save_state():
+        if state_path:
+            with open(state_path, "w") as f:
+                json.dump({"key": key, "finished": sorted(finished)}, f)
+
+    os.makedirs(target_dir, exist_ok=True)
+    source = f"{session.target}:{snapshot_dir.rstrip('/')}/"
+    rsync_base = ["rsync", "-a", "--info=progress2", "--stats", f"--partial-dir={PARTIAL_DIR}",
+                  "-e", session.rsync_rsh()]
+    progress = RestoreProgress(total)
+
+    async def run_stream(index, stream):
+        if index in finished:
+            progress.finish_stream(index, sizes[index])
+            return 0
+        files_from = write_files_from([entry.path for entry in stream])
+        try:
+            exit_code = await run_rsync(rsync_base + files_from_args(files_from) + [source, target_dir],
+                                        on_event=progress.stream(index, sizes[index]))
+        finally:
+            os.remove(files_from)
+        if exit_code == 0:
+            progress.finish_stream(index, sizes[index])
+            finished.add(index)
+            save_state()
+        return exit_code
+
+    save_state()
+    exit_codes = await asyncio.gather(*(run_stream(index, stream) for index, stream in enumerate(plan)))
+    failed = [exit_code for exit_code in exit_codes if exit_code != 0]
+    if failed:
+        logger.error(f"Restore incomplete, run it again to resume ({len(finished)} of {len(plan)} streams done)")
+        return failed[0]
+
+    if folders:
+        # Folder permissions and mtimes, after every file was written into them
+        files_from = write_files_from([entry.path for entry in folders])
+        try:
+            exit_code = await run_rsync(rsync_base + ["--dirs"] + files_from_args(files_from) + [source, target_dir])
+        finally:
+            os.remove(files_from)
+        if exit_code != 0:
+            return exit_code
+
+    elapsed = time.monotonic() - progress.start
+    logger.info(f"Restore completed: {total} bytes in {elapsed:.1f}s ({total / max(elapsed, 1e-9) / 1024 ** 2:.1f} MB/s)")
+    if state_path and os.path.exists(state_path):
+        os.remove(state_path)
+    return 0
+
+
+def restore_snapshot(*args, **kwargs):
+    """Blocking restore_snapshot_async."""
+    return asyncio.run(restore_snapshot_async(*args, **kwargs))
@@ -0,0 +1,160 @@
+# ============================================================
+#
+#  Easy backup
+#  Snapshot Retention Engine
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import asyncio
+import datetime
+import os
+import shlex
+from utils.manifest import REMOTE_MANIFEST_DIR, MANIFEST_SUFFIX
+from utils.logger import logger  # Import the shared logger
+
+# Name of the dated snapshot directories created by run_incremental_backup
+SNAPSHOT_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+# Snapshots are moved here before the slow rm -rf, so they disappear from listings at once
+TRASH_DIR = ".easybackup-trash"
+
+# GFS rules: bucket of a snapshot time for each rule
+GFS_BUCKETS = {
+    "keep_daily": lambda when: when.date(),
+    "keep_weekly": lambda when: when.isocalendar()[:2],
+    "keep_monthly": lambda when: (when.year, when.month),
+}
+
+
+def parse_snapshot_name(name):
+    """
+    Return the timestamp encoded in a snapshot name, or None if name is not a snapshot.
+    """
+    try:
+        return datetime.datetime.strptime(name, SNAPSHOT_FORMAT)
+    except ValueError:
+        return None
+
+
+def plan_retention(names, now=None, keep_days=None, keep_last=None, keep_daily=None, keep_weekly=None,
+                   keep_monthly=None, protected=()):
+    """
+    Decide which snapshots to keep from their names only.
+
+    A snapshot is kept if any rule keeps it:
+    - keep_days: younger than keep_days days.
+    - keep_last: one of the keep_last newest snapshots.
+    - keep_daily / keep_weekly / keep_monthly: newest snapshot of each of the N most
+      recent days / ISO weeks / months that have snapshots (grandfather-father-son).
+    Names that are not snapshots are ignored and protected names (the "latest" target)
+    are always kept. Without any rule every snapshot is kept.
+
+    Args:
+    - names (list): Directory names found under remote_path.
+    - now (datetime): Reference time for keep_days, now by default.
+    - protected (iterable): Snapshot names that must never be deleted.
+
+    Returns:
+    - list: Snapshot names to keep, newest first.
+    - list: Snapshot names to delete, oldest first.
+    """
+    now = now or datetime.datetime.now()
+    snapshots = sorted(((parse_snapshot_name(name), name) for name in names if parse_snapshot_name(name)),
+                       reverse=True)
+
+    rules = {"keep_daily": keep_daily, "keep_weekly": keep_weekly, "keep_monthly": keep_monthly}
+    if keep_days is None and keep_last is None and not any(rules.values()):
+        return [name for _, name in snapshots], []
+
+    keep = set(protected)
+    if keep_last:
+        keep.update(name for _, name in snapshots[:int(keep_last)])
+    if keep_days is not None:
+        cutoff = now - datetime.timedelta(days=int(keep_days))
+        keep.update(name for when, name in snapshots if when >= cutoff)
+
+    for rule, count in rules.items():
+        if not count:
+            continue
+        buckets = set()
+        for when, name in snapshots:
+            bucket = GFS_BUCKETS[rule](when)
+            if bucket in buckets:
+                continue
+            if len(buckets) >= int(count):
+                break
+            buckets.add(bucket)
+            keep.add(name)
+
+    kept = [name for _, name in snapshots if name in keep]
+    deleted = [name for _, name in reversed(snapshots) if name not in keep]
+    return kept, deleted
+
+
+def delete_snapshots_cmd(remote_path, names, parallel=4, background=True):
+    """
+    Build the single remote command deleting snapshots.
+
+    The snapshots are first renamed into TRASH_DIR (instant, same file system), then the
+    trash is removed with parallel rm -rf workers, detached from the SSH session when
+    background is True so the next job does not wait for millions of unlinks. The
+    manifests of the snapshots are removed with them.
+
+    Each snapshot gets its own "<name>.<timestamp>" entry in the trash: a copy of the
+    same snapshot left there by an interrupted prune can not block the rename.
+    """
+    stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+    moves = " && ".join(f"mv -- {shlex.quote(name)} {shlex.quote(f'{TRASH_DIR}/{name}.{stamp}')}" for name in names)
+    manifests = " ".join(shlex.quote(f"{REMOTE_MANIFEST_DIR}/{name}{MANIFEST_SUFFIX}") for name in names)
+    move = f"cd {shlex.quote(remote_path)} && mkdir -p {TRASH_DIR} && {moves} && rm -f -- {manifests}"
+    # Also picks up anything left in the trash by an interrupted earlier prune
+    remove = f"cd {TRASH_DIR} && find . -mindepth 1 -maxdepth 1 -print0 | xargs -0 -r -n 1 -P {int(parallel)} rm -rf --"
+    if background:
+        remove = f"nohup sh -c {shlex.quote(remove)} </dev/null >/dev/null 2>&1 &"
+    return f"{move} && {remove}"
+
+
+def apply_retention(session, remote_path, protected=(), dry_run=False, parallel=4, background=True, **rules):
+    """Blocking apply_retention_async."""
+    return asyncio.run(apply_retention_async(session, remote_path, protected=protected, dry_run=dry_run,
+                                             parallel=parallel, background=background, **rules))
+
+
+async def apply_retention_async(session, remote_path, protected=(), dry_run=False, parallel=4, background=True,
+                                **rules):
+    """
+    List the snapshots of remote_path once, plan the deletions locally and run them in one command.
+
+    Args:
+    - session (SSHSession): Open session to the remote host.
+    - remote_path (str): Remote backup directory.
+    - protected (iterable): Snapshot names that must never be deleted (the "latest" target).
+    - dry_run (bool): Only report what would be deleted.
+    - parallel (int): rm -rf workers.
+    - background (bool): Do not wait for the deletion to finish.
+    - rules: keep_days, keep_last, keep_daily, keep_weekly, keep_monthly (see plan_retention).
+
+    Returns:
+    - list: Snapshot names to keep.
+    - list: Snapshot names deleted (or that would be deleted on a dry run).
+    """
+    listing = await session.check_output_async(f"ls -1A {shlex.quote(remote_path)}")
+    names = listing.splitlines()
+    protected = {os.path.basename(path.rstrip("/")) for path in protected if path}
+
+    kept, deleted = plan_retention(names, protected=protected, **rules)
+
+    prefix = "[dry run] " if dry_run else ""
+    logger.info(f"{prefix}Retention of {remote_path}: keeping {len(kept)}, deleting {len(deleted)} snapshot(s)")
+    for name in deleted:
+        logger.info(f"{prefix}Deleting snapshot {name}")
+
+    if deleted and not dry_run:
+        await session.run_async(delete_snapshots_cmd(remote_path, deleted, parallel=parallel, background=background),
+                                check=True)
+
+    return kept, deleted
@@ -0,0 +1,202 @@
+# ============================================================
+#
+#  Easy backup
+#  Streaming Rsync Progress Parser
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import asyncio
+import re
+from collections import deque, namedtuple
+from utils.async_process import terminate
+
+# Progress record, e.g. "    10,220,696   0%  522.43kB/s    0:00:19 (xfr#1772, ir-chk=1389/18955)"
+# The "(xfr#..)" part is only printed once a file has been transferred.
+PROGRESS_RE = re.compile(rb"\s*(\d[\d,]*)\s+(\d+)%\s+([\d.]+)([kMGT]?)B/s\s+(\d+:\d\d:\d\d)"
+                         rb"(?:\s+\(xfr#(\d+),\s*(?:ir|to)-chk=(\d+)/(\d+)\))?")
+
+# --stats totals, e.g. "Total transferred file size: 1,234 bytes"
+STATS_RE = re.compile(rb"(Number of files|Number of created files|Number of deleted files|"
+                      rb"Number of regular files transferred|Total file size|Total transferred file size|"
+                      rb"Literal data|Matched data|File list size|File list generation time|"
+                      rb"File list transfer time|Total bytes sent|Total bytes received): ([\d,.]+)")
+
+# Itemized entry printed with --out-format="%i %l %M %B %n", e.g.
+# ">f.st...... 1234 2024/01/02-03:04:05 rw-r--r-- docs/report.pdf". The flags are 11
+# characters wide, an unchanged entry listed by -ii shows spaces (".f          ").
+ITEM_RE = re.compile(rb"([<>ch.][fdLDS][-a-zA-Z.+? ]{9}|\*deleting  ) (\d+) (\d{4}/\d\d/\d\d-\d\d:\d\d:\d\d) (\S{9,10}) (.+)")
+
+# Lines rsync prints around the file list that are not file names
+SUMMARY_PREFIXES = (b"sending incremental file list", b"receiving incremental file list",
+                    b"sent ", b"total size is ", b"building file list", b"created directory ",
+                    b"deleting ", b"cannot delete ", b"skipping ", b"done")
+
+RATE_UNITS = {b"": 1, b"k": 1024, b"M": 1024 ** 2, b"G": 1024 ** 3, b"T": 1024 ** 4}
+
+CHUNK_SIZE = 64 * 1024
+
+# Typed events emitted by the parser
+ProgressEvent = namedtuple("ProgressEvent", ["bytes", "percent", "rate", "elapsed", "xfr",
+                                             "files_remaining", "files_total"])
+FileEvent = namedtuple("FileEvent", ["name"])
+MessageEvent = namedtuple("MessageEvent", ["text"])
+StatsEvent = namedtuple("StatsEvent", ["key", "value"])
+ItemEvent = namedtuple("ItemEvent", ["flags", "size", "mtime", "perms", "name"])
+
+
+def iter_records(stream):
+    """
+    Split a binary stream into records on both "\\r" and "\\n", reading big chunks.
+
+    --info=progress2 rewrites its status line with "\\r", so reading lines would
+    mostly return huge run-on lines.
+
+    Args:
+    - stream: Binary file object, e.g. process.stdout opened without text=True.
+
+    Yields:
+    - bytes: Non-empty records without separators.
+    """
+    pending = b""
+    read = getattr(stream, "read1", stream.read)
+    while True:
+        chunk = read(CHUNK_SIZE)
+        if not chunk:
+            break
+        records, pending = split_records(pending, chunk)
+        yield from records
+    if pending:
+        yield pending
+
+
+def split_records(pending, chunk):
+    """
+    Split pending + chunk on "\r" and "\n".
+
+    Returns:
+    - list: Complete non-empty records.
+    - bytes: Trailing partial record, to prepend to the next chunk.
+    """
+    records = (pending + chunk).replace(b"\r", b"\n").split(b"\n")
+    pending = records.pop()
+    return [record for record in records if record], pending
+
+
+async def aiter_records(stream):
+    """iter_records for an asyncio.StreamReader."""
+    pending = b""
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        records, pending = split_records(pending, chunk)
+        for record in records:
+            yield record
+    if pending:
+        yield pending
+
+
+def parse_record(record):
+    """
+    Classify one rsync output record in a single pass.
+
+    Args:
+    - record (bytes): One record from iter_records.
+
+    Returns:
+    - ProgressEvent, FileEvent, ItemEvent, StatsEvent or MessageEvent.
+    """
+    # rsync indents progress records and prints file names from the first column
+    if record[:1] in (b" ", b"\t"):
+        match = PROGRESS_RE.match(record)
+        if match:
+            transferred, percent, rate, unit, elapsed, xfr, remaining, total = match.groups()
+            return ProgressEvent(bytes=int(transferred.replace(b",", b"")),
+                                 percent=int(percent),
+                                 rate=float(rate) * RATE_UNITS[unit],
+                                 elapsed=elapsed.decode(),
+                                 xfr=int(xfr) if xfr else 0,
+                                 files_remaining=int(remaining) if remaining else None,
+                                 files_total=int(total) if total else None)
+        return MessageEvent(record.decode(errors="replace").strip())
+
+    match = STATS_RE.match(record)
+    if match:
+        key = match.group(1).decode().lower().replace("number of ", "").replace(" ", "_")
+        value = match.group(2).replace(b",", b"")
+        return StatsEvent(key, float(value) if b"." in value else int(value))
+
+    match = ITEM_RE.fullmatch(record)
+    if match:
+        flags, size, mtime, perms, name = match.groups()
+        return ItemEvent(flags.decode().rstrip(), int(size), mtime.decode(), perms.decode(),
+                         name.decode(errors="surrogateescape"))
+
+    if record.startswith(SUMMARY_PREFIXES):
+        return MessageEvent(record.decode(errors="replace"))
+    return FileEvent(record.decode(errors="surrogateescape"))
+
+
+def iter_events(stream):
+    """
+    Yield the typed events of an rsync stdout stream.
+    """
+    for record in iter_records(stream):
+        yield parse_record(record)
+
+
+async def drain_stream(stream, tail):
+    """Read an asyncio stream to the end keeping only its last lines in tail (a bounded deque)."""
+    async for record in aiter_records(stream):
+        tail.append(record.decode(errors="replace"))
+
+
+async def stream_rsync_async(rsync_cmd, on_event=None, stderr_lines=50):
+    """
+    Run rsync and feed its progress as typed events to a subscriber.
+
+    stdout and stderr are read concurrently, so rsync can never block on a full pipe.
+    When the calling task is cancelled (or a timeout expires around it) rsync is killed.
+
+    Args:
+    - rsync_cmd (list): rsync argv.
+    - on_event (callable): Called with every ProgressEvent, FileEvent, StatsEvent and MessageEvent.
+    - stderr_lines (int): Number of stderr lines kept for error reporting.
+
+    Returns:
+    - int: rsync's exit code.
+    - list: Last stderr lines.
+    """
+    process = await asyncio.create_subprocess_exec(*rsync_cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    stderr_tail = deque(maxlen=stderr_lines)
+    stderr_task = asyncio.ensure_future(drain_stream(process.stderr, stderr_tail))
+
+    try:
+        async for record in aiter_records(process.stdout):
+            if on_event is not None:
+                on_event(parse_record(record))
+        await stderr_task
+        await process.wait()
+    except BaseException:
+        stderr_task.cancel()
+        await terminate(process)
+        raise
+
+    return process.returncode, list(stderr_tail)
+
+
+def stream_rsync(rsync_cmd, on_event=None, stderr_lines=50):
+    """
+    Blocking stream_rsync_async, for callers outside an event loop.
+
+    Returns:
+    - int: rsync's exit code.
+    - list: Last stderr lines.
+    """
+    return asyncio.run(stream_rsync_async(rsync_cmd, on_event=on_event, stderr_lines=stderr_lines))
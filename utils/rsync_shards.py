@@ -0,0 +1,145 @@
+# ============================================================
+#
+#  Easy backup
+#  Sharded Rsync Planning
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import os
+import tempfile
+
+# Per-file cost expressed in bytes, so trees of many tiny files weigh more than their raw size
+PER_FILE_COST = 64 * 1024
+
+
+def estimate_entry_weight(path):
+    """
+    Estimate the rsync cost of a top-level entry from its total size and file count.
+
+    Args:
+    - path (str): File or directory to measure.
+
+    Returns:
+    - int: Size in bytes plus PER_FILE_COST for every file found.
+    """
+    weight = 0
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            stat = os.lstat(current)
+        except OSError:
+            continue
+        weight += stat.st_size + PER_FILE_COST
+        if os.path.isdir(current) and not os.path.islink(current):
+            try:
+                with os.scandir(current) as entries:
+                    stack.extend(entry.path for entry in entries)
+            except OSError:
+                continue
+    return weight
+
+
+def split_source(local_path):
+    """
+    Split local_path the way rsync reads it.
+
+    With a trailing slash rsync copies the contents of the directory, without it the
+    directory itself is created inside the destination.
+
+    Returns:
+    - str: Directory the shard file lists are relative to (rsync source argument).
+    - str: Prefix of every shard entry ("" or the directory name followed by "/").
+    """
+    if local_path.endswith("/"):
+        return local_path, ""
+    source_root = os.path.abspath(local_path)
+    return os.path.dirname(source_root) + "/", os.path.basename(source_root) + "/"
+
+
+def plan_shards(local_path, shard_count):
+    """
+    Split the top-level entries of local_path into balanced shards.
+
+    Entries are assigned largest first to the currently lightest shard, using the
+    estimated size plus file count of each entry.
+
+    Args:
+    - local_path (str): Local source directory.
+    - shard_count (int): Maximum number of shards.
+
+    Returns:
+    - list: Lists of paths relative to the rsync source directory (see split_source),
+            one list per non-empty shard. Empty if local_path has no entries.
+    """
+    source_root = os.path.abspath(local_path)
+    try:
+        entries = sorted(os.listdir(source_root))
+    except OSError:
+        return []
+
+    _, prefix = split_source(local_path)
+    weighted = sorted(((estimate_entry_weight(os.path.join(source_root, entry)), entry) for entry in entries),
+                      reverse=True)
+
+    shards = [[] for _ in range(max(1, min(shard_count, len(entries))))]
+    loads = [0] * len(shards)
+    for weight, entry in weighted:
+        lightest = loads.index(min(loads))
+        shards[lightest].append(prefix + entry)
+        loads[lightest] += weight
+
+    return [sorted(shard) for shard in shards if shard]
+
+
+def write_files_from(shard):
+    """
+    Write a shard to a temporary file for rsync's --files-from. The caller removes it.
+
+    Entries are NUL separated, so names holding a newline stay one entry. Pass the
+    list to rsync with files_from_args.
+
+    Returns:
+    - str: Path of the file list.
+    """
+    fd, path = tempfile.mkstemp(prefix="easybackup_shard_", suffix=".lst")
+    with os.fdopen(fd, "wb") as f:
+        for entry in shard:
+            f.write(os.fsencode(entry) + b"\0")
+    return path
+
+
+def files_from_args(path):
+    """rsync options reading the NUL separated list written by write_files_from."""
+    return ["--from0", f"--files-from={path}"]
+
+
+def delete_extraneous_cmd(local_path, rsync_rsh, destination):
+    """
+    Build the rsync command removing the top-level entries of a snapshot that no longer
+    exist in the source, without transferring anything.
+
+    Each shard only deletes inside its own entries, so a top-level entry deleted from the
+    source while a snapshot was interrupted would survive the resumed sharded run.
+    """
+    source_dir, prefix = split_source(local_path)
+    # --existing with --ignore-existing skips every transfer, --dirs limits --delete to the root
+    return ["rsync", "--dirs", "--delete", "--existing", "--ignore-existing", "-e", rsync_rsh,
+            source_dir + prefix, f"{destination.rstrip('/')}/{prefix}"]
+
+
+def root_attributes_cmd(local_path, rsync_rsh, destination):
+    """
+    Build the rsync command copying only the attributes of the source root directory.
+
+    Shards never carry the root directory itself, so this last pass gives the snapshot
+    the same root permissions, owner and mtime as a single-stream run.
+    """
+    rsync_cmd = ["rsync", "--dirs", "-lptgoD", "-e", rsync_rsh]
+    if local_path.endswith("/"):
+        rsync_cmd.append("--exclude=/*")
+    return rsync_cmd + [local_path, destination]
@@ -0,0 +1,284 @@
+# ============================================================
+#
+#  Easy backup
+#  Scheduler Daemon
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import datetime
+import json
+import os
+import random
+import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.cmd_credentials_management import probe_targets
+from utils.concurrent_runner import _run_job, config_down, config_hosts, local_disk_id
+from utils.credentials_management import load_backup_configs, BACKUP_FILE, is_config_active, as_int
+from utils.easybackup_core import CONNECT_FAILURE_EXIT_CODE
+from utils.host_probe import ReachabilityCache, DEFAULT_TTL
+from utils.state import config_state_path
+from utils.logger import logger  # Import the shared logger
+
+INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+CRON_ALIASES = {"@hourly": "0 * * * *", "@daily": "0 0 * * *", "@midnight": "0 0 * * *",
+                "@weekly": "0 0 * * 0", "@monthly": "0 0 1 * *"}
+# minute, hour, day of month, month, day of week (0 and 7 are Sunday)
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+class IntervalSchedule:
+    """Run every fixed number of seconds after the previous run started."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next_after(self, when):
+        return when + datetime.timedelta(seconds=self.seconds)
+
+
+class CronSchedule:
+    """
+    Numeric 5-field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields accept *, values, ranges (a-b), lists (a,b) and steps (*/n, a-b/n). As in
+    cron, when both day fields are restricted a day matching either one matches.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"A cron expression needs 5 fields: {expression}")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS))
+        self.weekdays = {day % 7 for day in self.weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(","):
+            span, _, step = part.partition("/")
+            if span == "*":
+                start, end = low, high
+            elif "-" in span:
+                start, end = (int(bound) for bound in span.split("-"))
+            else:
+                start = int(span)
+                end = high if step else start  # "a/n" steps from a to the end of the range
+            if not low <= start <= end <= high:
+                raise ValueError(f"Cron field {field} out of range {low}-{high}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, when):
+        day = when.day in self.days
+        weekday = (when.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, when):
+        """Return the first matching minute strictly after when."""
+        t = when.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = t + datetime.timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError("The cron expression never matches")
+
+
+def parse_schedule(text):
+    """
+    Parse the schedule of a configuration.
+
+    Accepted forms: an interval ("3600", "30m", "6h", "1d", "1w"), a 5-field cron
+    expression ("0 2 * * *") or an alias (@hourly, @daily, @weekly, @monthly).
+
+    Returns:
+    - IntervalSchedule or CronSchedule, None if text is empty.
+    """
+    text = (text or "").strip()
+    if not text or text.lower() == "none":
+        return None
+    text = CRON_ALIASES.get(text.lower(), text)
+    match = re.fullmatch(r"(\d+)\s*([smhdw]?)", text.lower())
+    if match:
+        return IntervalSchedule(int(match.group(1)) * INTERVAL_UNITS[match.group(2) or "s"])
+    return CronSchedule(text)
+
+
+class ScheduleState:
+    """
+    Per-config scheduling state, kept across daemon restarts so missed runs are caught up.
+
+    - last_run: start time of the last run that was not an SSH failure.
+    - failures: consecutive SSH failures, driving the exponential backoff.
+    - retry_at: time of the next attempt after an SSH failure.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_run = self.retry_at = None
+        self.failures = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.last_run = datetime.datetime.fromisoformat(state["last_run"]) if state.get("last_run") else None
+            self.retry_at = datetime.datetime.fromisoformat(state["retry_at"]) if state.get("retry_at") else None
+            self.failures = state.get("failures", 0)
+
+    def save(self):
+        state = {"last_run": self.last_run.isoformat(timespec="seconds") if self.last_run else None,
+                 "retry_at": self.retry_at.isoformat(timespec="seconds") if self.retry_at else None,
+                 "failures": self.failures}
+        with open(self.path, "w") as f:
+            json.dump(state, f)
+
+    def due(self, schedule):
+        """
+        Return when the config should run next. A never run config, or one whose next
+        slot passed while the daemon was not running, is due now (one catch-up run).
+        """
+        if self.retry_at:
+            return self.retry_at
+        if self.last_run is None:
+            return datetime.datetime.now()
+        return schedule.next_after(self.last_run)
+
+
+def vault_mtime():
+    try:
+        return os.stat(BACKUP_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_schedules():
+    """Return {name: (config, schedule)} for the active configs that have a schedule."""
+    scheduled = {}
+    for config in load_backup_configs(backup_file=BACKUP_FILE).values():
+        if not is_config_active(config):
+            continue
+        try:
+            schedule = parse_schedule(config.get("schedule"))
+        except ValueError as e:
+            logger.error(f"Ignoring the schedule of {config['name']}: {e}")
+            continue
+        if schedule:
+            scheduled[config["name"]] = (config, schedule)
+    return scheduled
+
+
+def run_scheduler(max_workers=4, per_host_limit=1, per_disk_limit=1, jitter=300, poll=30, backoff_base=60,
+                  backoff_max=21600, probe_ttl=DEFAULT_TTL):
+    """
+    Run every active, scheduled configuration from one long-lived process.
+
+    Each config runs on its own interval or cron schedule, delayed by a random jitter
+    so jobs do not all hit the same NAS at once. A job is started when a global worker
+    slot and slots for each of its destination hosts and its local disk are free. Runs that failed to
+    reach the host are retried with exponential backoff, and slots missed while the
+    daemon was stopped are caught up with one run. The hosts of the due jobs are probed
+    together before they start (see host_probe), and jobs whose hosts are all down are
+    deferred until the probe result expires instead of waiting for their own timeouts.
+    The vault is only decrypted again when the file changes.
+
+    Args:
+    - max_workers (int): Cap of jobs running at once.
+    - per_host_limit (int): Cap of jobs running at once against the same remote host.
+    - per_disk_limit (int): Cap of jobs running at once reading from the same local disk.
+    - jitter (int): Maximum random delay in seconds, unless the config sets schedule_jitter.
+    - poll (int): Seconds between two checks of the vault and the schedule.
+    - backoff_base (int): Delay in seconds after the first SSH failure, doubled for each further one.
+    - backoff_max (int): Longest delay between two attempts.
+    - probe_ttl (int): Seconds a host probe result is reused, 0 (or None) to not probe.
+    """
+    scheduled = None
+    loaded_mtime = None
+    planned = {}
+    running = {}
+    host_slots = Counter()
+    disk_slots = Counter()
+    states = {}
+    cache = ReachabilityCache(ttl=probe_ttl) if probe_ttl else None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            mtime = vault_mtime()
+            if scheduled is None or mtime != loaded_mtime:
+                scheduled = load_schedules()
+                loaded_mtime = mtime
+                states = {name: states.get(name) or ScheduleState(config_state_path(name, "schedule.json"))
+                          for name in scheduled}
+                planned.clear()
+                logger.info(f"Loaded {len(scheduled)} scheduled backup configuration(s)")
+
+            now = datetime.datetime.now()
+            busy = {config["name"] for config, _, _, _ in running.values()}
+            for name, (config, schedule) in scheduled.items():
+                if name not in busy and name not in planned:
+                    config_jitter = as_int(config.get("schedule_jitter"))
+                    delay = random.uniform(0, jitter if config_jitter is None else config_jitter)
+                    planned[name] = states[name].due(schedule) + datetime.timedelta(seconds=delay)
+                    logger.info(f"Next run of {name}: {planned[name].isoformat(timespec='seconds')}")
+
+            due = [name for name in scheduled if name not in busy and planned[name] <= now]
+            if due and cache is not None:
+                # Every due host at once, so powered-off ones cost one probe timeout per TTL
+                cache.refresh(probe_targets([scheduled[name][0] for name in due]))
+            for name in due:
+                config = scheduled[name][0]
+                if cache is not None and config_down(config, cache):
+                    retry = max(cache.expires(host, port) for host, port, _, _ in probe_targets([config]))
+                    planned[name] = datetime.datetime.fromtimestamp(retry)
+                    logger.info(f"{name}: {config['remote_host']} is unreachable, deferred to "
+                                f"{planned[name].isoformat(timespec='seconds')}")
+                    continue
+                if len(running) >= max_workers:
+                    continue
+                hosts, disk = config_hosts(config), local_disk_id(config["local_path"])
+                if any(host_slots[host] >= per_host_limit for host in hosts) or disk_slots[disk] >= per_disk_limit:
+                    continue
+                host_slots.update(hosts)
+                disk_slots[disk] += 1
+                logger.info(f"Starting scheduled backup {name}")
+                running[executor.submit(_run_job, config)] = (config, hosts, disk, now)
+
+            done, _ = wait(running, timeout=poll, return_when=FIRST_COMPLETED) if running else (set(), None)
+            if not running:
+                next_run = min(planned.values(), default=None)
+                seconds = poll if next_run is None else (next_run - datetime.datetime.now()).total_seconds()
+                time.sleep(min(poll, max(1, seconds)))
+
+            for future in done:
+                config, hosts, disk, started = running.pop(future)
+                host_slots.subtract(hosts)
+                disk_slots[disk] -= 1
+                result = future.result()
+                name = config["name"]
+                state = states.get(name) or ScheduleState(config_state_path(name, "schedule.json"))
+                if result["exit_code"] == CONNECT_FAILURE_EXIT_CODE:
+                    state.failures += 1
+                    delay = min(backoff_max, backoff_base * 2 ** (state.failures - 1))
+                    state.retry_at = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+                    logger.info(f"{name}: host unreachable ({state.failures} in a row), retrying in {delay} s")
+                else:
+                    state.last_run, state.failures, state.retry_at = started, 0, None
+                    logger.info(f"{name}: {result['status']} in {result['wall_time']:.1f} s")
+                state.save()
+                planned.pop(name, None)
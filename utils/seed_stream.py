@@ -0,0 +1,58 @@
+# ============================================================
+#
+#  Easy backup
+#  First Backup Seeding (tar stream)
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import shlex
+from utils.async_process import run_pipeline
+from utils.rsync_shards import split_source
+from utils.logger import logger  # Import the shared logger
+
+# Compressor argv (local side) and decompressor command (remote side)
+COMPRESSORS = {
+    "zstd": (lambda level: ["zstd", "-T0", f"-{level or 3}", "-q", "-c"], "zstd -d -q -c"),
+    "lz4": (lambda level: ["lz4", f"-{level or 1}", "-q", "-c"], "lz4 -d -q -c"),
+}
+
+
+async def seed_snapshot(session, local_path, new_backup, compression="zstd", level=None):
+    """
+    Copy local_path into an empty snapshot as one tar stream over a single SSH channel.
+
+    For a first backup of many small files this is much faster than rsync's per-file
+    negotiation. The caller still runs rsync afterwards as a consistency pass, which
+    then only compares metadata.
+
+    Args:
+    - session (SSHSession): Open session to the remote host.
+    - local_path (str): Local source directory (same trailing slash rules as rsync).
+    - new_backup (str): Remote snapshot directory, created if missing.
+    - compression (str): "zstd", "lz4" or "none".
+    - level (int): Compression level, the compressor default if None.
+
+    Returns:
+    - int: 0 on success, otherwise the first failing exit code of tar, the compressor or the remote side.
+    """
+    source_dir, prefix = split_source(local_path)
+    tar_cmd = ["tar", "-C", source_dir, "-cf", "-", prefix.rstrip("/") or "."]
+
+    compressor, decompressor = COMPRESSORS.get(compression, (None, None))
+    extract = f"mkdir -p {shlex.quote(new_backup)} && cd {shlex.quote(new_backup)} && "
+    extract += f"{decompressor} | tar -xpf -" if decompressor else "tar -xpf -"
+
+    logger.info(f"Seeding {new_backup} with a tar stream ({compression or 'none'} compression)")
+
+    commands = [tar_cmd] + ([compressor(level)] if compressor else []) + [session.ssh_command() + [extract]]
+    session.commands += 1
+    exit_codes = await run_pipeline(commands)
+    failed = [exit_code for exit_code in exit_codes if exit_code != 0]
+    if failed:
+        logger.error(f"Seeding failed, exit codes (tar, compressor, remote): {exit_codes}")
+        return failed[0]
+    return 0
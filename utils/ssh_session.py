@@ -0,0 +1,208 @@
+# ============================================================
+#
+#  Easy backup
+#  Multiplexed SSH Session
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import asyncio
+import os
+import shlex
+import shutil
+import tempfile
+import time
+from utils.async_process import run_process
+from utils.logger import logger  # Import the shared logger
+
+
+class SSHSession:
+    """
+    One multiplexed SSH connection (OpenSSH ControlMaster) per backup job.
+
+    The master connection is authenticated once in open(). Every remote command
+    run through the session, and every rsync using rsync_rsh() as its "-e"
+    transport, is multiplexed over that master, so the job pays for a single
+    handshake, key exchange and sshpass authentication.
+
+    Every command runs through an asyncio subprocess (argv, no local shell) with
+    an optional timeout; the blocking methods wrap the async ones for callers
+    outside an event loop.
+
+    Usage:
+        with SSHSession(remote_host, ssh_port, ssh_user, ssh_password) as session:
+            success, message = session.open()
+            ...
+        async with SSHSession(...) as session:
+            success, message = await session.open_async()
+    """
+
+    def __init__(self, remote_host, ssh_port=22, ssh_user=None, ssh_password=None, timeout=5):
+        self.remote_host = remote_host
+        self.ssh_port = ssh_port
+        self.ssh_user = ssh_user
+        self.ssh_password = ssh_password
+        self.timeout = timeout
+
+        self.control_dir = None
+        self.control_path = None
+        self.is_open = False
+
+        # Per-job connection statistics
+        self.handshakes = 0
+        self.handshake_time = 0.0
+        self.commands = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close_async()
+        return False
+
+    @property
+    def target(self):
+        return f"{self.ssh_user}@{self.remote_host}"
+
+    def _env(self):
+        # sshpass reads the password from $SSHPASS with "-e", so it never shows up in the process list
+        env = os.environ.copy()
+        if self.ssh_password:
+            env["SSHPASS"] = str(self.ssh_password)
+        return env
+
+    def _ssh_options(self):
+        return ["-p", str(self.ssh_port), "-o", f"ControlPath={self.control_path}"]
+
+    def ssh_command(self):
+        """
+        Return the ssh argv prefix that reuses the master connection.
+
+        Returns:
+        - list: e.g. ["ssh", "-p", "22", "-o", "ControlPath=...", "user@host"]
+        """
+        return ["ssh"] + self._ssh_options() + [self.target]
+
+    def rsync_rsh(self):
+        """
+        Return the remote shell string for rsync's "-e" option.
+
+        Returns:
+        - str: ssh command line multiplexed over the master connection.
+        """
+        return shlex.join(["ssh"] + self._ssh_options())
+
+    def open(self):
+        """Blocking open_async."""
+        return asyncio.run(self.open_async())
+
+    async def open_async(self):
+        """
+        Authenticate the master connection. This is also the connection test of the job.
+
+        Returns:
+        - bool: True if connection is successful, False otherwise.
+        - str: Error message if connection fails.
+        """
+        if not self.ssh_password:
+            return False, "Password is required when using sshpass."
+
+        self.control_dir = tempfile.mkdtemp(prefix="easybackup_ssh_")
+        # %C expands to a short hash of the connection, keeping the socket path under the unix socket limit
+        self.control_path = os.path.join(self.control_dir, "%C")
+
+        master_command = [
+            "sshpass", "-e", "ssh", "-M", "-N", "-f",
+            "-o", "ControlMaster=yes",
+            "-o", f"ConnectTimeout={self.timeout}",
+            "-o", "ServerAliveInterval=30",
+        ] + self._ssh_options() + [self.target]
+
+        start = time.monotonic()
+        try:
+            result = await run_process(master_command, timeout=self.timeout + 5, env=self._env())
+        except asyncio.TimeoutError:
+            return False, "SSH connection timed out."
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            return False, f"Unexpected error: {str(e)}"
+        finally:
+            self.handshakes += 1
+            self.handshake_time += time.monotonic() - start
+
+        if result.returncode == 0:
+            self.is_open = True
+            return True, "SSH connection successful."
+        elif "Permission denied" in result.stderr or "Authentication failed" in result.stderr:
+            return False, "Authentication failed: Incorrect username or password."
+        else:
+            return False, f"SSH connection failed: {result.stderr.strip()}"
+
+    def run(self, remote_command, check=False, input=None, timeout=None):
+        """Blocking run_async."""
+        return asyncio.run(self.run_async(remote_command, check=check, input=input, timeout=timeout))
+
+    async def run_async(self, remote_command, check=False, input=None, timeout=None):
+        """
+        Run a command on the remote host over the master connection.
+
+        stdout and stderr are read concurrently and returned, stderr is logged when
+        the command fails.
+
+        Args:
+        - remote_command (str): Command line executed by the remote shell. Quote paths with shlex.quote.
+        - check (bool): Raise subprocess.CalledProcessError on a non-zero exit code.
+        - input (str or bytes): Data sent to the remote command's stdin, e.g. many paths batched in one command.
+        - timeout (float): Seconds before the command is killed, None for no limit.
+
+        Returns:
+        - subprocess.CompletedProcess: With stdout and stderr as text.
+        """
+        self.commands += 1
+        result = await run_process(self.ssh_command() + [remote_command], input=input, timeout=timeout)
+        if result.returncode != 0 and result.stderr.strip():
+            logger.debug("Remote command failed (%s): %s", result.returncode, result.stderr.strip())
+        if check:
+            result.check_returncode()
+        return result
+
+    def check_output(self, remote_command):
+        """Blocking check_output_async."""
+        return asyncio.run(self.check_output_async(remote_command))
+
+    async def check_output_async(self, remote_command, timeout=None):
+        """
+        Run a remote command and return its stripped stdout, or "" if it failed.
+        """
+        result = await self.run_async(remote_command, timeout=timeout)
+        if result.returncode != 0:
+            return ""
+        return result.stdout.strip()
+
+    def close(self):
+        """Blocking close_async."""
+        asyncio.run(self.close_async())
+
+    async def close_async(self):
+        """
+        Tear down the master connection and its control socket. Safe to call more than once.
+        """
+        if self.is_open:
+            await run_process(["ssh"] + self._ssh_options() + ["-O", "exit", self.target])
+            self.is_open = False
+            logger.info(f"SSH session to {self.remote_host}: {self.handshakes} handshake(s) "
+                        f"in {self.handshake_time:.2f}s, {self.commands} multiplexed command(s).")
+
+        if self.control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
@@ -0,0 +1,37 @@
+# ============================================================
+#
+#  Easy backup
+#  Local State Files
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import re
+from pathlib import Path
+
+# Next to the configuration vault, which lives in the home folder too
+STATE_DIR = Path.home() / ".easybackup"
+
+
+def safe_config_name(config_name):
+    """Return config_name reduced to characters safe in file names."""
+    return re.sub(r"[^A-Za-z0-9._-]", "_", config_name) or "_"
+
+
+def config_state_path(config_name, filename):
+    """
+    Return the path of a per-config state file, creating its folder if needed.
+
+    Args:
+    - config_name (str): Backup configuration name.
+    - filename (str): State file name, e.g. "change_index.sqlite".
+
+    Returns:
+    - Path: STATE_DIR/<sanitized config name>/<filename>
+    """
+    folder = STATE_DIR / safe_config_name(config_name)
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder / filename
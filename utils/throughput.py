@@ -0,0 +1,131 @@
+# ============================================================
+#
+#  Easy backup
+#  Bandwidth and I/O Scheduling Policies
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import datetime
+import json
+import os
+import shutil
+from utils.logger import logger  # Import the shared logger
+
+IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3", "1": "1", "2": "2", "3": "3"}
+
+# Weight of the newest run in the learned link capacity
+CAPACITY_SMOOTHING = 0.3
+
+
+def parse_bandwidth_windows(text):
+    """
+    Parse time-of-day bandwidth windows.
+
+    Format: comma separated "HH:MM-HH:MM=LIMIT" entries. LIMIT is a rate in KB/s,
+    "NN%" of the learned link capacity (adaptive mode) or 0/"unlimited". Windows
+    may cross midnight, the first matching window wins.
+    e.g. "08:00-18:00=2000,18:00-22:00=50%,22:00-08:00=0"
+
+    Returns:
+    - list: (start, end, limit) tuples with datetime.time bounds and limit as
+            int KB/s, a "NN%" string or None for unlimited.
+    """
+    windows = []
+    for entry in (text or "").split(","):
+        entry = entry.strip()
+        if not entry or entry.lower() == "none":
+            continue
+        span, limit = entry.split("=")
+        start, end = (datetime.datetime.strptime(bound.strip(), "%H:%M").time() for bound in span.split("-"))
+        limit = limit.strip().lower()
+        if limit in ("0", "unlimited", "none", ""):
+            limit = None
+        elif not limit.endswith("%"):
+            limit = int(limit)
+        windows.append((start, end, limit))
+    return windows
+
+
+def window_limit(windows, when):
+    """Return the limit of the first window containing when (a datetime.time), None if none does."""
+    for start, end, limit in windows:
+        inside = start <= when < end if start <= end else (when >= start or when < end)
+        if inside:
+            return limit
+    return None
+
+
+class ThroughputPolicy:
+    """
+    Per-config bandwidth and CPU/IO priority policy for the local rsync.
+
+    - Bandwidth windows become rsync's --bwlimit for the time of day the job starts.
+    - nice and ionice wrap the local rsync process.
+    - Adaptive mode: windows given as a percentage use the link capacity learned
+      from the rsync progress rate samples of previous unthrottled runs.
+    """
+
+    def __init__(self, bandwidth_windows=None, nice=None, ionice_class=None, ionice_level=None, state_path=None):
+        self.windows = parse_bandwidth_windows(bandwidth_windows)
+        self.nice = nice
+        self.ionice_class = IONICE_CLASSES.get(str(ionice_class).lower()) if ionice_class is not None else None
+        self.ionice_level = ionice_level
+        self.state_path = state_path
+        self.state = self._load_state()
+
+    def _load_state(self):
+        if self.state_path and os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return {}
+
+    @property
+    def capacity(self):
+        """Learned link capacity in KB/s, None until an unthrottled run has been measured."""
+        return self.state.get("capacity_kbps")
+
+    def bwlimit(self, now=None):
+        """
+        Return the --bwlimit in KB/s for now, None for unlimited.
+        """
+        limit = window_limit(self.windows, (now or datetime.datetime.now()).time())
+        if isinstance(limit, str):
+            if not self.capacity:
+                logger.info("Adaptive bandwidth window but no link capacity learned yet, running unthrottled.")
+                return None
+            limit = max(1, int(self.capacity * float(limit.rstrip("%")) / 100))
+        return limit
+
+    def command_prefix(self):
+        """
+        Return the nice/ionice argv put in front of the local rsync.
+        """
+        prefix = []
+        if self.nice is not None:
+            prefix += ["nice", "-n", str(self.nice)]
+        if self.ionice_class is not None and shutil.which("ionice"):
+            prefix += ["ionice", "-c", self.ionice_class]
+            if self.ionice_level is not None and self.ionice_class != "3":
+                prefix += ["-n", str(self.ionice_level)]
+        return prefix
+
+    def learn(self, rate_p90, bwlimit):
+        """
+        Update the learned link capacity from the 90th percentile rate (bytes/s) of a run.
+
+        Throttled runs only show the limit, so they are not used.
+        """
+        if bwlimit is not None or not rate_p90 or not self.state_path:
+            return
+        observed = rate_p90 / 1024
+        capacity = self.capacity
+        capacity = observed if capacity is None else \
+            (1 - CAPACITY_SMOOTHING) * capacity + CAPACITY_SMOOTHING * observed
+        self.state["capacity_kbps"] = capacity
+        with open(self.state_path, "w") as f:
+            json.dump(self.state, f)
+        logger.info(f"Learned link capacity: {capacity:.0f} KB/s")
@@ -0,0 +1,246 @@
+# ============================================================
+#
+#  Easy backup
+#  Snapshot Integrity Verification
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import asyncio
+import datetime
+import hashlib
+import os
+import re
+import shlex
+import stat as stat_module
+import time
+from concurrent.futures import ProcessPoolExecutor
+from utils.change_index import scan_tree
+from utils.retention import parse_snapshot_name
+from utils.rsync_shards import split_source
+from utils.logger import logger  # Import the shared logger
+
+# hashlib name -> coreutils (or busybox) command computing the same digest on the remote host
+ALGORITHMS = {"sha256": "sha256sum", "sha1": "sha1sum", "md5": "md5sum", "blake2b": "b2sum"}
+
+READ_BUFFER = 4 * 1024 * 1024  # Local reads, large enough to keep a disk streaming
+BATCH_FILES = 2000  # Files per local worker task and per remote hashing command
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_sample(text):
+    """
+    Parse a sample size: a fraction of the bytes ("0.05", "5%") or a byte budget ("200G").
+
+    Returns:
+    - tuple: (fraction, byte budget), one of them None. (None, None) for a full verification.
+    """
+    text = (text or "").strip().upper()
+    if not text or text == "FULL":
+        return None, None
+    if text.endswith("%"):
+        return float(text[:-1]) / 100, None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)I?B?", text)
+    if not match:
+        raise ValueError(f"Invalid sample size: {text}")
+    value, unit = float(match.group(1)), match.group(2)
+    if not unit and value <= 1:
+        return value, None
+    return None, int(value * SIZE_UNITS[unit])
+
+
+def hash_file(path, algorithm, buffer):
+    """Digest of one file, read into a reused buffer without extra copies."""
+    digest = hashlib.new(algorithm)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+def hash_local_batch(source_dir, paths, algorithm):
+    """
+    Hash a batch of files in a worker process.
+
+    Returns:
+    - dict: path -> hex digest, None for a file that could not be read.
+    """
+    buffer = bytearray(READ_BUFFER)
+    digests = {}
+    for path in paths:
+        try:
+            digests[path] = hash_file(os.path.join(source_dir, path), algorithm, buffer)
+        except OSError:
+            digests[path] = None
+    return digests
+
+
+def remote_hash_cmd(snapshot_dir, algorithm):
+    """Remote command hashing the NUL separated paths read from stdin, relative to snapshot_dir."""
+    return f"cd {shlex.quote(snapshot_dir)} && xargs -0 -r {ALGORITHMS[algorithm]} --"
+
+
+def parse_hash_output(text):
+    """
+    Parse "digest  path" lines of sha256sum and friends.
+
+    A line starting with a backslash has "\\\\" and "\\n" escapes in the path.
+
+    Returns:
+    - dict: path -> hex digest.
+    """
+    digests = {}
+    for line in text.split("\n"):
+        escaped = line.startswith("\\")
+        if escaped:
+            line = line[1:]
+        digest, separator, path = line.partition("  ")
+        if not separator:
+            continue
+        if escaped:
+            path = re.sub(r"\\(.)", lambda match: "\n" if match.group(1) == "n" else match.group(1), path)
+        digests[path] = digest.lower()
+    return digests
+
+
+def sample_key(path):
+    # Stable pseudo-random order, so consecutive sampled runs walk through every file
+    return hashlib.blake2b(path.encode(errors="surrogateescape"), digest_size=8).hexdigest()
+
+
+def select_sample(files, budget, cursor=None):
+    """
+    Pick files up to a byte budget, continuing the rotation where the last run stopped.
+
+    Args:
+    - files (dict): path -> size.
+    - budget (int): Bytes to verify. At least one file is picked.
+    - cursor (str): sample_key of the last file verified by the previous run.
+
+    Returns:
+    - list: Paths to verify.
+    - str: New cursor.
+    """
+    ordered = sorted((sample_key(path), path) for path in files)
+    if not ordered:
+        return [], cursor
+    start = 0
+    if cursor:
+        start = next((index for index, (key, _) in enumerate(ordered) if key > cursor), 0)
+    picked, total = [], 0
+    for offset in range(len(ordered)):
+        key, path = ordered[(start + offset) % len(ordered)]
+        if picked and total + files[path] > budget:
+            break
+        picked.append(path)
+        total += files[path]
+        cursor = key
+    return picked, cursor
+
+
+async def verify_snapshot_async(session, local_path, snapshot_dir, algorithm="sha256", sample=None, cursor=None,
+                                workers=None):
+    """
+    Compare the content of a remote snapshot with the local source by hashing both sides.
+
+    Local files are hashed by a pool of processes while the remote host hashes the same
+    paths, in batches sent over the SSH session one command at a time. Files modified
+    locally since the snapshot started are skipped, they are expected to differ.
+
+    Args:
+    - session (SSHSession): Open session to the remote host.
+    - local_path (str): Local source directory of the configuration.
+    - snapshot_dir (str): Remote snapshot to verify.
+    - algorithm (str): Key of ALGORITHMS, the digest must exist on both hosts.
+    - sample (str): Fraction ("0.05", "5%") or byte budget ("200G") per run, None for every file.
+    - cursor (str): Sample rotation position returned by the previous sampled run.
+    - workers (int): Local hashing processes, the CPU count by default.
+
+    Returns:
+    - dict: snapshot, mode, candidates, verified, bytes, mismatched, missing, unreadable,
+            skipped_changed, local_seconds, remote_seconds, wall_time, cursor.
+    """
+    start = time.monotonic()
+    snapshot = os.path.basename(snapshot_dir.rstrip("/"))
+    snapshot_time = parse_snapshot_name(snapshot)
+    # Anything modified after the run started may legitimately differ from the snapshot
+    changed_after = snapshot_time.timestamp() * 10 ** 9 if snapshot_time else None
+
+    source_dir, prefix = split_source(local_path)
+    tree = await asyncio.to_thread(scan_tree, source_dir, prefix)
+    files, skipped = {}, 0
+    for path, (size, mtime_ns, _, mode) in tree.items():
+        if not stat_module.S_ISREG(mode):
+            continue
+        if changed_after is not None and mtime_ns >= changed_after:
+            skipped += 1
+            continue
+        files[path] = size
+
+    fraction, budget = parse_sample(sample)
+    if fraction is not None:
+        budget = int(sum(files.values()) * fraction)
+    if budget is not None:
+        paths, cursor = select_sample(files, budget, cursor)
+    else:
+        paths = sorted(files)
+    logger.info(f"Verifying {len(paths)} of {len(files)} files of {snapshot} "
+                f"({sum(files[path] for path in paths)} bytes, {algorithm})")
+
+    batches = [paths[index:index + BATCH_FILES] for index in range(0, len(paths), BATCH_FILES)]
+    timings = {"local": 0.0, "remote": 0.0}
+
+    async def hash_local():
+        phase_start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            results = await asyncio.gather(*(loop.run_in_executor(pool, hash_local_batch, source_dir, batch, algorithm)
+                                             for batch in batches))
+        timings["local"] = time.monotonic() - phase_start
+        return {path: digest for result in results for path, digest in result.items()}
+
+    async def hash_remote():
+        phase_start = time.monotonic()
+        digests = {}
+        for batch in batches:
+            # Missing files make the command fail, they are simply absent from the output
+            result = await session.run_async(remote_hash_cmd(snapshot_dir, algorithm), input="\0".join(batch))
+            digests.update(parse_hash_output(result.stdout))
+        timings["remote"] = time.monotonic() - phase_start
+        return digests
+
+    local, remote = await asyncio.gather(hash_local(), hash_remote())
+
+    mismatched, missing, unreadable = [], [], []
+    for path in paths:
+        if local.get(path) is None:
+            unreadable.append(path)
+        elif path not in remote:
+            missing.append(path)
+        elif remote[path] != local[path]:
+            mismatched.append(path)
+
+    verified_bytes = sum(files[path] for path in paths)
+    result = {"snapshot": snapshot, "mode": "full" if budget is None else "sample", "algorithm": algorithm,
+              "candidates": len(files), "verified": len(paths), "bytes": verified_bytes,
+              "mismatched": mismatched, "missing": missing, "unreadable": unreadable, "skipped_changed": skipped,
+              "local_seconds": timings["local"], "remote_seconds": timings["remote"],
+              "wall_time": time.monotonic() - start, "cursor": cursor,
+              "finished": datetime.datetime.now().isoformat(timespec="seconds")}
+    logger.info(f"Verified {len(paths)} files of {snapshot} in {result['wall_time']:.1f}s "
+                f"({verified_bytes / max(result['wall_time'], 1e-9) / 1024 ** 2:.1f} MB/s): "
+                f"{len(mismatched)} mismatched, {len(missing)} missing, {len(unreadable)} unreadable")
+    return result
+
+
+def verify_snapshot(*args, **kwargs):
+    """Blocking verify_snapshot_async."""
+    return asyncio.run(verify_snapshot_async(*args, **kwargs))
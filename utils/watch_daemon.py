@@ -0,0 +1,107 @@
+# ============================================================
+#
+#  Easy backup
+#  Continuous Backup (Watch Mode)
+#
+#  author: Francisco Perdigon Romero
+#  email: fperdigon88@gmail.com
+#  github id: fperdigon
+#
+# ===========================================================
+
+import os
+import time
+from utils.cmd_credentials_management import run_backup_config
+from utils.credentials_management import load_backup_configs, BACKUP_FILE, check_if_backup_config_exist
+from utils.inotify_watch import InotifyWatcher, DirtySet
+from utils.rsync_shards import split_source
+from utils.change_index import collapse_nested
+from utils.logger import logger  # Import the shared logger
+
+
+def dirty_subtrees(local_path, folders):
+    """
+    Convert dirty local folders to paths relative to the rsync source.
+
+    Folders deleted since the event are replaced by their closest existing parent,
+    whose direct entries are synced (with --delete) and no longer hold them. Folders
+    inside a new subtree are left to the recursive sync of that subtree.
+
+    Args:
+    - local_path (str): Watched rsync source.
+    - folders (dict): Dirty folder -> recursive, as drained from the DirtySet.
+
+    Returns:
+    - list: Folders whose direct entries are synced, the source root itself is "."
+            (or its name without a trailing slash).
+    - list: New subtrees, synced recursively.
+    """
+    _, prefix = split_source(local_path)
+    root = os.path.abspath(local_path)
+    flat, subtrees = set(), set()
+    for folder, recursive in folders.items():
+        if recursive and os.path.isdir(folder) and folder.startswith(root + "/"):
+            subtrees.add(prefix + os.path.relpath(folder, root))
+            continue
+        while not os.path.isdir(folder) and folder.startswith(root + "/"):
+            folder = os.path.dirname(folder)
+        if folder.startswith(root + "/"):
+            flat.add(prefix + os.path.relpath(folder, root))
+        else:
+            flat.add(prefix.rstrip("/") or ".")
+    subtrees = collapse_nested(subtrees)
+    flat = [folder for folder in flat if not any(folder.startswith(subtree + "/") or folder == subtree
+                                                 for subtree in subtrees)]
+    return sorted(flat), subtrees
+
+
+def watch_backup(config_name, sync_interval=300, debounce=10, full_interval=86400, max_pending=10000):
+    """
+    Keep a configuration backed up continuously.
+
+    local_path is watched with inotify. Changed folders are coalesced in a bounded
+    set and, once no event has arrived for debounce seconds and at least
+    sync_interval seconds passed since the last sync, only the direct entries of those
+    folders, and the new folders recursively, are synced into a new snapshot. A full reconciling run_incremental_backup pass runs
+    at start and every full_interval seconds, and whenever the pending set overflows.
+
+    Args:
+    - config_name (str): Backup configuration name.
+    - sync_interval (int): Minimum seconds between two subtree syncs.
+    - debounce (int): Quiet seconds required after the last event before syncing.
+    - full_interval (int): Seconds between two full passes.
+    - max_pending (int): Maximum dirty folders kept in memory before falling back to a full pass.
+    """
+    if not check_if_backup_config_exist(config_name):
+        return
+    config = load_backup_configs(backup_file=BACKUP_FILE)[config_name]
+
+    dirty = DirtySet(max_entries=max_pending)
+    with InotifyWatcher(config["local_path"], dirty) as watcher:
+        logger.info(f"Watching {config['local_path']} ({len(watcher.watches)} folders) for backup {config_name}")
+
+        # Events arriving during the first pass are kept, the pass only covers the tree as it was
+        run_backup_config(config)
+        last_full = last_sync = last_event = time.monotonic()
+
+        while True:
+            if watcher.read_events(timeout=1):
+                last_event = time.monotonic()
+
+            now = time.monotonic()
+            if now - last_full >= full_interval or (dirty.overflowed and now - last_event >= debounce):
+                dirty.drain()
+                logger.info(f"Running full pass of backup {config_name}")
+                run_backup_config(config)
+                last_full = last_sync = time.monotonic()
+
+            elif len(dirty) and now - last_event >= debounce and now - last_sync >= sync_interval:
+                folders, subtrees = dirty_subtrees(config["local_path"], dirty.drain()[0])
+                logger.info(f"Syncing {len(folders)} dirty folder(s) and {len(subtrees)} new subtree(s) "
+                            f"of backup {config_name}")
+                # Subtree passes clone the rest of "latest", the change index is left to the full passes
+                exit_code = run_backup_config(config, folders=folders, subtrees=subtrees, index_path=None)
+                if exit_code != 0:
+                    # Try again with a full pass, it covers everything the failed sync missed
+                    dirty.mark_overflow()
+                last_sync = time.monotonic()